@@ -0,0 +1,417 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import time
+import json
+import atexit
+import os
+from urllib.parse import urlencode
+from tempfile import gettempdir
+from binascii import unhexlify
+from .nem_connect import NemConnect, NemConnectError, AnnounceRejectedError, MAIN_NET_PEERS, TEST_NET_PEERS, \
+    ANNOUNCE_EXISTS
+from .transaction_builder import announce_hash
+from .utils import PeerStorage, NemResponse, ResponseStats, MosaicCache
+
+
+class AsyncHttpPool:
+    """
+        asyncio上のHTTP/1.1クライアント、Peer毎にKeep-aliveな接続を保持する
+        peer毎に同時にmaxsize接続まで使い、それ以上は空くのを待つ
+        max_idle秒使われない接続は閉じる
+    """
+    def __init__(self, maxsize=8, max_idle=60, stats=None):
+        self.maxsize = maxsize
+        self.max_idle = max_idle
+        self.stats = stats  # ResponseStats
+        self.pool = dict()  # url: [(reader, writer, last_used), ..]
+        self.limits = dict()  # url: asyncio.Semaphore
+        self.reused = 0
+        self.opened = 0
+        self.closed = 0
+
+    def __repr__(self):
+        return "<AsyncHttpPool peers={} reused={} opened={} closed={}>".format(
+            len(self.pool), self.reused, self.opened, self.closed)
+
+    async def _acquire(self, url):
+        self._evict_idle()
+        idle = self.pool.get(url)
+        while idle:
+            reader, writer, last = idle.pop()
+            if reader.at_eof():
+                self._close(writer)
+                continue
+            self.reused += 1
+            return reader, writer, True
+        reader, writer = await asyncio.open_connection(url[1], url[2])
+        self.opened += 1
+        return reader, writer, False
+
+    def _release(self, url, reader, writer):
+        idle = self.pool.setdefault(url, list())
+        if len(idle) < self.maxsize:
+            idle.append((reader, writer, time.time()))
+        else:
+            self._close(writer)
+
+    def _close(self, writer):
+        writer.close()
+        self.closed += 1
+
+    def _evict_idle(self):
+        limit = time.time() - self.max_idle
+        for url in list(self.pool):
+            idle = self.pool[url]
+            for e in [e for e in idle if e[2] < limit]:
+                idle.remove(e)
+                self._close(e[1])
+            if len(idle) == 0:
+                del self.pool[url]
+
+    def discard(self, url):
+        for reader, writer, last in self.pool.pop(url, list()):
+            self._close(writer)
+
+    def close(self):
+        for url in list(self.pool):
+            self.discard(url)
+
+    def counters(self):
+        return {
+            'reused': self.reused, 'opened': self.opened, 'closed': self.closed,
+            'idle': sum(len(e) for e in self.pool.values())}
+
+    async def request(self, url, method, path, params=None, body=None, timeout=10):
+        call = path
+        if params:
+            path += '?' + urlencode(params)
+        headers = [
+            "%s /%s HTTP/1.1" % (method, path),
+            "Host: %s:%d" % (url[1], url[2]),
+            "Content-Type: application/json",
+            "Connection: keep-alive"]
+        body = b'' if body is None else body
+        if method == 'POST':
+            headers.append("Content-Length: %d" % len(body))
+        raw = ("\r\n".join(headers) + "\r\n\r\n").encode() + body
+        if url not in self.limits:
+            self.limits[url] = asyncio.Semaphore(self.maxsize)
+        async with self.limits[url]:
+            return await self._request(url, call, raw, timeout)
+
+    async def _request(self, url, call, raw, timeout):
+        while True:
+            reader, writer, reused = await asyncio.wait_for(self._acquire(url), timeout)
+            try:
+                writer.write(raw)
+                status, content, keep_alive = await asyncio.wait_for(self._read_response(reader), timeout)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                self._close(writer)
+                if reused:
+                    continue  # 相手が閉じたKeep-alive接続、新しい接続でやり直す
+                raise e
+            except BaseException as e:
+                self._close(writer)
+                raise e
+            if keep_alive:
+                self._release(url, reader, writer)
+            else:
+                self._close(writer)
+            return NemResponse(call, status, content, self.stats)
+
+    async def _read_response(self, reader):
+        line = await reader.readuntil(b"\r\n")
+        status = int(line.split()[1])
+        headers = dict()
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            k, v = line.decode('latin-1').split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = list()
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b';')[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                chunks.append(chunk[:-2])
+            content = b''.join(chunks)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            keep_alive = False
+        return status, content, keep_alive
+
+
+class AsyncNemConnect:
+    """
+        NemConnectのREST API methodをasyncioで使う
+        Peerの選び方とretryはNemConnectと同じ、Peerファイルも共有する
+        TXの作成や手数料計算などはNemConnectを使う
+    """
+    TRANSFER_INCOMING = NemConnect.TRANSFER_INCOMING
+    TRANSFER_OUTGOING = NemConnect.TRANSFER_OUTGOING
+    TRANSFER_ALL = NemConnect.TRANSFER_ALL
+    nem_xem_define = NemConnect.nem_xem_define
+    timeout = NemConnect.timeout
+    peer_ttl = NemConnect.peer_ttl
+    announce_peers = NemConnect.announce_peers
+    height = 0
+
+    def __init__(self, main_net=True):
+        self.main_net = main_net
+        self.TMP_DIR = os.path.join(gettempdir(), 'nem_python' + ('' if main_net else '_test'))
+        self.PEER_FILE = os.path.join(self.TMP_DIR, 'peer.json')
+        if not os.path.exists(self.TMP_DIR):
+            os.mkdir(self.TMP_DIR)
+        self.peers = PeerStorage(path=self.PEER_FILE)
+        if len(self.peers) < 5:
+            self.peers.update(MAIN_NET_PEERS if main_net else TEST_NET_PEERS)
+        # Mosaic定義とsupplyのキャッシュ、NemConnectと同じファイル
+        self.mosaic_cache = MosaicCache(path=os.path.join(self.TMP_DIR, 'mosaic.json'))
+        atexit.register(self.mosaic_cache.save)
+        # endpoint毎の応答bytesとparse時間
+        self.response_stats = ResponseStats()
+        self.http = AsyncHttpPool(stats=self.response_stats)
+
+    async def connect(self):
+        # 今の正確なHeightを挿入
+        self.height = await self.get_biggest_height()
+        return self.height
+
+    def close(self):
+        self.http.close()
+        self.mosaic_cache.save()
+
+    async def _random_choice_url(self):
+        # 1回の呼び出しで各Peerは1度だけ試す
+        tried = set()
+        while True:
+            try:
+                url = self.peers.random(exclude=tried)
+            except IndexError:
+                break
+            tried.add(url)
+            try:
+                if self.peers.is_alive(url, ttl=self.peer_ttl, height=self.height - 1):
+                    return url  # 最近確認済み
+                d = await self._get(call='chain/last-block', url=url)
+                height = d.json()['height']
+                if self.height - 1 < height:
+                    self.peers.caught_up(url)
+                    return url
+                else:
+                    self.peers.lagging(url)
+            except NemConnectError:
+                continue  # _getで記録済み
+            except Exception:
+                self.peers.failure(url)
+        raise NemConnectError("run out of API connection pool.")
+
+    async def _get(self, call, url, data=None):
+        try:
+            begin = time.time()
+            r = await self.http.request(url, 'GET', call, params=data, timeout=self.timeout)
+        except Exception as e:
+            self.peers.failure(url)
+            self.http.discard(url)
+            raise NemConnectError(e)
+        self.peers.report_response(url=url, call=call, response=r, latency=time.time() - begin)
+        return r
+
+    async def _get_auto(self, call, data=None):
+        retry = 10
+        while retry > 0:
+            retry -= 1
+            url = await self._random_choice_url()
+            try:
+                r = await self._get(call=call, url=url, data=data)
+            except NemConnectError as e:
+                logging.error(e)
+                continue
+            return r
+        else:
+            raise NemConnectError("many retry error '%s', %s" % (call, data))
+
+    async def _post(self, call, url, data=None):
+        try:
+            body = json.dumps(data).encode()
+            return await self.http.request(url, 'POST', call, body=body, timeout=self.timeout)
+        except Exception as e:
+            self.peers.failure(url)
+            self.http.discard(url)
+            raise NemConnectError(e)
+
+    """ rest api methods """
+
+    async def get_account_info(self, ck):
+        data = await self._get_auto(call="account/get", data={"address": ck})
+        if not data.ok:
+            raise NemConnectError("failed 'account/get' %s" % ck)
+        return data.json()
+
+    async def get_account_owned_mosaic(self, ck):
+        data = await self._get_auto(call="account/mosaic/owned", data={"address": ck})
+        if not data.ok:
+            raise NemConnectError("failed 'account/mosaic/owned' %s" % ck)
+        return {
+            "{}:{}".format(e['mosaicId']['namespaceId'], e['mosaicId']['name']): e['quantity']
+            for e in data.json()['data']}
+
+    async def get_namespace2definition(self, namespace, cashe=True):
+        if namespace == 'nem':
+            return {'nem:xem': self.nem_xem_define}
+        if cashe:
+            result = self.mosaic_cache.get_definition(namespace)
+            if result is not None:
+                return result
+
+        index_id = None
+        url = await self._random_choice_url()
+        result = dict()
+        while True:
+            data = await self._get(
+                call="namespace/mosaic/definition/page",
+                url=url,
+                data={"namespace": namespace, "id": index_id} if index_id else {"namespace": namespace})
+            if not data.ok:
+                index_id = None
+                url = await self._random_choice_url()
+                logging.error("failed get mosaic def, retry")
+                continue
+            j = data.json()['data']
+            if len(j) == 0:
+                self.mosaic_cache.put_definition(namespace, result)
+                return result
+            result.update({"{}:{}".format(e['mosaic']['id']['namespaceId'], e['mosaic']['id']['name'])
+                           : e['mosaic'] for e in j})
+            index_id = j[-1]['meta']['id']
+
+    async def get_namespace_regist_height(self, namespace):
+        top_namespace = namespace.split('.')[0]
+        if top_namespace == 'nem':
+            raise NemConnectError('\"nem\" is ')
+        d = await self._get_auto(call='namespace', data={'namespace': top_namespace})
+        if not d.ok:
+            raise NemConnectError('Not found namespace.')
+        return d.json()['height']
+
+    async def get_mosaic_supply(self, namespace_name, cashe=True):
+        if cashe:
+            supply = self.mosaic_cache.get_supply(namespace_name, self.height)
+            if supply is not None:
+                return supply
+        data = await self._get_auto(call='mosaic/supply', data={'mosaicId': namespace_name})
+        j = data.json()
+        if not data.ok:
+            raise NemConnectError("failed 'mosaic/supply' %s" % j['message'])
+        # supplyMutable=falseなら二度と変わらない
+        definition = (await self.get_namespace2definition(namespace_name.split(':')[0])).get(namespace_name)
+        mutable = definition is None or any(
+            p['name'] == 'supplyMutable' and p['value'] != 'false' for p in definition['properties'])
+        self.mosaic_cache.put_supply(namespace_name, j['supply'], self.height, mutable)
+        return j['supply']
+
+    async def get_account_transfer_newest(self, ck, call_name=TRANSFER_INCOMING):
+        data = await self._get_auto(call=call_name, data={'address': ck})
+        if not data.ok:
+            raise NemConnectError("failed '%s' %s" % (call_name, data.json()['message']))
+        return data.json()['data']
+
+    async def get_account_transfer_all(self, ck, call_name=TRANSFER_INCOMING, c=100):
+        # tmpファイルのCasheは使わず、最新から順に全て取得する
+        url = await self._random_choice_url()
+        result = list()
+        params = {'address': ck}
+        while c > 0:
+            c -= 1
+            data = await self._get(call=call_name, url=url, data=params)
+            if not data.ok:
+                raise NemConnectError("failed '%s' %s" % (call_name, data.json()['message']))
+            j = data.json()['data']
+            if len(j) == 0:
+                return result
+            result.extend(j)
+            params = {'address': ck, 'id': j[-1]['meta']['id']}
+        else:
+            logging.error("not completed! %s" % ck)
+            return result
+
+    async def get_account_harvests_newest(self, ck):
+        data = await self._get_auto(call="account/harvests", data={'address': ck})
+        if not data.ok:
+            raise NemConnectError("failed 'account/harvests' %s" % data.json()['message'])
+        return data.json()['data']
+
+    async def get_last_chain(self):
+        data = await self._get_auto(call='chain/last-block')
+        return data.json()
+
+    async def get_biggest_height(self):
+        while True:
+            data = await self._get_auto(call='node/active-peers/max-chain-height')
+            j = data.json()
+            if 'height' in j:
+                return j['height']
+
+    """ broadcast functions """
+
+    async def transaction_announce(self, tx_hex, tx_sign):
+        # 送金先をランダムで選ぶ
+        url_set = set()
+        count = self.announce_peers * 3
+        while count > 0:
+            count -= 1
+            url_set.add(await self._random_choice_url())
+            if len(url_set) >= self.announce_peers:
+                break
+
+        # hashは手元で決まる、既に受け付けられたTXの再announceも成功とする
+        local_hash = announce_hash(unhexlify(NemConnect.byte2str(tx_hex).encode()))
+        # 並列に送金実行、最初のSUCCESSで返す(残りはそのまま完了させる)
+        data = {'data': NemConnect.byte2str(tx_hex), 'signature': NemConnect.byte2str(tx_sign)}
+        pending = {asyncio.ensure_future(self._announce(url, data)) for url in url_set}
+        result_message = list()
+        rejected_all = True
+        while len(pending) > 0:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                message, tx_hash, rejected = future.result()
+                result_message.append(message)
+                rejected_all = rejected_all and rejected
+                if message == 'SUCCESS' and tx_hash is not None:
+                    if tx_hash != local_hash:
+                        logging.warning("txhash differ, local=%s peer=%s" % (local_hash, tx_hash))
+                    return tx_hash
+                elif message in ANNOUNCE_EXISTS:
+                    return local_hash
+        if rejected_all:
+            # 全てのPeerが内容を見て断った、受け付けられたPeerは無い
+            raise AnnounceRejectedError("rejected 'transaction/announce' %s" % result_message)
+        raise NemConnectError("failed 'transaction/announce' %s" % result_message)
+
+    async def _announce(self, url, data):
+        # (message, tx_hash, NISが断ったか)
+        try:
+            r = await self._post(call="transaction/announce", url=url, data=data)
+            j = r.json()
+            if r.ok or j.get('message') in ANNOUNCE_EXISTS:
+                message = j['message']
+            else:
+                message = "%d %s" % (r.status_code, j.get('message'))
+            if message != 'SUCCESS':
+                return message, None, NemConnect._is_rejected(r, j)
+            try:
+                return 'SUCCESS', j['innerTransactionHash']['data'], False  # multi sig
+            except KeyError:
+                return 'SUCCESS', j['transactionHash']['data'], False  # single sig
+        except (NemConnectError, ValueError, KeyError) as e:
+            # 通信エラーは受け付けられたか分からない
+            return str(e), None, False
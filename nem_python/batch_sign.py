@@ -0,0 +1,182 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+"""
+多数の送金TXをまとめて作成・署名する
+Fee計算に使うMosaicの定義とsupplyは先に1回だけ取得(snapshot)し、署名はProcessに分ける
+
+    snapshot = create_snapshot(nem, mosaics)
+    signed = batch_sign(snapshot, Signer(sk, pk), [(recipient_ck, {'nem:xem': 1000000}, b'msg'), ..])
+    for tx_dict, tx_hex, sign_hex, txhash, fee in signed:
+        nem.transaction_announce(tx_hex, sign_hex)
+
+署名Processはspawnで作り(threadを持つProcessのforkは危険)、次の呼び出しでも使い回す
+spawnはmainを読み直すので、scriptでは if __name__ == '__main__': の中から呼ぶこと
+"""
+
+from multiprocessing import get_context
+from binascii import hexlify
+import atexit
+import threading
+import os
+import time
+from .transaction_builder import TransactionBuilder
+from .dict_math import DictMath
+from .nem_connect import NemConnect, NemConnectError
+
+
+def create_snapshot(nem, mosaics):
+    """ 署名Processへ渡すFee計算用のMosaic情報、通信はここだけ """
+    mosaics = set(mosaics)
+    nem.prefetch_mosaics(mosaics)
+    snapshot = {'main_net': nem.main_net, 'retention': nem.retention, 'mosaics': dict()}
+    for namespace_name in mosaics:
+        definition = nem.get_namespace2definition(namespace_name.split(':')[0])
+        if namespace_name not in definition:
+            raise NemConnectError("not found mosaic: %s" % namespace_name)
+        divi = None
+        for p in definition[namespace_name]['properties']:
+            if p['name'] == 'divisibility':
+                divi = int(p['value'])
+        snapshot['mosaics'][namespace_name] = {
+            'divisibility': divi,
+            'supply': nem.get_mosaic_supply(namespace_name),
+            'levy': definition[namespace_name]['levy']}
+    return snapshot
+
+
+def send_fee(snapshot, mosaics, factor=20):
+    """ NemConnect.estimate_send_fee と同じ計算をsnapshotで行う """
+    if len(mosaics) == 1 and 'nem:xem' in mosaics:
+        fee = NemConnect._calc_min_xem_fee(xem_int=mosaics['nem:xem'], factor=factor)
+    else:
+        fee = 0.0
+        for namespace_name in mosaics:
+            m = _mosaic(snapshot, namespace_name)
+            fee += NemConnect._calc_mosaic_fee(
+                quantity_int=mosaics[namespace_name], supply=m['supply'], divi=m['divisibility'], factor=factor)
+    return {'nem:xem': round(fee * 1000000)}
+
+
+def levy_fee(snapshot, mosaics):
+    """ NemConnect.estimate_levy_fee と同じ計算をsnapshotで行う """
+    fee = {'nem:xem': 0}
+    for namespace_name in mosaics:
+        if namespace_name == 'nem:xem':
+            continue
+        levy = _mosaic(snapshot, namespace_name)['levy']
+        if len(levy) == 0:
+            continue
+        levy_mosaic = "{}:{}".format(levy['mosaicId']['namespaceId'], levy['mosaicId']['name'])
+        amount = levy['fee'] if levy['type'] == 1 else round(levy['fee'] * mosaics[namespace_name] / 10000)
+        fee[levy_mosaic] = fee.get(levy_mosaic, 0) + amount
+    return fee
+
+
+def transfer_dict(snapshot, sender_pk, recipient_ck, mosaics, msg_body=b'', msg_type=1, now=None):
+    """ NemConnect.mosaic_transfer と同じTXを通信せずに作る、nowはNEMの時刻 """
+    transfer_type = 1 if len(mosaics) == 1 and 'nem:xem' in mosaics else 2
+    transfer_version = (1744830464 if snapshot['main_net'] else -1744830464) + transfer_type
+    transfer_fee = DictMath.add(NemConnect.estimate_msg_fee(msg=msg_body), send_fee(snapshot, mosaics))
+    now = _nem_time() if now is None else now
+    tx_dict = {
+        'type': 257,
+        'version': transfer_version,
+        'signer': sender_pk,
+        'timeStamp': now,
+        'deadline': now + snapshot['retention'],
+        'recipient': recipient_ck,
+        'amount': mosaics['nem:xem'] if transfer_type == 1 else 1000000,
+        'fee': transfer_fee['nem:xem'],
+        'message': {'type': msg_type, 'payload': hexlify(msg_body).decode()}}
+    if transfer_type == 2:
+        tx_dict['mosaics'] = [
+            {'mosaicId': {'namespaceId': n.split(":")[0], 'name': n.split(":")[1]}, 'quantity': mosaics[n]}
+            for n in mosaics]
+    return tx_dict
+
+
+def build_sign(snapshot, signer, entries, now=None):
+    """
+    entries = [(recipient_ck, mosaics, msg_body[, msg_type]), ..]
+    return [(tx_dict, tx_hex, sign_hex, txhash, fee), ..]、feeはlevyを含む
+    全てのTXのtimeStampをnowに揃える
+    """
+    now = _nem_time() if now is None else now
+    built = list()
+    for entry in entries:
+        recipient_ck, mosaics, msg_body = entry[:3]
+        msg_type = entry[3] if len(entry) > 3 else 1
+        tx_dict = transfer_dict(snapshot, signer.pk, recipient_ck, mosaics, msg_body, msg_type, now)
+        tb = TransactionBuilder()
+        tx_raw = tb.encode_raw(tx_dict)
+        fee = DictMath.add(levy_fee(snapshot, mosaics), {'nem:xem': tx_dict['fee']})
+        built.append((tx_dict, tx_raw, tb.txhash, fee))
+    signs = signer.sign_many([tx_raw for tx_dict, tx_raw, txhash, fee in built])
+    return [(tx_dict, hexlify(tx_raw).decode(), hexlify(sign_raw).decode(), txhash, fee)
+            for (tx_dict, tx_raw, txhash, fee), sign_raw in zip(built, signs)]
+
+
+def batch_sign(snapshot, signer, entries, workers=None, chunksize=None):
+    """
+    entriesを順番通りに作成・署名する、workers個のProcessで分担
+    timeStampは全て同じで、同じ内容のTXは同じhashになりNISが1つしか受け付けないのでエラー
+    """
+    entries = list(entries)
+    now = _nem_time()
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(entries) < 2:
+        signed = build_sign(snapshot, signer, entries, now)
+    else:
+        # Poolは使い回すのでsnapshotとSignerはchunkと一緒に送る、entryはまとめて送る
+        chunksize = chunksize or max(1, len(entries) // (workers * 4))
+        chunks = [(snapshot, signer, now, entries[i:i + chunksize]) for i in range(0, len(entries), chunksize)]
+        signed = [e for chunk in _pool(workers).map(_build_sign, chunks) for e in chunk]
+    seen = dict()
+    for index, (tx_dict, tx_hex, sign_hex, txhash, fee) in enumerate(signed):
+        if txhash in seen:
+            raise BatchSignError('entry %d is same tx as entry %d' % (index, seen[txhash]))
+        seen[txhash] = index
+    return signed
+
+
+def _nem_time():
+    return int(time.time()) - 1427587585
+
+
+def _mosaic(snapshot, namespace_name):
+    try:
+        return snapshot['mosaics'][namespace_name]
+    except KeyError:
+        raise BatchSignError("not in snapshot: %s" % namespace_name)
+
+
+_pools = dict()  # workers: Pool
+_pools_lock = threading.Lock()
+
+
+def _pool(workers):
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = get_context('spawn').Pool(processes=workers)
+        return _pools[workers]
+
+
+def close_pool():
+    """ 署名Processを終了する、終了時にも呼ばれる """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+            pool.join()
+        _pools.clear()
+
+
+atexit.register(close_pool)
+
+
+def _build_sign(args):
+    snapshot, signer, now, entries = args
+    return build_sign(snapshot, signer, entries, now)
+
+
+class BatchSignError(Exception): pass
@@ -7,15 +7,18 @@ import time
 import logging
 import os
 import random
+from concurrent.futures import ThreadPoolExecutor
 from binascii import unhexlify, hexlify
 import fasteners
 from tempfile import gettempdir
 from nem_ed25519.key import get_address, is_address
-from nem_ed25519.signature import sign
-from nem_ed25519.encrypt import encrypt
 from ..transaction_reform import TransactionReform
+from ..nem_connect import AnnounceRejectedError
 from ..transaction_builder import TransactionBuilder
+from ..batch_sign import create_snapshot, batch_sign
+from ..signer import Signer
 from ..dict_math import DictMath
+from ..metrics import TimedConnection
 from .utils import int_time, tag2hex, msg2tag
 
 F_DEBUG = True
@@ -27,6 +30,10 @@ class Account(threading.Thread):
     expired_id = 2
     owner_id = 3
     confirm_height = 3
+    reannounce_interval = 60  # 承認されないTXをannounceし直す間隔
+    wait_interval = 10  # 承認待ちのTXを確かめる間隔
+    expire_margin = 180  # deadline後も承認が見えるのを待つ時間
+    announce_workers = 4  # send_manyで同時にannounceする数
     f_close = False
     f_at_first = False
 
@@ -37,6 +44,8 @@ class Account(threading.Thread):
         self.nem = nem
         self.sk = sk
         self.pk = pk
+        # 鍵の展開は1回だけ、署名と暗号化で使い回す
+        self.signer = Signer(sk, pk) if sk else None
         self.main_net = main_net
         self.ck = get_address(pk, main_net=main_net)
         dir_name = 'nem_python' + ('' if main_net else '_test')
@@ -53,6 +62,10 @@ class Account(threading.Thread):
         self.iso_level = "IMMEDIATE"  # Write時のみLock
         self._check_new_creation()
         self.db = self.create_connect()
+        # 承認待ちのTX、1つのthreadでまとめて確かめる
+        self.waiting = dict()  # txhash: {'announced', 'last_announce', 'tx_hex', 'sign_hex', 'deadline', 'height'}
+        self.waiting_lock = threading.Lock()
+        self.waiting_thread = None
 
     def run(self):
         logging.info("Start account engine")
@@ -122,7 +135,10 @@ class Account(threading.Thread):
     """ SYSTEM ACTIONS """
 
     def create_connect(self):
-        return sqlite3.connect(database=self.db_path, isolation_level=self.iso_level)
+        # SQLの所要時間をnem.metricsに記録する
+        db = sqlite3.connect(database=self.db_path, isolation_level=self.iso_level, factory=TimedConnection)
+        db.metrics = self.nem.metrics
+        return db
 
     def backup(self):
         import shutil
@@ -454,7 +470,7 @@ class Account(threading.Thread):
             if to_pk is None:
                 raise AccountError('You send encrypt msg to Account that have never send before.')
             # Generally cannot convert CK to PK.
-            msg = encrypt(self.sk, to_pk, msg)
+            msg = self.signer.encrypt(to_pk, msg)
             msg_type = 2
         else:
             msg_type = 1
@@ -463,8 +479,10 @@ class Account(threading.Thread):
         fee = DictMath.add(fee, self.nem.estimate_send_fee(mosaics))
         tx_dict = self.nem.mosaic_transfer(self.pk, to_address, mosaics, msg, msg_type)
         tb = TransactionBuilder()
-        tx_hex = tb.encode(tx_dict)
-        sign_raw = sign(msg=unhexlify(tx_hex.encode()), sk=self.sk, pk=self.pk)
+        tx_raw = tb.encode_raw(tx_dict)
+        tx_hex = hexlify(tx_raw).decode()
+        tx_hash = tb.txhash  # announce前に決まる
+        sign_raw = self.signer.sign(tx_raw)
         sign_hex = hexlify(sign_raw).decode()
         if only_check:
             balance = self.balance(from_id)
@@ -473,6 +491,8 @@ class Account(threading.Thread):
             # only_check=False return sending info, NOT send
             return fee, send_ok, tx_dict, tx_hex, sign_hex
         else:
+            # 先に台帳へ書いてからannounceする、通信中はLockを持たない
+            height = self.nem.height  # これより前のBlockには入らない
             with self.transaction:
                 self.refresh(db=db)
                 with db as conn:
@@ -481,52 +501,217 @@ class Account(threading.Thread):
                     if balance_check and not DictMath.all_plus_amount(DictMath.sub(balance, need_amount)):
                         need = {m: a for m, a in DictMath.sub(balance, need_amount).items() if a < 0}
                         raise AccountError('Not enough balance on ID:%d, %s' % (from_id, need))
-                    tx_hash = self.nem.transaction_announce(tx_hex, sign_hex)
-                    outgoing_many = list()
-                    for mosaic in need_amount:
-                        # height, time is None
-                        amount = need_amount[mosaic]
-                        value = self.get_value(mosaic, amount, db=db)
-                        price = self.get_price(mosaic, db=db)
-                        outgoing_many.append((
-                            unhexlify(tx_hash.encode()), None, from_id, mosaic, amount, value, price, None
-                        ))
                     conn.executemany("""
                     INSERT INTO `outgoing_table` VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    """, outgoing_many)
+                    """, self._outgoing_many(tx_hash, from_id, need_amount, db))
                     conn.commit()
-                threading.Thread(target=self._send, name='Wait',
-                                 args=(tx_hash,), daemon=False).start()
+            try:
+                self._announce(tx_hash, tx_hex, sign_hex)
+            except AnnounceRejectedError:
+                # NISが断ったので承認されない、書いた分を戻す
+                self._remove_unconfirmed(tx_hash, db)
+                raise
+            self._wait([(tx_hash, tx_hex, sign_hex, tx_dict['deadline'])], height)
             return tx_hash
 
-    def _send(self, txhash):
-        span = 10
-        limit = self.nem.retention // span
+    def sign_many(self, from_id, entries, workers=None, db=None):
+        """
+        多数の送金をまとめて作成・署名する、announceはしない
+        台帳(outgoing_table)には書かないので、自分でannounceするならsend_manyを使う
+        entries = [(to_address, mosaics, msg), ..]
+        return (fee, send_ok, [(tx_dict, tx_hex, sign_hex, txhash, fee), ..])
+        """
+        if db is None:
+            db = self.db
+        assert self.sk is not None, 'You need sk if you use \"sign_many\"'
+        entries = [(to_address.replace('-', ''), mosaics, msg) for to_address, mosaics, msg in entries]
+        namespaces = set()
+        for to_address, mosaics, msg in entries:
+            if to_address == self.ck:
+                raise AccountError("You send to and receive to same address.")
+            elif not is_address(to_address):
+                raise AccountError('Not correct address format. %s' % to_address)
+            namespaces.update(mosaics)
+        for mosaic in namespaces:
+            self._check_expire_mosaic(mosaic, db)
+        # Fee計算に使う情報は1回だけ取得して全Processで使う
+        snapshot = create_snapshot(self.nem, namespaces)
+        signed = batch_sign(snapshot, self.signer, entries, workers=workers)
+        fee = dict()
+        need_amount = dict()
+        for (to_address, mosaics, msg), (tx_dict, tx_hex, sign_hex, txhash, tx_fee) in zip(entries, signed):
+            fee = DictMath.add(fee, tx_fee)
+            need_amount = DictMath.add(need_amount, mosaics)
+        need_amount = DictMath.add(need_amount, fee)
+        send_ok = DictMath.all_plus_amount(DictMath.sub(self.balance(from_id, db=db), need_amount))
+        return fee, send_ok, signed
+
+    def send_many(self, from_id, entries, workers=None, balance_check=True, db=None):
+        """
+        多数の送金をまとめて作成・署名し、台帳へ書いてからannounceする
+        entries = [(to_address, mosaics, msg), ..]
+        return [txhash, ..]、NISに断られたTXは台帳から戻してNone
+        """
+        if db is None:
+            db = self.db
+        *dummy, signed = self.sign_many(from_id, entries, workers=workers, db=db)
+        height = self.nem.height  # これより前のBlockには入らない
+        # 各TXのhashで台帳へ書く、残高は全体で確かめる
+        tx_need = [DictMath.add(tx_fee, mosaics)
+                   for (to_address, mosaics, msg), (tx_dict, tx_hex, sign_hex, txhash, tx_fee) in zip(entries, signed)]
+        with self.transaction:
+            self.refresh(db=db)
+            with db as conn:
+                balance = self.balance(from_id)
+                need_amount = dict()
+                for need in tx_need:
+                    need_amount = DictMath.add(need_amount, need)
+                if balance_check and not DictMath.all_plus_amount(DictMath.sub(balance, need_amount)):
+                    need = {m: a for m, a in DictMath.sub(balance, need_amount).items() if a < 0}
+                    raise AccountError('Not enough balance on ID:%d, %s' % (from_id, need))
+                outgoing_many = list()
+                for (tx_dict, tx_hex, sign_hex, txhash, tx_fee), need in zip(signed, tx_need):
+                    outgoing_many.extend(self._outgoing_many(txhash, from_id, need, db))
+                conn.executemany("""
+                INSERT INTO `outgoing_table` VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, outgoing_many)
+                conn.commit()
+        # announceは並列に、承認待ちはまとめて1つのthreadで確かめる
+        with ThreadPoolExecutor(max_workers=self.announce_workers) as pool:
+            errors = list(pool.map(self._announce_many, signed))
+        txhashes = list()
+        waiting = list()
+        for (tx_dict, tx_hex, sign_hex, txhash, tx_fee), error in zip(signed, errors):
+            if error is not None:
+                logging.warning("Rejected announce 0x%s %s" % (txhash, error))
+                self._remove_unconfirmed(txhash, db)
+                txhashes.append(None)
+            else:
+                txhashes.append(txhash)
+                waiting.append((txhash, tx_hex, sign_hex, tx_dict['deadline']))
+        self._wait(waiting, height)
+        return txhashes
+
+    def _announce_many(self, signed):
+        # NISに断られたらそのエラー
+        tx_dict, tx_hex, sign_hex, txhash, tx_fee = signed
+        try:
+            self._announce(txhash, tx_hex, sign_hex)
+        except AnnounceRejectedError as e:
+            return e
+        return None
+
+    def _outgoing_many(self, txhash, from_id, need_amount, db):
+        # height, time is None
+        outgoing_many = list()
+        for mosaic in need_amount:
+            amount = need_amount[mosaic]
+            value = self.get_value(mosaic, amount, db=db)
+            price = self.get_price(mosaic, db=db)
+            outgoing_many.append((
+                unhexlify(txhash.encode()), None, from_id, mosaic, amount, value, price, None
+            ))
+        return outgoing_many
+
+    def _announce(self, txhash, tx_hex, sign_hex):
+        # NISが断った時だけAnnounceRejectedError
+        try:
+            announced_hash = self.nem.transaction_announce(tx_hex, sign_hex)
+            if announced_hash != txhash:
+                logging.warning("txhash differ, local=%s announced=%s" % (txhash, announced_hash))
+        except AnnounceRejectedError:
+            raise
+        except Exception as e:
+            # 受け付けられた後の通信エラーかもしれないので台帳は残し、_sendでannounceし直すか期限で消す
+            logging.warning("Unknown announce result 0x%s %s" % (txhash, e))
+
+    def _wait(self, waiting, height):
+        """
+        承認待ちに加える、waiting = [(txhash, tx_hex, sign_hex, deadline), ..]
+        heightはannounce前のBlock高、deadlineはNEMの時刻
+        """
+        now = time.time()
+        with self.waiting_lock:
+            for txhash, tx_hex, sign_hex, deadline in waiting:
+                self.waiting[txhash] = {
+                    'announced': now, 'last_announce': now, 'tx_hex': tx_hex, 'sign_hex': sign_hex,
+                    'deadline': deadline + 1427587585, 'height': height}
+            if len(self.waiting) > 0 and self.waiting_thread is None:
+                self.waiting_thread = threading.Thread(target=self._send, name='Wait', daemon=False)
+                self.waiting_thread.start()
+
+    def _send(self):
+        # 承認待ちのTXを1つのthreadで確かめる、時々announceし直す(同じTXなので何度でも良い)
         tr = TransactionReform(main_net=self.main_net, your_ck=self.ck)
         db = self.create_connect()
-        while limit > 0:
-            limit -= 1
-            time.sleep(span)
-            txs = self.nem.get_account_transfer_newest(self.ck, self.nem.TRANSFER_OUTGOING)
-            txs = tr.reform_transactions(txs)
-            for tx in txs:
-                if tx['txhash'] != txhash:
-                    continue
-                with db as conn:
-                    conn.execute("""
-                    UPDATE `outgoing_table` SET `height`= ?, `time`= ? WHERE `txhash`= ?
-                    """, (tx['height'], tx['time'], unhexlify(txhash.encode())))
-                    conn.commit()
-                logging.info("Sending success 0x%s" % txhash)
-                db.close()
-                return
-        # remove unconfirmed sending tx
-        with db as conn:
-            conn.execute("""
-            DELETE `outgoing_table` WHERE `txhahs` = ?
-            """, (unhexlify(txhash.encode()),))
-            conn.commit()
-        logging.info("Failed sending 0x%s" % txhash)
+        while True:
+            time.sleep(self.wait_interval)
+            with self.waiting_lock:
+                waiting = dict(self.waiting)
+            try:
+                confirmed = self._find_outgoing(waiting, tr)
+            except Exception as e:
+                logging.debug("Failed outgoing check %s" % e)
+                confirmed = None  # 分からない間は台帳を消さない
+            done = list()
+            for txhash, entry in waiting.items():
+                now = time.time()
+                if confirmed is not None and txhash in confirmed:
+                    tx = confirmed[txhash]
+                    with db as conn:
+                        conn.execute("""
+                        UPDATE `outgoing_table` SET `height`= ?, `time`= ? WHERE `txhash`= ?
+                        """, (tx['height'], tx['time'], unhexlify(txhash.encode())))
+                        conn.commit()
+                    self.nem.metrics.observe('account_confirm_seconds', now - entry['announced'])
+                    logging.info("Sending success 0x%s" % txhash)
+                    done.append(txhash)
+                elif now > entry['deadline'] + self.expire_margin:
+                    if confirmed is None:
+                        # 確かめられないまま期限を過ぎた、台帳は残す
+                        logging.error("Unknown sending result 0x%s" % txhash)
+                    else:
+                        # remove unconfirmed sending tx
+                        self.nem.metrics.inc('account_confirm_failed_total')
+                        self._remove_unconfirmed(txhash, db)
+                        logging.info("Failed sending 0x%s" % txhash)
+                    done.append(txhash)
+                elif now < entry['deadline'] and now - entry['last_announce'] > self.reannounce_interval:
+                    entry['last_announce'] = now
+                    try:
+                        self.nem.transaction_announce(entry['tx_hex'], entry['sign_hex'])
+                        logging.debug("Re-announce 0x%s" % txhash)
+                    except Exception as e:
+                        logging.debug("Failed re-announce 0x%s %s" % (txhash, e))
+            with self.waiting_lock:
+                for txhash in done:
+                    self.waiting.pop(txhash, None)
+                if len(self.waiting) == 0:
+                    self.waiting_thread = None
+                    break
+        db.close()
+
+    def _find_outgoing(self, waiting, tr):
+        # 送金履歴を新しい順に遡り、announce前のBlock高より古くなれば止める(newestの25件だけでは足りない)
+        bottom = min(entry['height'] for entry in waiting.values())
+        found = dict()
+        for tx in self.nem.iter_account_transfers(self.ck, self.nem.TRANSFER_OUTGOING):
+            if tx['meta']['height'] < bottom:
+                break
+            for r in tr.reform_transactions([tx]):
+                if r['txhash'] in waiting:
+                    found[r['txhash']] = r
+            if len(found) == len(waiting):
+                break
+        return found
+
+    def _remove_unconfirmed(self, txhash, db):
+        with self.transaction:
+            with db as conn:
+                conn.execute("""
+                DELETE FROM `outgoing_table` WHERE `txhash` = ? AND `height` IS NULL
+                """, (unhexlify(txhash.encode()),))
+                conn.commit()
 
     def move_by_group(self, from_group, to_group, mosaics, db=None):
         from_user_list = self.id_of_group(from_group, db=db)
@@ -743,24 +928,26 @@ class Account(threading.Thread):
             else:
                 raise AccountError('Unexpected status')
 
-    def _get_history(self, call):
+    def _get_history(self, call, tr):
+        # 履歴をHistoryStoreに揃えてから古い順に1つずつ返す
         count = 100
         while count > 0:
             try:
-                return self.nem.get_account_transfer_all(
-                    ck=self.ck, call_name=call, c=10000)
+                self.nem.sync_history(ck=self.ck, call_name=call, c=10000)
+                break
             except Exception as e:
                 time.sleep(5)
                 logging.info("Failed _get_history %s" % e)
                 continue
-        raise AccountError('Cannot get account history.')
+        else:
+            raise AccountError('Cannot get account history.')
+        return (reformed for tx in self.nem.history.iter_read(kind=call, ck=self.ck, oldest_first=True)
+                for reformed in tr.reform_transactions([tx]))
 
     def _initialize(self, db):
         tr = TransactionReform(main_net=self.main_net, your_ck=self.ck)
-        incoming = self._get_history(self.nem.TRANSFER_INCOMING)
-        incoming = tr.reform_transactions(incoming)[::-1]
-        outgoing = self._get_history(self.nem.TRANSFER_OUTGOING)
-        outgoing = tr.reform_transactions(outgoing)[::-1]
+        incoming = self._get_history(self.nem.TRANSFER_INCOMING, tr)
+        outgoing = self._get_history(self.nem.TRANSFER_OUTGOING, tr)
 
         with db as conn:
             self.refresh(db=db)
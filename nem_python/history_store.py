@@ -0,0 +1,182 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import threading
+import logging
+import json
+import time
+
+
+class HistoryStore:
+    """
+        送受金・Harvest履歴のSQLiteキャッシュ
+        (kind, ck)毎に手元にある連続した範囲[oldest, newest]を記録し
+        新しい分と古い分だけを取得する、書き込みは新しいTXの数だけ
+        途中で止まった時はgap_top/gap_cursorから続ける
+        kind = 'account/transfers/incoming' などcall名そのまま
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(database=path, check_same_thread=False)
+        with self.lock:
+            # 新規作成時のみ有効、evictで空いた領域を返せるようにする
+            self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("""
+            CREATE TABLE IF NOT EXISTS `history` (
+            `kind` TEXT NOT NULL, `ck` TEXT NOT NULL, `id` INTEGER NOT NULL,
+            `height` INTEGER, `hash` TEXT, `body` TEXT NOT NULL,
+            PRIMARY KEY (`kind`, `ck`, `id`))""")
+            self.db.execute("""
+            CREATE INDEX IF NOT EXISTS `history_height` ON `history` (`kind`, `ck`, `height`)""")
+            self.db.execute("""
+            CREATE TABLE IF NOT EXISTS `sync_state` (
+            `kind` TEXT NOT NULL, `ck` TEXT NOT NULL,
+            `newest` INTEGER, `oldest` INTEGER, `complete` INTEGER NOT NULL DEFAULT 0,
+            `gap_top` INTEGER, `gap_cursor` INTEGER,
+            `size` INTEGER NOT NULL DEFAULT 0, `last_access` REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (`kind`, `ck`))""")
+            self.db.commit()
+
+    def __repr__(self):
+        return "<HistoryStore {}>".format(self.path)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def state(self, kind, ck):
+        with self.lock:
+            f = self.db.execute("""
+            SELECT `newest`, `oldest`, `complete`, `gap_top`, `gap_cursor` FROM `sync_state`
+            WHERE `kind` = ? AND `ck` = ?""", (kind, ck))
+            row = f.fetchone()
+        if row is None:
+            return {'newest': None, 'oldest': None, 'complete': False, 'gap_top': None, 'gap_cursor': None}
+        return {'newest': row[0], 'oldest': row[1], 'complete': bool(row[2]),
+                'gap_top': row[3], 'gap_cursor': row[4]}
+
+    def _save(self, kind, ck, state, rows):
+        # 取得した1pageと範囲の更新は同じtransactionで書く
+        with self.lock:
+            with self.db as conn:
+                added = 0
+                for row in rows:
+                    f = conn.execute("""
+                    INSERT OR IGNORE INTO `history` VALUES (?, ?, ?, ?, ?, ?)""", (kind, ck) + row)
+                    if f.rowcount == 1:
+                        added += len(row[3])
+                conn.execute("""
+                INSERT OR IGNORE INTO `sync_state` (`kind`, `ck`) VALUES (?, ?)""", (kind, ck))
+                conn.execute("""
+                UPDATE `sync_state` SET `newest` = ?, `oldest` = ?, `complete` = ?,
+                `gap_top` = ?, `gap_cursor` = ?, `size` = `size` + ?, `last_access` = ?
+                WHERE `kind` = ? AND `ck` = ?""", (
+                    state['newest'], state['oldest'], int(state['complete']),
+                    state['gap_top'], state['gap_cursor'], added, time.time(), kind, ck))
+
+    def _flush(self, kind, ck, state, txs, key, height, txhash):
+        rows = [(key(e), height(e), txhash(e), json.dumps(e)) for e in txs]
+        self._save(kind, ck, state, rows)
+        del txs[:]
+
+    def sync(self, kind, ck, iterate, key, height, txhash=lambda e: None, limit=2500, batch=25):
+        """
+            iterate(since_id)はsince_idより古いTXを新しい順に返すgenerator(Noneなら最新から)
+            差分だけbatch件毎に保存する、最大limit件取得し全履歴が揃えばTrue
+        """
+        state = self.state(kind, ck)
+        txs = list()
+        count = 0
+        if state['newest'] is None:
+            # 初めてかTXがまだ無い、先頭から古い方へ
+            state.update(oldest=None, complete=False)
+        else:
+            # 新しい方、前回limitで止まっていればその続きから
+            top = state['gap_top']
+            for tx in iterate(state['gap_cursor']):
+                if key(tx) <= state['newest']:
+                    break  # 保存済みの範囲に届いた
+                top = key(tx) if top is None else top
+                txs.append(tx)
+                count += 1
+                if len(txs) >= batch or count >= limit:
+                    state.update(gap_top=top, gap_cursor=key(txs[-1]))
+                    self._flush(kind, ck, state, txs, key, height, txhash)
+                if count >= limit:
+                    return False
+            if top is not None:
+                state['newest'] = max(state['newest'], top)
+            state.update(gap_top=None, gap_cursor=None)
+            self._flush(kind, ck, state, txs, key, height, txhash)
+
+        # 古い方、最後まで取れば全て揃った
+        if not state['complete']:
+            for tx in iterate(state['oldest']):
+                if state['newest'] is None:
+                    state['newest'] = key(tx)
+                txs.append(tx)
+                count += 1
+                if len(txs) >= batch or count >= limit:
+                    state['oldest'] = key(txs[-1])
+                    self._flush(kind, ck, state, txs, key, height, txhash)
+                if count >= limit:
+                    return False
+            if len(txs) > 0:
+                state['oldest'] = key(txs[-1])
+            state['complete'] = True
+            self._flush(kind, ck, state, txs, key, height, txhash)
+        return True
+
+    def iter_read(self, kind, ck, oldest_first=False, batch=500):
+        """ batch件ずつDBから読む、新しい順(oldest_firstなら古い順) """
+        with self.lock:
+            self.db.execute("""
+            UPDATE `sync_state` SET `last_access` = ? WHERE `kind` = ? AND `ck` = ?""", (time.time(), kind, ck))
+            self.db.commit()
+        sql = """
+        SELECT `id`, `body` FROM `history` WHERE `kind` = ? AND `ck` = ? AND `id` {} ?
+        ORDER BY `id` {} LIMIT ?""".format(*(('>', 'ASC') if oldest_first else ('<', 'DESC')))
+        last = -1 if oldest_first else 2 ** 63 - 1
+        while True:
+            with self.lock:
+                rows = self.db.execute(sql, (kind, ck, last, batch)).fetchall()
+            if len(rows) == 0:
+                return
+            for tx_id, body in rows:
+                yield json.loads(body)
+            last = rows[-1][0]
+
+    def read(self, kind, ck):
+        """ 新しい順に全て """
+        return list(self.iter_read(kind, ck))
+
+    def total_size(self):
+        with self.lock:
+            f = self.db.execute("SELECT COALESCE(SUM(`size`), 0) FROM `sync_state`")
+            return f.fetchone()[0]
+
+    def evict(self, maxsize):
+        """ 合計maxsize bytesを超えたら最後に使われていない(kind, ck)から消す """
+        with self.lock:
+            f = self.db.execute("""
+            SELECT `kind`, `ck`, `size` FROM `sync_state` ORDER BY `last_access` ASC""")
+            states = f.fetchall()
+            all_size = sum(size for kind, ck, size in states)
+            if all_size <= maxsize:
+                return list()
+            removed = list()
+            with self.db as conn:
+                for kind, ck, size in states:
+                    if all_size <= maxsize:
+                        break
+                    conn.execute("DELETE FROM `history` WHERE `kind` = ? AND `ck` = ?", (kind, ck))
+                    conn.execute("DELETE FROM `sync_state` WHERE `kind` = ? AND `ck` = ?", (kind, ck))
+                    all_size -= size
+                    removed.append((kind, ck))
+            self.db.execute("PRAGMA incremental_vacuum")
+        logging.info("evict history %d accounts, %d bytes left" % (len(removed), all_size))
+        return removed
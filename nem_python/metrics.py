@@ -0,0 +1,131 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from threading import Lock
+from contextlib import contextmanager
+import sqlite3
+import time
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+
+
+class Metrics:
+    """
+        Counter・Gauge・Histogramの記録
+        snapshot()でdict、prometheus()でPrometheusのtext形式
+        labelはkeyword引数で、metric名毎に同じ組み合わせを使う
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = Lock()
+        self.counters = dict()  # (name, labels): value
+        self.gauges = dict()  # (name, labels): value
+        self.histograms = dict()  # (name, labels): [bucket毎の数, sum, count]
+
+    def __repr__(self):
+        return "<Metrics counters={} gauges={} histograms={}>".format(
+            len(self.counters), len(self.gauges), len(self.histograms))
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            h = self.histograms[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        begin = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - begin, **labels)
+
+    def snapshot(self):
+        """ {'counters': {name: [(labels, value), ..]}, 'gauges': .., 'histograms': {name: [(labels, {..}), ..]}} """
+        result = {'counters': dict(), 'gauges': dict(), 'histograms': dict()}
+        with self.lock:
+            for kind, items in (('counters', self.counters), ('gauges', self.gauges)):
+                for (name, labels), value in sorted(items.items()):
+                    result[kind].setdefault(name, list()).append((dict(labels), value))
+            for (name, labels), (counts, total, count) in sorted(self.histograms.items()):
+                result['histograms'].setdefault(name, list()).append((dict(labels), {
+                    'buckets': dict(zip(self.buckets, counts)), 'sum': total, 'count': count}))
+        return result
+
+    @staticmethod
+    def _labels(labels, extra=None):
+        items = list(labels) + ([extra] if extra else list())
+        if len(items) == 0:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in items) + '}'
+
+    def prometheus(self):
+        lines = list()
+        with self.lock:
+            for kind, items in (('counter', self.counters), ('gauge', self.gauges)):
+                prev = None
+                for (name, labels), value in sorted(items.items()):
+                    if name != prev:
+                        lines.append("# TYPE %s %s" % (name, kind))
+                        prev = name
+                    lines.append("%s%s %s" % (name, self._labels(labels), value))
+            prev = None
+            for (name, labels), (counts, total, count) in sorted(self.histograms.items()):
+                if name != prev:
+                    lines.append("# TYPE %s histogram" % name)
+                    prev = name
+                for bound, num in zip(self.buckets, counts):
+                    lines.append("%s_bucket%s %d" % (name, self._labels(labels, ('le', bound)), num))
+                lines.append("%s_bucket%s %d" % (name, self._labels(labels, ('le', '+Inf')), count))
+                lines.append("%s_sum%s %s" % (name, self._labels(labels), total))
+                lines.append("%s_count%s %d" % (name, self._labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+        sqlite3.connect(factory=TimedConnection)で使う
+        metricsを設定するとexecuteの時間をSQLの種類毎に記録する
+    """
+    metrics = None
+
+    @staticmethod
+    def _op(sql):
+        # 先頭の単語(SELECT, INSERT..)、空白だけのSQLもある
+        words = sql.split(None, 1)
+        return words[0].upper() if words else 'EMPTY'
+
+    def execute(self, sql, *args):
+        if self.metrics is None:
+            return super().execute(sql, *args)
+        with self.metrics.timer('account_sql_seconds', op=self._op(sql)):
+            return super().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        if self.metrics is None:
+            return super().executemany(sql, *args)
+        with self.metrics.timer('account_sql_seconds', op=self._op(sql)):
+            return super().executemany(sql, *args)
@@ -5,15 +5,23 @@ import logging
 import threading
 import random
 import time
-import requests
 import json
 import copy
+import collections
+import atexit
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 from tempfile import gettempdir
-from binascii import hexlify
+from binascii import hexlify, unhexlify
 from .dict_math import DictMath
 from .transaction_reform import TransactionReform
-from .utils import QueueSystem, PeerStorage
+from .history_store import HistoryStore
+from .transaction_builder import announce_hash
+from .metrics import Metrics
+from .utils import QueueSystem, PeerStorage, SessionPool, BlockNotifier, PollSchedule, \
+    NemResponse, ResponseStats, PeerLimiter, MosaicCache, SingleFlight, \
+    RateLimiter, HedgeDelay
+from .stomp_client import PushListener
 
 
 F_DEBUG = False
@@ -21,6 +29,23 @@ LOCAL_NIS_URL = ("http", "127.0.0.1", 7890)  # transaction_prepareでのみ使
 ALLOW_NIS_VER = ["0.6.93-BETA", "0.6.95-BETA", "0.6.96-BETA"]  # 使用するNISのVersion
 ALLOW_DIFF_HEIGHT = 2  # 許容するHeightのズレ
 ALLOW_MARGIN_EXP = 5  # NISの経験値？
+ANNOUNCE_EXISTS = ('NEUTRAL', 'FAILURE_HASH_EXISTS')  # 既に受け付けられているTX
+MAIN_NET_PEERS = {
+    ('http', '62.75.251.134', 7890),  # Hi, I am Alice2
+    ('http', '62.75.163.236', 7890),  # Hi, I am Alice3
+    ('http', '209.126.98.204', 7890),  # Hi, I am Alice4
+    ('http', '108.61.182.27', 7890),  # Hi, I am Alice5
+    ('http', '27.134.245.213', 7890),  # nem4ever
+    ('http', '104.168.152.37', 7890),  # Phatty
+}
+TEST_NET_PEERS = {
+    ('http', '150.95.145.157', 7890),  # nis-testnet.44uk.net
+    ('http', '104.128.226.60', 7890),  # Hi, I am BigAlice2
+    ('http', '80.93.182.146', 7890),  # hxr.team
+    ('http', '23.228.67.85', 7890),  # Hi, I am MedAlice2
+    ('http', '82.196.9.187', 7890),  # NEMventory
+    ('http', '188.166.14.34', 7890),  # testnet.hxr.team
+}
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
@@ -30,7 +55,6 @@ class NemConnect:
     TRANSFER_INCOMING = 'account/transfers/incoming'
     TRANSFER_OUTGOING = 'account/transfers/outgoing'
     TRANSFER_ALL = 'account/transfers/all'
-    ns2def_cashe = dict()
     nem_xem_define = {
         "creator": "111112222233333a62f894e591478caa23b06f90471e7976c30fb95efda4b312",
         "description": "XEM",
@@ -42,14 +66,42 @@ class NemConnect:
             {"name": "transferable", "value": "true"}],
         "levy": {}}
     timeout = 10
+    peer_ttl = 30  # Peerの生存確認を再利用する秒数
+    hedged = False  # Trueなら一部のGETで応答の遅いPeerを待たず別のPeerにも送る
+    hedge_delay = 1.0  # 応答時間の記録が無い時の待ち時間
+    hedge_min_delay = 0.2
+    hedge_max_ratio = 0.25  # 待ち時間の上限、timeoutに対する割合
+    single_flight_window = 0.5  # 同じGETの結果を使い回す秒数
+    peer_rate = 5  # 1つのPeerへ1秒に送る数(DDOS防止機構に掛からないように)
+    peer_burst = 10
+    global_rate = 50  # 全Peer合わせて1秒に送る数
+    global_burst = 100
+    announce_peers = 3  # 同時にannounceするPeer数
+    crawl_workers = 16  # Peer探索で同時に調べるPeer数
+    crawl_target = 50  # この数の良いPeerが集まれば探索を打ち切る
+    crawl_hops = 1  # 何hop先のPeerまで辿るか
+    crawl_report = None  # 直近の探索結果と所要時間
+    bulk_workers = 16  # sync_historiesで同時に取得するアカウント数
+    bulk_peer_limit = 2  # sync_historiesで1つのPeerへ同時に送る数
+    sync_report = None  # 直近のsync_historiesの結果
+    block_interval = 5  # Block高を確認する間隔
+    block_time = 60  # NEMのBlock間隔、承認済みTXの確認はこの時間内に終えたい
+    confirmed_max_interval = 120  # 新しいBlockが来なくても承認済みTXを確認する間隔
+    mempool_min_interval = 2  # 未承認TXを確認する間隔、動きが無ければmaxまで延ばす
+    mempool_max_interval = 30
+    confirmed_max_skip = 4  # 動きの無いアドレスは最大この数のBlock毎に確認
+    poll_workers = 8  # 監視アドレスを同時に確認する数
+    ws_port = 7778  # NISのWebsocket(STOMP)
     retention = 3600 * 2  # 2 hours
     f_peer_update = False
     height = 0  # 現在のBlock高
     finish = False
 
     def __init__(self, main_net=True):
-        self.multisig_que = QueueSystem()
-        self.received_que = QueueSystem()
+        # 通信・Queue・監視Loopの計測
+        self.metrics = Metrics()
+        self.multisig_que = QueueSystem(metrics=self.metrics, name='multisig')
+        self.received_que = QueueSystem(metrics=self.metrics, name='received')
         self.monitor_cks = list()  # 監視対象CompressedKey
         self.main_net = main_net
         # tmpファイルの存在を確認、作成
@@ -64,72 +116,83 @@ class NemConnect:
         self.lock = threading.Lock()
         # Peerを内部に保存
         self.peers = PeerStorage(path=self.PEER_FILE)
-        if main_net and len(self.peers) < 5:
-            self.peers.update({
-                ('http', '62.75.251.134', 7890),  # Hi, I am Alice2
-                ('http', '62.75.163.236', 7890),  # Hi, I am Alice3
-                ('http', '209.126.98.204', 7890),  # Hi, I am Alice4
-                ('http', '108.61.182.27', 7890),  # Hi, I am Alice5
-                ('http', '27.134.245.213', 7890),  # nem4ever
-                ('http', '104.168.152.37', 7890),  # Phatty
-            })
-        elif len(self.peers) < 5:
-            self.peers.update({
-                ('http', '150.95.145.157', 7890),  # nis-testnet.44uk.net
-                ('http', '104.128.226.60', 7890),  # Hi, I am BigAlice2
-                ('http', '80.93.182.146', 7890),  # hxr.team
-                ('http', '23.228.67.85', 7890),  # Hi, I am MedAlice2
-                ('http', '82.196.9.187', 7890),  # NEMventory
-                ('http', '188.166.14.34', 7890),  # testnet.hxr.team
-            })
+        # Peer毎と全体の送信数の制限
+        self.rate_limiter = RateLimiter(
+            peer_rate=self.peer_rate, peer_burst=self.peer_burst,
+            global_rate=self.global_rate, global_burst=self.global_burst)
+        # hedgeするまでの待ち時間
+        self.hedge = HedgeDelay(default=self.hedge_delay, floor=self.hedge_min_delay)
+        # 同じGETをまとめる
+        self.single_flight = SingleFlight(window=self.single_flight_window)
+        # Mosaic定義とsupplyのキャッシュ
+        self.mosaic_cache = MosaicCache(path=os.path.join(self.TMP_DIR, 'mosaic.json'))
+        atexit.register(self.mosaic_cache.save)
+        # 送受金・Harvest履歴のキャッシュ
+        self.history = HistoryStore(path=os.path.join(self.TMP_DIR, 'history.db'))
+        # Peer毎のKeep-alive接続
+        self.sessions = SessionPool()
+        # 短い通信を並列に行う
+        self.executor = ThreadPoolExecutor(max_workers=16)
+        # 直近のannounce結果(診断用)
+        self.announce_log = collections.deque(maxlen=100)
+        # 監視Loopの所要時間
+        self.poll_stats = dict()
+        # endpoint毎の応答bytesとparse時間
+        self.response_stats = ResponseStats()
+        # 通知済みの入金とマルチシグ
+        self.received_seen = collections.deque(maxlen=10000)
+        self.multisig_seen = collections.deque(maxlen=10000)
+        # Websocketで通知を受け取り中ならPollingを止める
+        self.push_active = threading.Event()
+        if len(self.peers) < 5:
+            self.peers.update(MAIN_NET_PEERS if main_net else TEST_NET_PEERS)
         self.peers.save()
+        # 各Loopの停止とBlock更新の通知
+        self.stop_event = threading.Event()
+        self.blocks = BlockNotifier()
         # 今の正確なHeightを挿入
         self.height = self.get_biggest_height()
+        self.blocks.publish(self.height)
 
     def stop(self):
-        while True:
-            time.sleep(5)
-            if not self.f_peer_update:
-                self.finish = True
-                break
-
-    def _tmp_read(self, path, pre=None):
-        with self.lock:
-            try:
-                with open(path, mode='r') as f:
-                    return json.load(f)
-            except FileNotFoundError:
-                with open(path, mode='w+') as f:
-                    json.dump(pre, f)
-                    return pre
-
-    def _tmp_write(self, path, data):
-        with self.lock:
-            with open(path, mode='w') as f:
-                if type(data) == set:
-                    json.dump(list(data), f)
-                else:
-                    json.dump(data, f)
+        # 待機中の各Loopをすぐに終了させる
+        self.finish = True
+        self.stop_event.set()
+        self.blocks.close()
 
     def _random_choice_url(self):
-        while len(self.peers) > 0:
-            url = None
+        # 1回の呼び出しで各Peerは1度だけ試す
+        tried = set()
+        while True:
+            try:
+                url = self.peers.random(exclude=tried)
+            except IndexError:
+                break
+            tried.add(url)
             try:
-                url = self.peers.random()
+                if self.peers.is_alive(url, ttl=self.peer_ttl, height=self.height - 1):
+                    return url  # 最近確認済み
                 d = self._get(call='chain/last-block', url=url)
                 height = d.json()['height']
                 if self.height - 1 < height:
+                    self.peers.caught_up(url)
                     return url
                 else:
-                    del self.peers[url]
+                    # 応答は正常なのでfailureではなく遅れとして数える
+                    self.peers.lagging(url)
+            except NemConnectError:
+                continue  # _getで記録済み
             except:
-                del self.peers[url]
+                self.peers.failure(url)
         raise NemConnectError("run out of API connection pool.")
 
-    def start(self):
+    def start(self, push=False):
+        # 監視アドレスを並列に確認する
+        self.poll_executor = ThreadPoolExecutor(max_workers=self.poll_workers)
+
         # Peerリスト自動更新
         def nem_peer_update():
-            while True:
+            while not self.stop_event.is_set():
                 self.f_peer_update = True
                 self.timeout = 3
                 if time.time() - os.stat(self.PEER_FILE).st_mtime > 3600 * 3:
@@ -141,112 +204,110 @@ class NemConnect:
                     self._update_peers()
                 self.f_peer_update = False
                 self.timeout = 10
-                time.sleep(3600 * random.random())
+                self.stop_event.wait(3600 * random.random())
 
         # マルチシグ署名依頼
         # multisig_que.get()で取得
+        def fetch_unconfirmed(ck):
+            un = self._get_auto(
+                call="account/unconfirmedTransactions",
+                data={'address': ck})
+            return un.json()['data']
+
         def unconfirmed_multisig_check():
-            find_tx_list = list()
+            # 新しいTXがあれば短く、無ければ徐々に長い間隔で確認する
+            schedule = PollSchedule(self.mempool_min_interval, self.mempool_max_interval, factor=1.5)
             monitor_cks = list()
-            while True:
-                time.sleep(5)
-                if self.monitor_cks != monitor_cks:
-                    monitor_cks = copy.copy(self.monitor_cks)
-
+            pushed = False
+            while not self.stop_event.wait(schedule.wait_time(monitor_cks, time.time())):
+                # Websocketで受信中は止める、繋がった直後の1回は取りこぼしの確認
+                if self.push_active.is_set() and pushed:
+                    continue
+                pushed = self.push_active.is_set()
                 try:
-                    for ck in monitor_cks:
-                        ck = self.byte2str(ck)
-                        un = self._get_auto(
-                            call="account/unconfirmedTransactions",
-                            data={'address': ck})
-                        for tx in un.json()['data'][::-1]:
-                            if 'otherTrans' not in tx['transaction']:
-                                continue  # not multisig
-                            elif tx['transaction']['otherTrans'] not in find_tx_list:
-                                # get new multisig transaction
-                                find_tx_list.append(tx['transaction']['otherTrans'])
-                                account_info = self.get_account_info(ck=ck)
-                                if 'cosignatoriesCount' not in account_info['account']['multisigInfo']:
-                                    # Not multisig account, may as cosigner
-                                    continue
-                                all_cosigner = [u['address'] for u in account_info['meta']['cosignatories']]
-                                self.multisig_que.broadcast({
-                                    "type": "new",
-                                    "txhash": tx['meta']['data'],
-                                    "account": ck,
-                                    "inner_tx": tx['transaction']['otherTrans'],
-                                    "all_cosigner": all_cosigner,
-                                    "need_cosigner": account_info['account']['multisigInfo']['minCosignatories'],
-                                })
-                                logging.info("new multisig %s %s" % (ck, tx['meta']['data']))
-
-                            else:
-                                for sign in tx['transaction']['signatures']:
-                                    if sign in find_tx_list:
-                                        continue
-                                    else:
-                                        # new cosigner transaction
-                                        find_tx_list.append(sign)
-                                        self.multisig_que.broadcast({
-                                            "type": "cosigner",
-                                            "txhash": tx['meta']['data'],
-                                            "account": ck,
-                                            "inner_tx": tx['transaction']['otherTrans'],
-                                            "cosigner": sign['otherAccount']})
-                                        logging.info("new cosigner %s %s" % (ck, sign['otherAccount']))
-                        else:
-                            if len(find_tx_list) > len(monitor_cks) * 50:
-                                # Remove old tx list
-                                find_tx_list = find_tx_list[10:]
+                    begin = time.time()
+                    monitor_cks = [self.byte2str(ck) for ck in copy.copy(self.monitor_cks)]
+                    cks = schedule.due(monitor_cks, begin)
+                    for ck in cks:
+                        schedule.done(ck, False, begin)
+                    for ck, unconfirmed in self._poll_many(fetch_unconfirmed, cks):
+                        busy = False
+                        for tx in unconfirmed[::-1]:
+                            busy |= self._check_multisig(ck, tx)
+                        if busy:
+                            schedule.done(ck, True, begin)
+                    schedule.retain(monitor_cks)
+                    self._record_sweep('multisig', time.time() - begin, len(cks), self.mempool_max_interval)
 
                 except Exception as e:
                     logging.debug(e)
 
         # 新着入金を取得
         # received_que.get()で取得
+        def fetch_incoming(ck):
+            new_income = self.get_account_transfer_newest(ck=ck, call_name=self.TRANSFER_INCOMING)
+            reform_obj = TransactionReform(main_net=self.main_net, your_ck=ck)
+            return reform_obj.reform_transactions(tx_list=new_income)[::-1]
+
         def new_received_check():
             find_tx_list = list()
             monitor_cks = list()
-            height = 0
-            while True:
-                time.sleep(5)
+            heights = dict()  # ck: 通知済みの最新height
+            # 動きの少ないアドレスは数Block毎に確認する
+            schedule = PollSchedule(1, self.confirmed_max_skip)
+            block_height = self.blocks.height
+            pushed = False
+            while not self.stop_event.is_set():
+                # 承認済みTXはBlockが進んだ時だけ確認する
+                new_block_height = self.blocks.wait(block_height, timeout=self.confirmed_max_interval)
+                if self.stop_event.is_set():
+                    break
+                block_height = new_block_height or block_height
+                # Websocketで受信中は止める、繋がった直後の1回は取りこぼしの確認
+                if self.push_active.is_set() and pushed:
+                    continue
+                pushed = self.push_active.is_set()
                 try:
+                    begin = time.time()
                     # 新規のアカウントのみ初期化(初期化)
-                    for ck in set(self.monitor_cks) - set(monitor_cks):
-                        ck = self.byte2str(ck)
-                        new_income = self.get_account_transfer_newest(ck=ck, call_name=self.TRANSFER_INCOMING)
-                        reform_obj = TransactionReform(main_net=self.main_net, your_ck=ck)
-                        tx_reformed = reform_obj.reform_transactions(tx_list=new_income)[::-1]
+                    new_cks = [self.byte2str(ck) for ck in set(self.monitor_cks) - set(monitor_cks)]
+                    for ck, tx_reformed in self._poll_many(fetch_incoming, new_cks):
                         for tx in tx_reformed:
                             if tx not in find_tx_list:
                                 find_tx_list.append(tx)
                         if len(tx_reformed) > 0:
-                            height = max(height, tx_reformed[-1]['height'])
-                    else:
-                        monitor_cks = copy.copy(self.monitor_cks)
-
-                    # モニタリング
-                    for ck in monitor_cks:
-                        ck = self.byte2str(ck)
-                        new_income = self.get_account_transfer_newest(ck=ck, call_name=self.TRANSFER_INCOMING)
-                        reform_obj = TransactionReform(main_net=self.main_net, your_ck=ck)
-                        tx_reformed = reform_obj.reform_transactions(tx_list=new_income)[::-1]
+                            heights[ck] = max(heights.get(ck, 0), tx_reformed[-1]['height'])
+                    for ck in new_cks:
+                        # 今取得したので次のBlockから確認する
+                        schedule.done(ck, False, block_height)
+                    monitor_cks = copy.copy(self.monitor_cks)
+
+                    # モニタリング、Blockが来ないままtimeoutした時は全て確認
+                    cks = [self.byte2str(ck) for ck in monitor_cks]
+                    if new_block_height is not None:
+                        cks = schedule.due(cks, block_height)
+                    for ck in cks:
+                        schedule.done(ck, False, block_height)
+                    for ck, tx_reformed in self._poll_many(fetch_incoming, cks):
+                        busy = False
                         for tx in tx_reformed:
                             if tx in find_tx_list:
                                 # 既に通知済み
                                 continue
-                            elif height > tx['height']:
+                            elif heights.get(ck, 0) > tx['height']:
                                 # 前記録時より古い
                                 continue
                             else:
-                                height = tx['height']
+                                heights[ck] = tx['height']
                                 find_tx_list.append(tx)
-                                logging.info("New income tx %s" % tx['txhash'])
-                                self.received_que.broadcast(tx)
+                                busy |= self._notify_received(tx)
+                        if busy:
+                            schedule.done(ck, True, block_height)
+                    schedule.retain([self.byte2str(ck) for ck in monitor_cks])
 
-                    else:
-                        if len(find_tx_list) > len(monitor_cks) * 50:
-                            find_tx_list = find_tx_list[10:]
+                    if len(find_tx_list) > len(monitor_cks) * 50:
+                        find_tx_list = find_tx_list[10:]
+                    self._record_sweep('received', time.time() - begin, len(cks), self.block_time)
 
                 except Exception as e:
                     import traceback
@@ -257,8 +318,9 @@ class NemConnect:
         def new_block_check():
             prev_hash = ""
             height = 0
-            while True:
-                time.sleep(5)
+            while not self.stop_event.wait(self.block_interval):
+                if self.push_active.is_set():
+                    continue  # Websocketで受け取り中
                 try:
                     block_data = self.get_last_chain()
                     new_prev_hash = block_data['prevBlockHash']['data']
@@ -270,6 +332,7 @@ class NemConnect:
                     else:
                         prev_hash, height = new_prev_hash, new_height
                         self.height = new_height
+                        self.blocks.publish(new_height)
                         if new_height % 20 == 0:
                             logging.debug("Now block %d" % new_height)
 
@@ -290,10 +353,92 @@ class NemConnect:
         threading.Thread(
             target=new_block_check, name="HeightCheck", daemon=True
         ).start()
+        if push:
+            # Websocketで受け取り、切れている間は上のPollingで補う
+            self.push_listener = PushListener(self)
+            self.push_listener.start()
         logging.info("start")
 
-    def _update_peers(self):
+    def _notify_received(self, tx):
+        # 新着入金をreceived_queへ、PollingとWebsocketで重複しないようにする
+        with self.lock:
+            if tx['txhash'] in self.received_seen:
+                return False
+            self.received_seen.append(tx['txhash'])
+        logging.info("New income tx %s" % tx['txhash'])
+        self.received_que.broadcast(tx)
+        return True
+
+    def _check_multisig(self, ck, tx):
+        # 未承認のマルチシグTXと連署をmultisig_queへ、新しい物があればTrue
+        if 'otherTrans' not in tx['transaction']:
+            return False  # not multisig
+        meta = tx['meta']
+        txhash = meta['data'] if 'data' in meta else meta['hash']['data']
+        with self.lock:
+            f_new = tx['transaction']['otherTrans'] not in self.multisig_seen
+            if f_new:
+                self.multisig_seen.append(tx['transaction']['otherTrans'])
+                new_signs = list()
+            else:
+                new_signs = [e for e in tx['transaction']['signatures'] if e not in self.multisig_seen]
+                self.multisig_seen.extend(new_signs)
+        if f_new:
+            # get new multisig transaction
+            account_info = self.get_account_info(ck=ck)
+            if 'cosignatoriesCount' not in account_info['account']['multisigInfo']:
+                # Not multisig account, may as cosigner
+                return True
+            all_cosigner = [u['address'] for u in account_info['meta']['cosignatories']]
+            self.multisig_que.broadcast({
+                "type": "new",
+                "txhash": txhash,
+                "account": ck,
+                "inner_tx": tx['transaction']['otherTrans'],
+                "all_cosigner": all_cosigner,
+                "need_cosigner": account_info['account']['multisigInfo']['minCosignatories'],
+            })
+            logging.info("new multisig %s %s" % (ck, txhash))
+            return True
+        for sign in new_signs:
+            # new cosigner transaction
+            self.multisig_que.broadcast({
+                "type": "cosigner",
+                "txhash": txhash,
+                "account": ck,
+                "inner_tx": tx['transaction']['otherTrans'],
+                "cosigner": sign['otherAccount']})
+            logging.info("new cosigner %s %s" % (ck, sign['otherAccount']))
+        return len(new_signs) > 0
+
+    def _poll_many(self, fn, cks):
+        # fn(ck)を並列に実行し、終わった順に(ck, 結果)を返す、失敗したアドレスは飛ばす
+        futures = {self.poll_executor.submit(fn, ck): ck for ck in cks}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                logging.debug("failed poll %s %s" % (futures[future], e))
+
+    def _record_sweep(self, name, elapsed, num, budget):
+        # 監視Loop1周の所要時間、budget秒を超えたら警告
+        stats = self.poll_stats.setdefault(name, {'sweeps': 0, 'last': 0.0, 'max': 0.0, 'total': 0.0, 'addresses': 0})
+        stats['sweeps'] += 1
+        stats['last'] = elapsed
+        stats['max'] = max(stats['max'], elapsed)
+        stats['total'] += elapsed
+        stats['addresses'] = num
+        self.metrics.observe('nem_poll_sweep_seconds', elapsed, loop=name)
+        self.metrics.set('nem_poll_addresses', num, loop=name)
+        if elapsed > budget:
+            logging.warning("slow %s sweep %.1fs > %.1fs for %d addresses" % (name, elapsed, budget, num))
+
+    def _update_peers(self, hops=None, target=None):
+        # Peerの探索、crawl_workers並列で調べtarget個集まれば打ち切る
+        hops = self.crawl_hops if hops is None else hops
+        target = self.crawl_target if target is None else target
         logging.info("update start")
+        begin = time.time()
         retry = 10
         while retry > 0:
             try:
@@ -315,96 +460,119 @@ class NemConnect:
                 logging.debug(e)
                 continue
             best_height = best_height.json()['height']
-            lock = threading.Lock()
             peers = raw_peers.json()['data']
             logging.info("get raw peer: %d" % len(peers))
-
-            # ノードリストの品質チェック
-            result = list()
-            thread_obj = list()
-            for dummy in range(50):
-                thread_obj.append(threading.Thread(
-                    target=self._check_peer, args=(peers, result, lock, best_height), daemon=True
-                ))
-            for t in thread_obj:
-                t.start()
-            for t in thread_obj:
-                t.join()
-            logging.info("finish peer list: %d" % len(result))
-
-            # ノードリストの更新
-            self.peers.update(result)
-            self.peers.save()
-            return
+            break
         else:
             raise NemConnectError("failed to update peers")
 
-    def _check_peer(self, peers, result, lock, best_height):
-        network_id = 104 if self.main_net else -104
-        while True:
-            with lock:
-                if len(peers) > 0:
-                    peer_data = peers.pop(0)
-                    check_url = (
-                        peer_data['endpoint']['protocol'],
-                        peer_data['endpoint']['host'],
-                        peer_data['endpoint']['port'])
-                else:
+        # ノードリストの品質チェック
+        result = list()
+        report = {'candidates': 0, 'probed': 0, 'good': 0, 'hops': 0, 'stopped_early': False}
+        seen = {check_url}
+        candidates = collections.deque()
+        self._add_candidates(peers, 1, seen, candidates)
+        pool = ThreadPoolExecutor(max_workers=self.crawl_workers)
+        probing = dict()  # check_url: (hop, [status, height, experiences])
+        listing = dict()  # peer-listのfuture: hop
+        try:
+            while len(candidates) > 0 or len(probing) > 0 or len(listing) > 0:
+                # 1つのPeerへの3つの確認は同時に送る
+                while len(candidates) > 0 and len(probing) < self.crawl_workers:
+                    hop, url = candidates.popleft()
+                    probing[url] = (hop, [pool.submit(self._get, call, url)
+                                          for call in ("status", "chain/height", "node/experiences")])
+                    report['probed'] += 1
+                futures = list(listing)
+                for hop, probes in probing.values():
+                    futures.extend(probes)
+                wait(futures, return_when=FIRST_COMPLETED)
+
+                for future in [f for f in listing if f.done()]:
+                    hop = listing.pop(future)
+                    try:
+                        r = future.result()
+                        if r.ok:
+                            self._add_candidates(r.json()['data'], hop, seen, candidates)
+                    except Exception as e:
+                        logging.debug(e)
+
+                for url in [u for u, (h, probes) in probing.items() if all(f.done() for f in probes)]:
+                    hop, probes = probing.pop(url)
+                    if not self._check_peer(probes, best_height):
+                        continue
+                    # insert good peer
+                    result.append(url)
+                    report['hops'] = max(report['hops'], hop)
+                    if hop < hops:
+                        listing[pool.submit(self._get, "node/peer-list/reachable", url)] = hop + 1
+
+                if len(result) >= target:
+                    report['stopped_early'] = len(candidates) > 0 or len(probing) > 0 or len(listing) > 0
                     break
+        finally:
+            for future in list(listing):
+                future.cancel()
+            for hop, probes in probing.values():
+                for future in probes:
+                    future.cancel()
+            pool.shutdown(wait=False)
+
+        report['candidates'] = len(seen) - 1
+        report['good'] = len(result)
+        report['elapsed'] = time.time() - begin
+        self.crawl_report = report
+        logging.info("finish peer list: %d (%s)" % (len(result), report))
+
+        # ノードリストの更新
+        self.peers.update(result)
+        self.peers.save()
 
+    def _add_candidates(self, peers, hop, seen, candidates):
+        network_id = 104 if self.main_net else -104
+        for peer_data in peers:
+            check_url = (
+                peer_data['endpoint']['protocol'],
+                peer_data['endpoint']['host'],
+                peer_data['endpoint']['port'])
+            if check_url in seen:
+                continue
+            seen.add(check_url)
             # meta data check
             if peer_data['metaData']['version'] not in ALLOW_NIS_VER:
                 continue
             if peer_data['metaData']['networkId'] != network_id:
                 continue
+            candidates.append((hop, check_url))
 
-            try:
-                # status check
-                status = self._get(call="status", url=check_url)
-                if not status.ok or status.json()['code'] != 6:
-                    continue
-
-                # block height check
-                height = self._get(call="chain/height", url=check_url)
-                if not height.ok or abs(height.json()['height'] - best_height) > ALLOW_DIFF_HEIGHT:
-                    continue
-
-                # The number of selected as partner
-                experiences = self._get(call="node/experiences", url=check_url)
-                if not experiences.ok or len(experiences.json()['data']) < ALLOW_MARGIN_EXP:
-                    continue
-
-                # insert good peer
-                with lock:
-                    result.append(check_url)
-            except Exception as e:
-                if F_DEBUG:
-                    logging.debug("%s, %s" % (check_url[1], e))
-        return
+    @staticmethod
+    def _check_peer(probes, best_height):
+        try:
+            status, height, experiences = [f.result() for f in probes]
+            # status check
+            if not status.ok or status.json()['code'] != 6:
+                return False
+            # block height check
+            if not height.ok or abs(height.json()['height'] - best_height) > ALLOW_DIFF_HEIGHT:
+                return False
+            # The number of selected as partner
+            if not experiences.ok or len(experiences.json()['data']) < ALLOW_MARGIN_EXP:
+                return False
+            return True
+        except Exception as e:
+            if F_DEBUG:
+                logging.debug(e)
+            return False
 
     def clean_tmp_folder(self, maxsize=20):
-        # maxsize Kbyte までTmpファイルが膨れるのを許容する
-        path_size_time = list()
-        all_size = 0
+        # 履歴キャッシュがmaxsize Mbyteを超えたら古い物から消す
+        removed = False
         for p in os.listdir(self.TMP_DIR):
-            if 'peer.json' in p:
-                continue
-            path = os.path.join(self.TMP_DIR, p)
-            size = os.path.getsize(path)
-            time_ = int(os.stat(path).st_mtime)
-            path_size_time.append((path, size, time_))
-            all_size += size
-        if all_size < maxsize * 1000000:
-            return False
-        if len(path_size_time) < 3:
-            return False
-        for p, s, t in sorted(path_size_time, key=lambda x: x[2]):
-            os.remove(p)
-            all_size -= s
-            if all_size <= maxsize * 1000000:
-                return True
-        else:
-            return False
+            # 以前のJsonキャッシュはもう使わない
+            if p.startswith('account.') and p.endswith('.json'):
+                os.remove(os.path.join(self.TMP_DIR, p))
+                removed = True
+        return len(self.history.evict(maxsize * 1000000)) > 0 or removed
 
     """ rest api methods """
     def get_peers(self):
@@ -431,7 +599,8 @@ class NemConnect:
         """
         data = self._get_auto(
             call="account/get",
-            data={"address": ck})
+            data={"address": ck},
+            hedge=True)
         if not data.ok:
             raise NemConnectError("failed 'account/get' %s" % ck)
         return data.json()
@@ -455,9 +624,14 @@ class NemConnect:
     def get_namespace2definition(self, namespace, cashe=True):
         if namespace == 'nem':
             return {'nem:xem': self.nem_xem_define}
-        if namespace in self.ns2def_cashe and cashe:
-            return self.ns2def_cashe[namespace]
+        if cashe:
+            result = self.mosaic_cache.get_definition(namespace)
+            if result is not None:
+                return result
+        return self.single_flight.do(
+            ('namespace2definition', namespace), lambda: self._fetch_namespace2definition(namespace))
 
+    def _fetch_namespace2definition(self, namespace):
         index_id = None
         url = self._random_choice_url()
         result = dict()
@@ -472,13 +646,14 @@ class NemConnect:
                 url = self._random_choice_url()
                 logging.error("failed get mosaic def, retry")
                 continue
-            elif len(data.json()['data']) == 0:
-                self.ns2def_cashe[namespace] = result
+            j = data.json()['data']
+            if len(j) == 0:
+                self.mosaic_cache.put_definition(namespace, result)
                 return result
             else:
                 tmp = {"{}:{}".format(e['mosaic']['id']['namespaceId'], e['mosaic']['id']['name'])
-                       : e['mosaic'] for e in data.json()['data']}
-                index_id = data.json()['data'][-1]['meta']['id']
+                       : e['mosaic'] for e in j}
+                index_id = j[-1]['meta']['id']
                 result.update(tmp)
                 continue
 
@@ -492,13 +667,32 @@ class NemConnect:
                 raise NemConnectError('Not found namespace.')
             return d.json()['height']
 
-    def get_mosaic_supply(self, namespace_name):
+    def get_mosaic_supply(self, namespace_name, cashe=True):
+        if cashe:
+            supply = self.mosaic_cache.get_supply(namespace_name, self.height)
+            if supply is not None:
+                return supply
         data = self._get_auto(
             call='mosaic/supply',
             data={'mosaicId': namespace_name})
+        j = data.json()
         if not data.ok:
-            raise NemConnectError("failed 'mosaic/supply' %s" % data.json()['message'])
-        return data.json()['supply']
+            raise NemConnectError("failed 'mosaic/supply' %s" % j['message'])
+        # supplyMutable=falseなら二度と変わらない
+        definition = self.get_namespace2definition(namespace_name.split(':')[0]).get(namespace_name)
+        mutable = definition is None or any(
+            p['name'] == 'supplyMutable' and p['value'] != 'false' for p in definition['properties'])
+        self.mosaic_cache.put_supply(namespace_name, j['supply'], self.height, mutable)
+        return j['supply']
+
+    def prefetch_mosaics(self, mosaics):
+        """ 定義とsupplyをまとめて並列に取得しキャッシュ、保存する """
+        namespaces = {namespace_name.split(':')[0] for namespace_name in mosaics}
+        for future in [self.executor.submit(self.get_namespace2definition, namespace) for namespace in namespaces]:
+            future.result()
+        for future in [self.executor.submit(self.get_mosaic_supply, namespace_name) for namespace_name in mosaics]:
+            future.result()
+        self.mosaic_cache.save()
 
     def get_account_transfer_newest(self, ck, call_name=TRANSFER_INCOMING):
         """
@@ -543,7 +737,8 @@ class NemConnect:
         """
         data = self._get_auto(
             call=call_name,
-            data={'address': ck})
+            data={'address': ck},
+            hedge=True)
         if not data.ok:
             raise NemConnectError("failed '%s' %s" % (call_name, data.json()['message']))
         return data.json()['data']
@@ -553,68 +748,128 @@ class NemConnect:
         # account/transfers/incoming
         # account/transfers/outgoing
         # account/transfers/all
+        差分だけ取得しHistoryStoreに保存、新しい順に全て返す
         """
-        # tmpファイルの存在確認
-        path = os.path.join(self.TMP_DIR, call_name.replace('/', '.') + '.' + ck + '.json')
-        cashe = self._tmp_read(path=path, pre=list())
-        # 履歴を取得
-        while True:
+        self.sync_history(ck=ck, call_name=call_name, c=c)
+        return self.history.read(kind=call_name, ck=ck)
+
+    def iter_account_transfers(self, ck, call_name=TRANSFER_INCOMING, since_id=None):
+        """
+        新しい順に1pageずつ取得してTXを返すgenerator
+        since_idを渡すとそれより古いTXから、途中で止めた時は最後のmeta.idで再開できる
+        """
+        return self._iter_history(call_name, ck, since_id)
+
+    def iter_account_harvests(self, ck, since_id=None):
+        return self._iter_history("account/harvests", ck, since_id)
+
+    def _choice_free_url(self, limiter=None):
+        # 空きとtokenのあるPeerを選ぶ、見つからなければ送る時に待つ
+        for dummy in range(3):
             url = self._random_choice_url()
-            data = self._get(
-                call=call_name,
-                url=url,
-                data={'address': ck})
-            if not data.ok:
-                raise NemConnectError("failed '%s' %s" % (call_name, data.json()['message']))
-            j = data.json()['data']
+            if (limiter is None or limiter.free(url)) and self.rate_limiter.has_tokens(url):
+                break
+        return url
 
-            # TXがまだ存在しない場合
-            if len(j) == 0:
-                return list()
-            # Casheを使用する場合
-            if len(cashe) > 0:
-                oldest_tx = j[-1]['transaction']
-                newest_tx = j[0]['transaction']
-                if newest_tx == cashe[0]['transaction']:
-                    return cashe
+    def _iter_history(self, call, ck, since_id, limiter=None):
+        key = self._history_key(call)
+        url = self._choice_free_url(limiter)
+        page_index = since_id
+        retry = 3
+        while True:
+            try:
+                params = {'address': ck} if page_index is None else {'address': ck, 'id': page_index}
+                if limiter is None:
+                    data = self._get(call=call, url=url, data=params)
                 else:
-                    for i in range(min(25, len(cashe))):
-                        if oldest_tx == cashe[i]['transaction']:
-                            result = j + cashe[i + 1:]
-                            self._tmp_write(path=path, data=result)
-                            return result
-
-            # 同一の物がない場合
-            result = j
-            page_index = j[-1]['meta']['id']
-            while c > 0:
-                c -= 1
-                data = self._get(
-                    call=call_name,
-                    url=url,
-                    data={'address': ck, 'id': page_index})
+                    with limiter.slot(url):
+                        data = self._get(call=call, url=url, data=params)
                 if not data.ok:
                     # ここはDDOS防止機構とどう付き合うか考えもの
-                    raise NemConnectError("failed '%s' %s" % (call_name, data.json()['message']))
-                j = data.json()['data']
+                    raise NemConnectError("failed '%s' %s" % (call, data.json()['message']))
+                page = data.json()['data']
+            except NemConnectError as e:
+                # 同じ位置から別のPeerで続ける
+                retry -= 1
+                if retry <= 0:
+                    raise e
+                url = self._choice_free_url(limiter)
+                continue
+            if len(page) == 0:
+                return
+            retry = 3
+            for tx in page:
+                yield tx
+            page_index = key(page[-1])
 
-                if len(j) == 0:
-                    self._tmp_write(path=path, data=result)
-                    return result
-                else:
-                    # Casheをチェック
-                    oldest_tx = j[-1]['transaction']
-                    for i in range(min(25, len(cashe))):
-                        if oldest_tx == cashe[i]['transaction']:
-                            result += j + cashe[i + 1:]
-                            self._tmp_write(path=path, data=result)
-                            return result
-
-                result.extend(j)
-                page_index = j[-1]['meta']['id']
-            else:
-                logging.error("not completed! %s" % ck)
-                return result
+    @staticmethod
+    def _history_key(call):
+        # pageの位置を示すid
+        if call == "account/harvests":
+            return lambda e: e['id']
+        return lambda e: e['meta']['id']
+
+    def sync_history(self, ck, call_name=TRANSFER_INCOMING, c=100):
+        """ c pageまで差分を取得しHistoryStoreに保存、全て揃えばTrue """
+        return self._sync_history(ck, call_name, c)[0]
+
+    def _sync_history(self, ck, call_name, c, limiter=None):
+        # (全て揃ったか, 取得したTX数)
+        count = [0]
+
+        def iterate(since_id):
+            for tx in self._iter_history(call_name, ck, since_id, limiter):
+                count[0] += 1
+                yield tx
+
+        if call_name == "account/harvests":
+            height, txhash = lambda e: e['height'], lambda e: None
+        else:
+            height, txhash = lambda e: e['meta']['height'], lambda e: e['meta']['hash']['data']
+        done = self.history.sync(
+            kind=call_name, ck=ck, iterate=iterate, key=self._history_key(call_name),
+            height=height, txhash=txhash, limit=c * 25)
+        if not done:
+            logging.error("not completed! %s" % ck)
+        return done, count[0]
+
+    def sync_histories(self, cks, call_names=(TRANSFER_INCOMING,), c=100, progress=None):
+        """
+        複数アカウントの履歴をまとめてHistoryStoreに取得する
+        アカウント毎のpageは順に、別のアカウントは並列にPeerへ振り分ける
+        1つのPeerへは同時にbulk_peer_limitまで、progress(report)は1件終わる毎に呼ぶ
+        {(ck, call_name): True(全て揃った) / False(c pageで止めた) / None(失敗)}を返す
+        """
+        limiter = PeerLimiter(self.bulk_peer_limit)
+        jobs = [(self.byte2str(ck), call_name) for ck in cks for call_name in call_names]
+        report = {'jobs': len(jobs), 'done': 0, 'complete': 0, 'failed': 0, 'txs': 0,
+                  'requests': 0, 'elapsed': 0.0, 'tx_per_sec': 0.0}
+        result = dict()
+        begin = time.time()
+        with ThreadPoolExecutor(max_workers=self.bulk_workers) as pool:
+            futures = {pool.submit(self._sync_history, ck, call_name, c, limiter): (ck, call_name)
+                       for ck, call_name in jobs}
+            for future in as_completed(futures):
+                try:
+                    done, count = future.result()
+                    result[futures[future]] = done
+                    report['complete'] += int(done)
+                    report['txs'] += count
+                except Exception as e:
+                    logging.error("failed sync %s %s" % (futures[future], e))
+                    result[futures[future]] = None
+                    report['failed'] += 1
+                report['done'] += 1
+                report['requests'] = sum(limiter.requests.values())
+                report['elapsed'] = time.time() - begin
+                report['tx_per_sec'] = report['txs'] / max(report['elapsed'], 1e-6)
+                if progress is not None:
+                    progress(dict(report))
+        report['peers'] = dict(limiter.requests)
+        self.sync_report = report
+        logging.info("synced %d/%d accounts, %d txs in %.1fs" % (
+            report['complete'], report['jobs'], report['txs'], report['elapsed']))
+        return result
 
     def get_account_harvests_newest(self, ck):
         data = self._get_auto(
@@ -625,77 +880,18 @@ class NemConnect:
         return data.json()['data']
 
     def get_account_harvests_all(self, ck, c=100):
-        # tmpファイルの存在確認
-        path = os.path.join(self.TMP_DIR, 'account.harvests.' + ck + '.json')
-        cashe = self._tmp_read(path=path, pre=list())
-        # 履歴を取得
-        while True:
-            url = self._random_choice_url()
-            data = self._get(
-                call="account/harvests",
-                url=url,
-                data={'address': ck})
-            if not data.ok:
-                raise NemConnectError("failed 'account/harvests' %s" % data.json()['message'])
-            j = data.json()['data']
-
-            # TXがまだ存在しない場合
-            if len(j) == 0:
-                return list()
-            # Casheを使用する場合
-            if len(cashe) > 0:
-                oldest_tx = j[-1]['height']
-                newest_tx = j[0]['height']
-                if newest_tx == cashe[0]['height']:
-                    return cashe
-                else:
-                    for i in range(min(25, len(cashe))):
-                        if oldest_tx == cashe[i]['height']:
-                            result = j + cashe[i + 1:]
-                            self._tmp_write(path=path, data=result)
-                            return result
-
-            # 同一の物がない場合
-            result = j
-            page_index = j[-1]['id']
-            while c > 0:
-                c -= 1
-                data = self._get(
-                    call="account/harvests",
-                    url=url,
-                    data={'address': ck, 'id': page_index})
-                if not data.ok:
-                    # ここはDDOS防止機構とどう付き合うか考えもの
-                    raise NemConnectError("failed 'account/harvests' %s" % data.json()['message'])
-                j = data.json()['data']
-
-                if len(j) == 0:
-                    self._tmp_write(path=path, data=result)
-                    return result
-                else:
-                    # Casheをチェック
-                    oldest_tx = j[-1]['height']
-                    for i in range(min(25, len(cashe))):
-                        if oldest_tx == cashe[i]['height']:
-                            result += j + cashe[i + 1:]
-                            self._tmp_write(path=path, data=result)
-                            return result
-
-                result.extend(j)
-                page_index = j[-1]['id']
-            else:
-                logging.error("not completed! %s" % ck)
-                return result
+        self.sync_history(ck=ck, call_name="account/harvests", c=c)
+        return self.history.read(kind="account/harvests", ck=ck)
 
     def get_last_chain(self):
-        data = self._get_auto(call='chain/last-block')
+        data = self._get_auto(call='chain/last-block', hedge=True)
         return data.json()
 
     def get_biggest_height(self):
         while True:
-            data = self._get_auto(call='node/active-peers/max-chain-height')
-            if 'height' in data.json():
-                return data.json()['height']
+            data = self._get_auto(call='node/active-peers/max-chain-height').json()
+            if 'height' in data:
+                return data['height']
 
     """ sending functions """
 
@@ -904,90 +1100,197 @@ class NemConnect:
             data={'data': self.byte2str(tx_hex),
                   'signature': self.byte2str(tx_sign)}
         )
-        if not data.ok or data.json()['message'] != 'SUCCESS':
-            raise NemConnectError("failed 'transaction/announce' %s" % data.json()['message'])
+        j = data.json()
+        if not data.ok or j['message'] != 'SUCCESS':
+            raise NemConnectError("failed 'transaction/announce' %s" % j['message'])
         try:
-            txhash = data.json()['innerTransactionHash']['data']  # multi sig
+            txhash = j['innerTransactionHash']['data']  # multi sig
         except KeyError:
-            txhash = data.json()['transactionHash']['data']  # single sig
+            txhash = j['transactionHash']['data']  # single sig
         return txhash
 
     def transaction_announce(self, tx_hex, tx_sign):
-        # 送金先を３つランダムで選ぶ
+        # 送金先をランダムで選ぶ
         url_set = set()
-        count = 10
+        count = self.announce_peers * 3
         while count > 0:
             count -= 1
             url_set.add(self._random_choice_url())
-            if len(url_set) >= 3:
+            if len(url_set) >= self.announce_peers:
                 break
 
-        # 送金実行(3回)
-        result_message = list()
-        result_txhash = list()
-        for url in url_set:
-            data = self._post(
-                call="transaction/announce",
-                url=url,
-                data={'data': self.byte2str(tx_hex),
-                      'signature': self.byte2str(tx_sign)}
-            )
-            message = data.json()['message']
-            result_message.append(message)
-            if not data.ok or message != 'SUCCESS':
-                continue
-            try:
-                tx_hash = data.json()['innerTransactionHash']['data']  # multi sig
-                result_txhash.append(tx_hash)
-            except KeyError:
-                tx_hash = data.json()['transactionHash']['data']  # single sig
-                result_txhash.append(tx_hash)
-
-        # 送金結果
-        if 'SUCCESS' in result_message and len(result_txhash) > 0:
-            return result_txhash[0]
+        # hashは手元で決まる、既に受け付けられたTXの再announceも成功とする
+        local_hash = announce_hash(unhexlify(self.byte2str(tx_hex).encode()))
+        # 並列に送金実行、最初のSUCCESSで返す(残りは裏で完了させ記録する)
+        data = {'data': self.byte2str(tx_hex), 'signature': self.byte2str(tx_sign)}
+        record = {'time': time.time(), 'txhash': local_hash, 'results': list()}
+        self.announce_log.append(record)
+        futures = [self.executor.submit(self._announce, url, data, record) for url in url_set]
+        for future in as_completed(futures):
+            message, tx_hash = future.result()
+            if message == 'SUCCESS' and tx_hash is not None:
+                if tx_hash != local_hash:
+                    logging.warning("txhash differ, local=%s peer=%s" % (local_hash, tx_hash))
+                return tx_hash
+            elif message in ANNOUNCE_EXISTS:
+                return local_hash
         else:
-            raise NemConnectError("failed 'transaction/announce' %s" % result_message)
+            messages = [r['message'] for r in record['results']]
+            if all(r['rejected'] for r in record['results']):
+                # 全てのPeerが内容を見て断った、受け付けられたPeerは無い
+                raise AnnounceRejectedError("rejected 'transaction/announce' %s" % messages)
+            raise NemConnectError("failed 'transaction/announce' %s" % messages)
+
+    def _announce(self, url, data, record):
+        begin = time.time()
+        tx_hash = None
+        rejected = False
+        try:
+            r = self._post(call="transaction/announce", url=url, data=data)
+            j = r.json()
+            if r.ok or j.get('message') in ANNOUNCE_EXISTS:
+                message = j['message']
+            else:
+                message = "%d %s" % (r.status_code, j.get('message'))
+            if message == 'SUCCESS':
+                try:
+                    tx_hash = j['innerTransactionHash']['data']  # multi sig
+                except KeyError:
+                    tx_hash = j['transactionHash']['data']  # single sig
+            else:
+                rejected = self._is_rejected(r, j)
+        except (NemConnectError, ValueError, KeyError) as e:
+            # 通信エラーは受け付けられたか分からない
+            message = str(e)
+        record['results'].append({
+            'url': url, 'message': message, 'txhash': tx_hash, 'rejected': rejected,
+            'elapsed': time.time() - begin})
+        return message, tx_hash
+
+    @staticmethod
+    def _is_rejected(r, j):
+        # NISが内容を見て断った応答、5xxと429は受け付けられたか分からない
+        return r.status_code < 500 and r.status_code != 429 and \
+            isinstance(j, dict) and j.get('message') not in (None, 'SUCCESS') + ANNOUNCE_EXISTS
 
     def _get(self, call, url, data=None):
+        begin = time.time()
         try:
-            headers = {'Content-type': 'application/json'}
             uri = "%s://%s:%d/%s" % (url[0], url[1], url[2], call)
             if not self.f_peer_update and call != 'chain/last-block':
                 logging.debug("Access GET %s (%s)" % (uri, data))
-            return requests.get(uri, params=data, headers=headers, timeout=self.timeout)
+            self.rate_limiter.acquire(url)
+            begin = time.time()
+            with self.sessions.session(url) as s:
+                r = s.get(uri, params=data, timeout=self.timeout)
+                r = NemResponse(call, r.status_code, r.content, self.response_stats)
         except Exception as e:
-            del self.peers[url]
-            self.peers.save()
+            self.peers.failure(url)
+            self.sessions.discard(url)
+            self._record_request('GET', call, url, begin, None)
             raise NemConnectError(e)
-
-    def _get_auto(self, call, data=None):
+        self._record_request('GET', call, url, begin, r)
+        self._check_limited(url, r)
+        self.peers.report_response(url=url, call=call, response=r, latency=time.time() - begin)
+        return r
+
+    def _get_auto(self, call, data=None, hedge=False):
+        # 同時に来た同じGETは1回だけ送り結果を共有する
+        key = (call, tuple(sorted((data or dict()).items())))
+        return self.single_flight.do(key, lambda: self._get_any(call=call, data=data, hedge=hedge))
+
+    def _get_any(self, call, data=None, hedge=False):
+        if hedge and self.hedged:
+            return self._get_hedged(call=call, data=data)
         retry = 10
         while retry > 0:
             retry -= 1
-            url = self._random_choice_url()
+            url = self._choice_free_url()
+            begin = time.time()
             try:
-                headers = {'Content-type': 'application/json'}
                 uri = "%s://%s:%d/%s" % (url[0], url[1], url[2], call)
-                return requests.get(uri, params=data, headers=headers, timeout=self.timeout)
+                self.rate_limiter.acquire(url)
+                begin = time.time()
+                with self.sessions.session(url) as s:
+                    r = s.get(uri, params=data, timeout=self.timeout)
+                    r = NemResponse(call, r.status_code, r.content, self.response_stats)
             except Exception as e:
-                del self.peers[url]
-                self.peers.save()
+                self.peers.failure(url)
+                self.sessions.discard(url)
+                self._record_request('GET', call, url, begin, None)
                 logging.error(e)
                 continue
+            self._record_request('GET', call, url, begin, r)
+            if self._check_limited(url, r):
+                continue  # 別のPeerで
+            self.peers.report_response(url=url, call=call, response=r, latency=time.time() - begin)
+            return r
         else:
             raise NemConnectError("many retry error '%s', %s" % (call, data))
 
+    def _get_hedged(self, call, data=None):
+        # このcallのp95の時間内に応答が無ければ別のPeerにも送り、先に返った方を使う
+        delay = self.hedge.delay(call, cap=self.timeout * self.hedge_max_ratio)
+        first_url = self._random_choice_url()
+        futures = {self.executor.submit(self._get, call, first_url, data): time.time()}
+        done, not_done = wait(futures, timeout=delay)
+        if len(not_done) > 0:
+            for dummy in range(3):
+                second_url = self._random_choice_url()
+                if second_url != first_url:
+                    logging.debug("hedged GET %s after %.2fs" % (call, delay))
+                    futures[self.executor.submit(self._get, call, second_url, data)] = time.time()
+                    break
+        for future in as_completed(futures):
+            try:
+                r = future.result()
+            except NemConnectError as e:
+                logging.debug(e)
+                continue
+            # 先に返った応答の時間だけ記録、遅い方の結果は捨てる(まだ始まっていなければ取り消す)
+            self.hedge.record(call, time.time() - futures[future])
+            for other in futures:
+                other.cancel()
+            return r
+        return self._get_any(call=call, data=data)
+
     def _post(self, call, url, data=None):
+        begin = time.time()
         try:
-            headers = {'Content-type': 'application/json'}
             uri = "%s://%s:%d/%s" % (url[0], url[1], url[2], call)
             logging.debug("Access POST %s(%s)" % (uri, data))
-            return requests.post(uri, data=json.dumps(data), headers=headers, timeout=self.timeout)
+            self.rate_limiter.acquire(url)
+            begin = time.time()
+            with self.sessions.session(url) as s:
+                r = s.post(uri, data=json.dumps(data), timeout=self.timeout)
+                r = NemResponse(call, r.status_code, r.content, self.response_stats)
         except Exception as e:
-            del self.peers[url]
-            self.peers.save()
+            self.peers.failure(url)
+            self.sessions.discard(url)
+            self._record_request('POST', call, url, begin, None)
             raise NemConnectError(e)
+        self._record_request('POST', call, url, begin, r)
+        self._check_limited(url, r)
+        # announceの拒否(4xx)はTXの問題なのでPeerの失敗に数えない
+        self.peers.report(url, ok=r.status_code < 500, latency=time.time() - begin)
+        return r
+
+    def _record_request(self, method, call, url, begin, r):
+        # 応答時間はcall名毎、接続失敗と4xx/5xxはerrorとして数える
+        # 探索したPeerは増え続けるのでlabelにしない(Peer毎の値はPeerStatus)
+        self.metrics.observe('nem_request_seconds', time.time() - begin, method=method, call=call)
+        if r is None:
+            self.metrics.inc('nem_request_errors_total', method=method, call=call, reason='connection')
+        elif not r.ok:
+            self.metrics.inc('nem_request_errors_total', method=method, call=call, reason=str(r.status_code))
+
+    def _check_limited(self, url, r):
+        # DDOS防止機構に掛かったPeerはtokenが溜まるまで使わない
+        if r.status_code not in (429, 503):
+            return False
+        logging.debug("rate limited by %s:%d" % (url[1], url[2]))
+        self.rate_limiter.penalize(url)
+        return True
 
     @staticmethod
     def byte2str(b):
@@ -999,3 +1302,6 @@ class NemConnect:
 
 
 class NemConnectError(Exception): pass
+
+
+class AnnounceRejectedError(NemConnectError): pass
@@ -0,0 +1,138 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+"""
+秘密鍵の展開(scalarとprefix)を1回だけ行い、署名・暗号化で使い回す
+結果は nem_ed25519 の sign/encrypt/decrypt と同じ
+
+    signer = Signer(sk, pk)
+    sign_raw = signer.sign(tx_raw)
+    signs = signer.sign_many([tx_raw, ..])
+"""
+
+from binascii import unhexlify
+from os import urandom
+import threading
+from Cryptodome.Cipher import AES
+from nem_ed25519.key import public_key
+from nem_ed25519.utils import B, L, PRIME, IDENT, Bpow, to_hash, to_hash_sha3_256, Hint_hash, edwards_add, \
+    edwards_double, scalarmult, encodepoint, decodepoint, encodeint, inverse, pad, unpad
+
+WINDOW = 4  # 固定基点の表、4bit毎に1回の加算
+_table = list()
+_table_lock = threading.Lock()
+
+
+def _base_table():
+    """ table[i][d] = d * 16**i * B、最初の1回だけ作る(約1000点) """
+    if len(_table) == 0:
+        with _table_lock:
+            if len(_table) == 0:
+                table = list()
+                P = Bpow[0]
+                for i in range(-(-253 // WINDOW)):
+                    row = [None, P]
+                    for d in range(2, 2 ** WINDOW):
+                        row.append(edwards_add(row[-1], P))
+                    table.append(row)
+                    P = edwards_double(row[2 ** (WINDOW - 1)])
+                _table.extend(table)
+    return _table
+
+
+def scalarmult_base(e):
+    """ nem_ed25519.utils.scalarmult_B と同じ点、加算は最大64回 """
+    e %= L
+    mask = 2 ** WINDOW - 1
+    P = None
+    for row in _base_table():
+        d = e & mask
+        if d:
+            P = row[d] if P is None else edwards_add(P, row[d])
+        e >>= WINDOW
+    return IDENT if P is None else P
+
+
+def _encode_many(points):
+    """ encodepointをまとめて、逆元は全体で1回だけ計算する """
+    prods = list()
+    acc = 1
+    for x, y, z, t in points:
+        acc = acc * z % PRIME
+        prods.append(acc)
+    inv = inverse(acc)
+    encoded = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        x, y, z, t = points[i]
+        zi = inv * prods[i - 1] % PRIME if i > 0 else inv
+        inv = inv * z % PRIME
+        x = x * zi % PRIME
+        y = y * zi % PRIME
+        if x & 1 == 1:
+            y += 2 ** 255
+        encoded[i] = int(y).to_bytes(B // 8, 'little')
+    return encoded
+
+
+class Signer:
+    shared_max = 1000  # 暗号化の共有鍵を保持する相手の数
+
+    def __init__(self, sk, pk=None):
+        assert isinstance(sk, str), 'SK is hex str'
+        assert len(sk) == 64, 'SK is 32bytes'
+        h = to_hash(unhexlify(sk.encode())[::-1])
+        # 署名と暗号化で共通のscalar、bit 0,1,2,255を落とし254を立てる
+        a = int.from_bytes(h[:B // 8], 'little')
+        a &= (1 << (B - 2)) - 8
+        self.a = a | (1 << (B - 2))
+        self.prefix = h[B // 8:B // 4]
+        self.pk = public_key(sk) if pk is None else pk
+        self.pk_raw = unhexlify(self.pk.encode())
+        assert len(self.pk_raw) == 32, 'PK is 32bytes'
+        self.shared = dict()  # 相手のpk: 共有点
+
+    def sign(self, msg):
+        assert isinstance(msg, bytes), 'Msg is bytes'
+        r = Hint_hash(self.prefix + msg)
+        R = _encode_many([scalarmult_base(r)])[0]
+        S = (r + Hint_hash(R + self.pk_raw + msg) * self.a) % L
+        return R + encodeint(S)
+
+    def sign_many(self, msgs):
+        """ 複数のmsgを署名、結果は順番通り """
+        rs = list()
+        for msg in msgs:
+            assert isinstance(msg, bytes), 'Msg is bytes'
+            rs.append(Hint_hash(self.prefix + msg))
+        if len(rs) == 0:
+            return list()
+        Rs = _encode_many([scalarmult_base(r) for r in rs])
+        return [R + encodeint((r + Hint_hash(R + self.pk_raw + msg) * self.a) % L)
+                for msg, r, R in zip(msgs, rs, Rs)]
+
+    def encrypt(self, pk, msg):
+        assert isinstance(msg, bytes), 'Msg is bytes'
+        salt = urandom(32)
+        iv = urandom(16)
+        cipher = AES.new(self._shared_key(pk, salt), AES.MODE_CBC, iv)
+        return salt + iv + cipher.encrypt(pad(msg))
+
+    def decrypt(self, pk, enc):
+        assert isinstance(enc, bytes), 'Enc is bytes'
+        salt, iv, encrypted_msg = enc[:32], enc[32:32 + 16], enc[32 + 16:]
+        cipher = AES.new(self._shared_key(pk, salt), AES.MODE_CBC, iv)
+        return unpad(cipher.decrypt(encrypted_msg))
+
+    def _shared_key(self, pk, salt):
+        g = self.shared.get(pk)
+        if g is None:
+            assert isinstance(pk, str) and len(pk) == 64, 'PK is 32bytes hex str'
+            g = encodepoint(scalarmult(decodepoint(unhexlify(pk.encode())), self.a))
+            if len(self.shared) >= self.shared_max:
+                self.shared.clear()
+            self.shared[pk] = g
+        key_int = int.from_bytes(g, 'big') ^ int.from_bytes(salt, 'big')
+        return to_hash_sha3_256(key_int.to_bytes(32, 'big'))
+
+    def __repr__(self):
+        return "<Signer %s>" % self.pk
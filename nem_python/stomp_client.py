@@ -0,0 +1,254 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import hashlib
+import base64
+import socket
+import struct
+import random
+import copy
+import json
+import time
+import os
+from .transaction_reform import TransactionReform
+
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class WebSocket:
+    """ Websocketの最小実装(Client側, 拡張無し) """
+
+    def __init__(self, host, port, path, timeout=10.0):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = b''
+        self.fragments = list()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        key = base64.b64encode(os.urandom(16))
+        self.sock.sendall((
+            "GET {} HTTP/1.1\r\n"
+            "Host: {}:{}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Key: {}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n"
+        ).format(self.path, self.host, self.port, key.decode()).encode())
+        while b'\r\n\r\n' not in self.buffer:
+            self._fill()
+        header, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        lines = header.decode('latin-1').split('\r\n')
+        if lines[0].split(' ')[1] != '101':
+            raise ConnectionError("websocket handshake failed %s" % lines[0])
+        accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest()).decode()
+        headers = dict(line.split(': ', 1) for line in lines[1:] if ': ' in line)
+        if {k.lower(): v for k, v in headers.items()}.get('sec-websocket-accept') != accept:
+            raise ConnectionError("wrong Sec-WebSocket-Accept")
+
+    def _fill(self):
+        # socket.timeoutはそのまま上へ、途中まで読んだframeはbufferに残る
+        data = self.sock.recv(65536)
+        if len(data) == 0:
+            raise ConnectionError("websocket closed by peer")
+        self.buffer += data
+
+    def send(self, data, opcode=0x1):
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        length = len(data)
+        if length < 126:
+            header = struct.pack('>BB', 0x80 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('>BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 0x80 | 127, length)
+        # Clientから送るframeは必ずmaskする
+        mask = os.urandom(4)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+        self.sock.sendall(header + mask + masked)
+
+    def _parse(self):
+        # bufferから1frame取り出す、足りなければNone
+        if len(self.buffer) < 2:
+            return None
+        b0, b1 = self.buffer[0], self.buffer[1]
+        length, pos = b1 & 0x7f, 2
+        if length == 126:
+            if len(self.buffer) < 4:
+                return None
+            length, pos = struct.unpack('>H', self.buffer[2:4])[0], 4
+        elif length == 127:
+            if len(self.buffer) < 10:
+                return None
+            length, pos = struct.unpack('>Q', self.buffer[2:10])[0], 10
+        mask = None
+        if b1 & 0x80:
+            mask, pos = self.buffer[pos:pos + 4], pos + 4
+        if len(self.buffer) < pos + length:
+            return None
+        payload = self.buffer[pos:pos + length]
+        self.buffer = self.buffer[pos + length:]
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return b0 & 0x80, b0 & 0x0f, payload
+
+    def recv(self):
+        """ 1message受け取る、Ping/Pongは内部で処理 """
+        while True:
+            frame = self._parse()
+            if frame is None:
+                self._fill()
+                continue
+            fin, opcode, payload = frame
+            if opcode == 0x9:
+                self.send(payload, opcode=0xa)
+            elif opcode == 0xa:
+                continue
+            elif opcode == 0x8:
+                raise ConnectionError("websocket closed by peer")
+            else:
+                self.fragments.append(payload)
+                if fin:
+                    message, self.fragments = b''.join(self.fragments), list()
+                    return message
+
+    def close(self):
+        if self.sock is None:
+            return
+        try:
+            self.send(b'', opcode=0x8)
+        except Exception:
+            pass
+        self.sock.close()
+        self.sock = None
+
+
+class StompClient:
+    """ Websocket上のSTOMP 1.1 """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.buffer = b''
+        self.sub_id = 0
+
+    def _send_frame(self, command, headers, body=''):
+        lines = [command] + ["%s:%s" % (k, v) for k, v in headers.items()]
+        self.ws.send('\n'.join(lines) + '\n\n' + body + '\x00')
+
+    def connect(self, host):
+        self._send_frame('CONNECT', {'accept-version': '1.1,1.0', 'host': host, 'heart-beat': '0,0'})
+        command, headers, body = self.recv_frame()
+        if command != 'CONNECTED':
+            raise ConnectionError("STOMP connect failed %s %s" % (command, body))
+
+    def subscribe(self, destination):
+        self.sub_id += 1
+        self._send_frame('SUBSCRIBE', {'id': 'sub-%d' % self.sub_id, 'destination': destination})
+
+    def send(self, destination, body):
+        self._send_frame('SEND', {'destination': destination, 'content-type': 'application/json'}, body)
+
+    def recv_frame(self):
+        """ (command, headers, body)を返す """
+        while b'\x00' not in self.buffer:
+            self.buffer += self.ws.recv()
+        raw, self.buffer = self.buffer.split(b'\x00', 1)
+        # 先頭の改行はHeart-beat
+        head, body = raw.decode('utf8').lstrip('\r\n').split('\n\n', 1)
+        lines = head.split('\n')
+        headers = dict(line.split(':', 1) for line in lines[1:] if ':' in line)
+        return lines[0].strip(), headers, body
+
+
+class PushListener(threading.Thread):
+    """
+        NISのWebsocket(STOMP)で新Block・入金・未承認TXを受け取る
+        接続中はnem.push_activeを立て、切れたらPollingに戻す
+    """
+    ws_path = '/w/messages/websocket'
+    recv_timeout = 1.0  # 監視アドレスの追加を確認する間隔
+    push_stale = 180  # この秒数何も届かなければ繋ぎ直す
+    backoff = 5.0
+    max_backoff = 300.0
+
+    def __init__(self, nem):
+        super().__init__(name="PushListener", daemon=True)
+        self.nem = nem
+        self.connects = 0
+        self.messages = 0
+
+    def run(self):
+        backoff = self.backoff
+        while not self.nem.stop_event.is_set():
+            url = None
+            try:
+                url = self.nem.peers.random()
+                self._listen(url[1])
+            except Exception as e:
+                logging.debug("push disconnected %s %s" % (url, e))
+            finally:
+                self.nem.push_active.clear()
+            if self.messages > 0:
+                backoff = self.backoff
+            self.messages = 0
+            self.nem.stop_event.wait(backoff * (0.5 + random.random()))
+            backoff = min(self.max_backoff, backoff * 2)
+
+    def _listen(self, host):
+        ws = WebSocket(host, self.nem.ws_port, self.ws_path, timeout=self.nem.timeout)
+        try:
+            ws.connect()
+            ws.sock.settimeout(self.recv_timeout)
+            stomp = StompClient(ws)
+            stomp.connect(host)
+            stomp.subscribe('/blocks/new')
+            subscribed = set()
+            self.connects += 1
+            last = time.time()
+            logging.info("push connected %s" % host)
+            while not self.nem.stop_event.is_set():
+                for ck in copy.copy(self.nem.monitor_cks):
+                    ck = self.nem.byte2str(ck)
+                    if ck not in subscribed:
+                        stomp.subscribe('/transactions/' + ck)
+                        stomp.subscribe('/unconfirmed/' + ck)
+                        subscribed.add(ck)
+                # 購読を出してから受信中とする
+                self.nem.push_active.set()
+                try:
+                    command, headers, body = stomp.recv_frame()
+                except socket.timeout:
+                    if time.time() - last > self.push_stale:
+                        raise ConnectionError("no message in %ds" % self.push_stale)
+                    continue
+                last = time.time()
+                if command == 'ERROR':
+                    raise ConnectionError("STOMP error %s" % body)
+                elif command == 'MESSAGE':
+                    self.messages += 1
+                    self._dispatch(headers.get('destination', ''), json.loads(body))
+        finally:
+            ws.close()
+
+    def _dispatch(self, destination, data):
+        if destination == '/blocks/new':
+            height = data['height']
+            if height > self.nem.height:
+                self.nem.height = height
+                self.nem.blocks.publish(height)
+        elif destination.startswith('/transactions/'):
+            ck = destination[len('/transactions/'):]
+            reform_obj = TransactionReform(main_net=self.nem.main_net, your_ck=ck)
+            for tx in reform_obj.reform_transactions(tx_list=[data]):
+                if tx['recipient'] == ck:
+                    self.nem._notify_received(tx)
+        elif destination.startswith('/unconfirmed/'):
+            ck = destination[len('/unconfirmed/'):]
+            self.nem._check_multisig(ck, data)
@@ -2,133 +2,344 @@
 # -*- coding: utf-8 -*-
 
 from binascii import hexlify, unhexlify
+from struct import Struct, error as StructError
+from Cryptodome.Hash import keccak
 from nem_ed25519.key import get_address
 
 
+# type, version, timeStamp, 32, signer, fee, deadline
+HEADER = Struct('<IiII32sQI')
+UINT32 = Struct('<I')
+INT32 = Struct('<i')
+UINT64 = Struct('<Q')
+# 40, recipient, amount
+TRANSFER = Struct('<I40sQ')
+# msg body length, msg type, msg length
+MESSAGE = Struct('<III')
+# 40, modification type, 32, cosigner pubkey
+MODIFICATION = Struct('<III32s')
+# 36, 32, other hash, 40, other account
+COSIGN = Struct('<II32sI40s')
+# mosaic structure length, mosaic id structure length, namespace length
+MOSAIC_HEAD = Struct('<III')
+MOSAICS = dict()  # (namespace長, name長): Struct
+
+
+def mosaic_struct(namespace_len, name_len):
+    # mosaic structure length, mosaic id structure length, namespace, name, quantity
+    try:
+        return MOSAICS[(namespace_len, name_len)]
+    except KeyError:
+        s = MOSAICS[(namespace_len, name_len)] = Struct('<III%dsI%dsQ' % (namespace_len, name_len))
+        return s
+
+
+def _key(hex_str, name):
+    # 32bytesの公開鍵・hash、structは長さが違っても黙って詰めるので先に確かめる
+    raw = unhexlify(hex_str.encode('utf8'))
+    if len(raw) != 32:
+        raise TransactionBuilderError('wrong %s length %d' % (name, len(raw)))
+    return raw
+
+
+def _address(address, name):
+    # 40文字のアドレス
+    raw = address.encode('utf8')
+    if len(raw) != 40:
+        raise TransactionBuilderError('wrong %s length %d' % (name, len(raw)))
+    return raw
+
+
+def tx_hash(raw):
+    """ TXのhash、署名を除いたbinaryのSHA3-256(NEMのSHA3はKeccak) """
+    return keccak.new(digest_bits=256, data=raw).hexdigest()
+
+
+def announce_hash(raw):
+    """ announceが返すhash、マルチシグはinner transactionのhash """
+    view = memoryview(raw)
+    if UINT32.unpack_from(view, 0)[0] == 0x1004:
+        inner_len, = UINT32.unpack_from(view, HEADER.size)
+        return tx_hash(view[HEADER.size + UINT32.size:HEADER.size + UINT32.size + inner_len])
+    return tx_hash(view)
+
+
 class TransactionBuilder:
-    binary = b''
-    const4bytes_blank = int(0).to_bytes(4, "little")
-    const4bytes_signer = int(32).to_bytes(4, "little")
-    const4bytes_address = int(40).to_bytes(4, "little")
+    """
+        TXをbinaryにする、先に全体の長さを計算し1つのbytearrayへstructで書き込む
+        encode()はhex文字列、encode_raw()はbytesを返す(署名にはそのまま使える)
+        encodeするとtxhash(マルチシグはinner_txhashも)が決まる
+    """
+
+    def __init__(self):
+        self.binary = b''  # 最後にencodeした結果
+        self.txhash = None
+        self.inner_txhash = None
 
     def encode(self, tx_dict):
-        if tx_dict['type'] == 0x0101:
+        return hexlify(self.encode_raw(tx_dict)).decode()
+
+    def encode_raw(self, tx_dict):
+        size, layout = self._layout(tx_dict)
+        buffer = bytearray(size)
+        end = self._write(tx_dict, layout, buffer, 0)
+        assert end == size, 'wrong size calculation %d != %d' % (end, size)
+        self.binary = bytes(buffer)
+        self.txhash = tx_hash(self.binary)
+        self.inner_txhash = announce_hash(self.binary) if tx_dict['type'] == 0x1004 else None
+        return self.binary
+
+    def size(self, tx_dict):
+        """ encodeした時のbytes数 """
+        return self._layout(tx_dict)[0]
+
+    def _layout(self, tx_dict):
+        # (bytes数, 書き込みで使う変換済みの値)、並べ替えやbytesへの変換は1回だけ
+        tx_type = tx_dict['type']
+        if tx_type == 0x0101:
+            message = tx_dict['message']
+            payload = None
+            size = HEADER.size + TRANSFER.size + UINT32.size
+            if 'payload' in message and len(message['payload']) > 0:
+                payload = unhexlify(message['payload'].encode('utf8'))
+                size = HEADER.size + TRANSFER.size + MESSAGE.size + len(payload)
+            mosaics = None
             if 'mosaics' in tx_dict:
-                self.tx_ver2(tx_dict)
-            else:
-                self.tx_ver1(tx_dict)
-        elif tx_dict['type'] == 0x1001:
+                mosaics = self._sorted_mosaics(tx_dict['mosaics'])
+                size += UINT32.size + sum(e[0].size for e in mosaics)
+            return size, (payload, mosaics)
+        elif tx_type == 0x1001:
+            modifications = self._sorted_modifications(tx_dict)
+            size = HEADER.size + UINT32.size + MODIFICATION.size * len(modifications)
+            if tx_dict['minCosignatories']['relativeChange'] != 0:
+                size += 8
+            return size, modifications
+        elif tx_type == 0x1004:
+            inner_size, inner_layout = self._layout(tx_dict['otherTrans'])
+            return HEADER.size + UINT32.size + inner_size, inner_layout
+        elif tx_type == 0x1002:
+            return HEADER.size + COSIGN.size, None
+        else:
+            # none transfer tx
+            raise Exception("not found transaction version")
+
+    @staticmethod
+    def _sorted_mosaics(mosaics):
+        # NIS bug, need mosaic order
+        mosaic_dict = {e['mosaicId']['namespaceId'] + e['mosaicId']['name']: e for e in mosaics}
+        mosaics = list()
+        for key in sorted(mosaic_dict):
+            namespace_id = mosaic_dict[key]['mosaicId']['namespaceId'].encode('utf8')
+            name = mosaic_dict[key]['mosaicId']['name'].encode('utf8')
+            mosaics.append((mosaic_struct(len(namespace_id), len(name)), namespace_id, name,
+                            mosaic_dict[key]['quantity']))
+        return mosaics
+
+    @staticmethod
+    def _sorted_modifications(tx_dict):
+        is_mainnet = tx_dict['version'] == 1744830464
+        cosigners = {
+            get_address(_key(e['cosignatoryAccount'], 'cosignatory'), main_net=is_mainnet):
+                (e['modificationType'], e['cosignatoryAccount'])
+            for e in tx_dict['modifications']}
+        return [cosigners[account] for account in sorted(cosigners)]
+
+    def _write(self, tx_dict, layout, buffer, offset):
+        # bufferのoffsetから書き込み、書き終わった位置を返す
+        tx_type = tx_dict['type']
+        if tx_type == 0x0101:
+            # mosaicsがあればver2
+            return self._transfer(tx_dict, layout, buffer, offset)
+        elif tx_type == 0x1001:
             # multisig creation
-            self.modify_multisig(tx_dict)
-        elif tx_dict['type'] == 0x1004:
+            return self._modify_multisig(tx_dict, layout, buffer, offset)
+        elif tx_type == 0x1004:
             # multisig transaction
-            self.with_inner_tx(tx_dict)
-        elif tx_dict['type'] == 0x1002:
+            return self._with_inner_tx(tx_dict, layout, buffer, offset)
+        elif tx_type == 0x1002:
             # sign multisig tx as cosigner
-            self.sign_multisig_tx(tx_dict)
+            return self._sign_multisig_tx(tx_dict, buffer, offset)
         else:
             # none transfer tx
             raise Exception("not found transaction version")
-        return hexlify(self.binary).decode()
-
-    def _common_header(self, tx_dict):
-        self.binary += tx_dict['type'].to_bytes(4, "little")  # tx type 0x0101
-        self.binary += tx_dict['version'].to_bytes(4, "little", signed=True)  # version 0x01000098
-        self.binary += tx_dict['timeStamp'].to_bytes(4, "little")  # timestamp 0xccaa7704
-        self.binary += self.const4bytes_signer  # const 0x20000000
-        self.binary += unhexlify(tx_dict['signer'].encode('utf8'))  # signer 32 bytes
-        self.binary += tx_dict['fee'].to_bytes(8, "little")  # fee 0xa086010000000000
-        self.binary += tx_dict['deadline'].to_bytes(4, "little")  # deadline 0xdcb87704
-        return
-
-    def tx_ver1(self, tx_dict):
-        self._common_header(tx_dict)
-        self.binary += self.const4bytes_address            # const 28000000
-        self.binary += tx_dict['recipient'].encode('utf8')  # signer 40 bytes
-        self.binary += tx_dict['amount'].to_bytes(8, "little")  # amount 0x40420f0000000000
-
-        if 'payload' in tx_dict['message'] and len(tx_dict['message']['payload']) > 0:
-            msg_length = len(tx_dict['message']['payload']) // 2
-
-            self.binary += int(msg_length + 8).to_bytes(4, "little")  # msg body 0x23000000
-            self.binary += tx_dict['message']['type'].to_bytes(4, "little")  # msg type 0x01000000
-            self.binary += msg_length.to_bytes(4, "little")  # msg length 0x1b000000
-            self.binary += unhexlify(tx_dict['message']['payload'].encode('utf8'))  # msg payload 27
 
+    @staticmethod
+    def _common_header(tx_dict, buffer, offset):
+        HEADER.pack_into(
+            buffer, offset, tx_dict['type'], tx_dict['version'], tx_dict['timeStamp'], 32,
+            _key(tx_dict['signer'], 'signer'), tx_dict['fee'], tx_dict['deadline'])
+        return offset + HEADER.size
+
+    def _transfer(self, tx_dict, layout, buffer, offset):
+        payload, mosaics = layout
+        offset = self._common_header(tx_dict, buffer, offset)
+        TRANSFER.pack_into(buffer, offset, 40, _address(tx_dict['recipient'], 'recipient'), tx_dict['amount'])
+        offset += TRANSFER.size
+
+        if payload is not None:
+            MESSAGE.pack_into(buffer, offset, len(payload) + 8, tx_dict['message']['type'], len(payload))
+            offset += MESSAGE.size
+            buffer[offset:offset + len(payload)] = payload
+            offset += len(payload)
         else:
             # no message
             # Note: if the length is 0 then the following 2 fields (msg length, msg payload) do not apply.
-            self.binary += self.const4bytes_blank
-        return
+            UINT32.pack_into(buffer, offset, 0)
+            offset += UINT32.size
 
-    def tx_ver2(self, tx_dict):
-        # first section same with ver1
-        self.tx_ver1(tx_dict)
+        if mosaics is None:
+            return offset
+        """ add mosaic section (ver2) """
+        UINT32.pack_into(buffer, offset, len(mosaics))  # Number of mosaics
+        offset += UINT32.size
+        for mosaic, namespace_id, name, quantity in mosaics:
+            mosaic.pack_into(buffer, offset, mosaic.size - 4, mosaic.size - 16,
+                             len(namespace_id), namespace_id, len(name), name, quantity)
+            offset += mosaic.size
+        return offset
 
-        """ add mosaic section """
-        self.binary += len(tx_dict['mosaics']).to_bytes(4, "little")  # Number of mosaics 0x01000000
+    def _modify_multisig(self, tx_dict, modifications, buffer, offset):
+        offset = self._common_header(tx_dict, buffer, offset)
+        UINT32.pack_into(buffer, offset, len(modifications))  # cosign num
+        offset += UINT32.size
+        for co_type, pubkey in modifications:
+            MODIFICATION.pack_into(buffer, offset, 40, co_type, 32, _key(pubkey, 'cosignatory'))
+            offset += MODIFICATION.size
 
-        # The following part is repeated for every mosaic in the attachment.
-        # NIS bug, need mosaic order
-        mosaic_dict = {e['mosaicId']['namespaceId']+e['mosaicId']['name']: e for e in tx_dict['mosaics']}
-        for name in sorted(mosaic_dict.keys()):
-            mosaic = mosaic_dict[name]
-            namespace_id = mosaic['mosaicId']['namespaceId'].encode('utf8')
-            namespace_id_len = len(namespace_id).to_bytes(4, "little")
+        relative_change = tx_dict['minCosignatories']['relativeChange']
+        if relative_change != 0:
+            UINT32.pack_into(buffer, offset, 4)
+            (INT32 if relative_change < 0 else UINT32).pack_into(buffer, offset + 4, relative_change)
+            offset += 8
+        return offset
 
-            name = mosaic['mosaicId']['name'].encode('utf8')
-            name_len = len(name).to_bytes(4, "little")
+    def _with_inner_tx(self, tx_dict, inner_layout, buffer, offset):
+        offset = self._common_header(tx_dict, buffer, offset)
+        # inner transactionは同じbufferへ直接書き、長さは後から埋める
+        end = self._write(tx_dict['otherTrans'], inner_layout, buffer, offset + UINT32.size)
+        UINT32.pack_into(buffer, offset, end - offset - UINT32.size)  # inner transaction length
+        return end
 
-            mosaic_id_structure = namespace_id_len + namespace_id + name_len + name
-            mosaic_id_structure_len = len(mosaic_id_structure).to_bytes(4, "little")
+    @staticmethod
+    def _sign_multisig_tx(tx_dict, buffer, offset):
+        offset = TransactionBuilder._common_header(tx_dict, buffer, offset)
+        # 36 = hash objectの長さ、multisig accountはアドレス文字列(40bytes)
+        COSIGN.pack_into(
+            buffer, offset, 36, 32, _key(tx_dict['otherHash']['data'], 'otherHash'),
+            40, _address(tx_dict['otherAccount'], 'otherAccount'))
+        return offset + COSIGN.size
 
-            value = mosaic['quantity'].to_bytes(8, "little")
+    """ decode """
 
-            mosaic_structure = mosaic_id_structure_len + mosaic_id_structure + value
-            mosaic_structure_len = len(mosaic_structure).to_bytes(4, "little")
+    def decode(self, raw):
+        """
+            encodeの逆、bytes・bytearray・memoryview(hex文字列も可)からtx_dictに戻す
+            memoryviewのまま読むのでcopyしない、署名は含まれない
+        """
+        if isinstance(raw, str):
+            raw = unhexlify(raw.encode('utf8'))
+        view = raw if isinstance(raw, memoryview) else memoryview(raw)
+        try:
+            tx_dict, offset = self._read(view, 0, len(view))
+        except (StructError, UnicodeDecodeError, IndexError) as e:
+            raise TransactionBuilderError('broken transaction binary, %s' % e)
+        return tx_dict
 
-            self.binary += mosaic_structure_len + mosaic_structure
-        return
+    def _read(self, view, offset, end):
+        # view[offset:end]の1TXを読み、(tx_dict, 読み終わった位置)を返す
+        tx_type, version, time_stamp, signer_len, signer, fee, deadline = HEADER.unpack_from(view, offset)
+        if signer_len != 32:
+            raise TransactionBuilderError('wrong signer length %d' % signer_len)
+        tx_dict = {
+            'type': tx_type, 'version': version, 'signer': signer.hex(),
+            'timeStamp': time_stamp, 'deadline': deadline, 'fee': fee}
+        offset += HEADER.size
+        if tx_type == 0x0101:
+            offset = self._read_transfer(tx_dict, view, offset, end)
+        elif tx_type == 0x1001:
+            offset = self._read_modify_multisig(tx_dict, view, offset, end)
+        elif tx_type == 0x1004:
+            inner_len, = UINT32.unpack_from(view, offset)
+            offset += UINT32.size
+            tx_dict['otherTrans'], offset = self._read(view, offset, offset + inner_len)
+        elif tx_type == 0x1002:
+            hash_len, data_len, other_hash, address_len, other_account = COSIGN.unpack_from(view, offset)
+            if (hash_len, data_len, address_len) != (36, 32, 40):
+                raise TransactionBuilderError('wrong cosign structure')
+            tx_dict['otherHash'] = {'data': other_hash.hex()}
+            tx_dict['otherAccount'] = other_account.decode('utf8')
+            offset += COSIGN.size
+        else:
+            raise TransactionBuilderError('not found transaction version %d' % tx_type)
+        if offset != end:
+            raise TransactionBuilderError('transaction length mismatch %d != %d' % (offset, end))
+        return tx_dict, offset
 
-    def modify_multisig(self, tx_dict):
-        self._common_header(tx_dict)
-        self.binary += len(tx_dict['modifications']).to_bytes(4, "little")  # cosign num
+    @staticmethod
+    def _read_transfer(tx_dict, view, offset, end):
+        address_len, recipient, amount = TRANSFER.unpack_from(view, offset)
+        if address_len != 40:
+            raise TransactionBuilderError('wrong recipient length %d' % address_len)
+        tx_dict['recipient'] = recipient.decode('utf8')
+        tx_dict['amount'] = amount
+        offset += TRANSFER.size
+
+        body_len, = UINT32.unpack_from(view, offset)
+        if body_len == 0:
+            # no message
+            tx_dict['message'] = {}
+            offset += UINT32.size
+        else:
+            body_len, msg_type, msg_len = MESSAGE.unpack_from(view, offset)
+            offset += MESSAGE.size
+            if body_len != msg_len + 8 or offset + msg_len > end:
+                raise TransactionBuilderError('wrong message length')
+            tx_dict['message'] = {'type': msg_type, 'payload': view[offset:offset + msg_len].hex()}
+            offset += msg_len
+
+        if offset == end:
+            return offset  # ver1
+        """ mosaic section (ver2) """
+        count, = UINT32.unpack_from(view, offset)
+        offset += UINT32.size
+        mosaics = list()
+        for dummy in range(count):
+            structure_len, id_len, namespace_len = MOSAIC_HEAD.unpack_from(view, offset)
+            offset += MOSAIC_HEAD.size
+            namespace_id = str(view[offset:offset + namespace_len], 'utf8')
+            offset += namespace_len
+            name_len, = UINT32.unpack_from(view, offset)
+            offset += UINT32.size
+            name = str(view[offset:offset + name_len], 'utf8')
+            offset += name_len
+            quantity, = UINT64.unpack_from(view, offset)
+            offset += UINT64.size
+            if id_len != 8 + namespace_len + name_len or structure_len != id_len + 12:
+                raise TransactionBuilderError('wrong mosaic structure')
+            mosaics.append({'mosaicId': {'namespaceId': namespace_id, 'name': name}, 'quantity': quantity})
+        tx_dict['mosaics'] = mosaics
+        return offset
+
+    @staticmethod
+    def _read_modify_multisig(tx_dict, view, offset, end):
+        count, = UINT32.unpack_from(view, offset)
+        offset += UINT32.size
+        modifications = list()
+        for dummy in range(count):
+            address_len, co_type, key_len, pubkey = MODIFICATION.unpack_from(view, offset)
+            if (address_len, key_len) != (40, 32):
+                raise TransactionBuilderError('wrong modification structure')
+            modifications.append({'modificationType': co_type, 'cosignatoryAccount': pubkey.hex()})
+            offset += MODIFICATION.size
+        tx_dict['modifications'] = modifications
+        relative_change = 0
+        if offset < end:
+            change_len, relative_change = UINT32.unpack_from(view, offset)[0], INT32.unpack_from(view, offset + 4)[0]
+            if change_len != 4:
+                raise TransactionBuilderError('wrong min cosignatories length %d' % change_len)
+            offset += 8
+        tx_dict['minCosignatories'] = {'relativeChange': relative_change}
+        return offset
 
-        is_mainnet = tx_dict['version'] == 1744830464
-        cosigners = {
-            get_address(e['cosignatoryAccount'], main_net=is_mainnet):
-                (e['modificationType'], e['cosignatoryAccount'])
-            for e in tx_dict['modifications']}
 
-        for account in sorted(cosigners, reverse=False):
-            co_type = cosigners[account][0]
-            pubkey = cosigners[account][1]
-            self.binary += self.const4bytes_address  # const 0x28000000
-            self.binary += co_type.to_bytes(4, "little")  # cosig type
-            self.binary += self.const4bytes_signer  # const 0x20000000
-            self.binary += unhexlify(pubkey.encode('utf8'))  # pubkey
-
-        if tx_dict['minCosignatories']['relativeChange'] < 0:
-            self.binary += int(4).to_bytes(4, "little")
-            self.binary += tx_dict['minCosignatories']['relativeChange'].to_bytes(4, "little", signed=True)
-        elif tx_dict['minCosignatories']['relativeChange'] > 0:
-            self.binary += int(4).to_bytes(4, "little")
-            self.binary += tx_dict['minCosignatories']['relativeChange'].to_bytes(4, "little")
-        return
-
-    def with_inner_tx(self, tx_dict):
-        self._common_header(tx_dict)
-
-        inner_tx = TransactionBuilder()
-        inner_tx.encode(tx_dict['otherTrans'])
-        self.binary += len(inner_tx.binary).to_bytes(4, "little")  # inner transaction length
-        self.binary += inner_tx.binary
-        return
-
-    def sign_multisig_tx(self, tx_dict):
-        self._common_header(tx_dict)
-        self.binary += int(36).to_bytes(4, "little")  # ナニコレ？
-        self.binary += self.const4bytes_signer
-        self.binary += unhexlify(tx_dict['otherHash']['data'].encode('utf8'))
-        self.binary += self.const4bytes_address
-        self.binary += unhexlify(tx_dict['otherAccount'].encode('utf8'))
+class TransactionBuilderError(Exception): pass
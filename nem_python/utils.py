@@ -1,31 +1,48 @@
 #!/user/env python3
 # -*- coding: utf-8 -*-
 
-from threading import Lock
+from threading import Lock, Timer, Condition, Event
+from contextlib import contextmanager
 import queue
 import copy
+import collections
 import atexit
 import bjson
 import logging
 import os
 import random
+import time
+import json
+import requests
+try:
+    # 大きな応答のparseが速い、無ければ標準のjson
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:
+        fast_json = json
 
 
 class QueueSystem:
-    def __init__(self):
+    def __init__(self, metrics=None, name=None):
         self.que = list()
         self.lock = Lock()
+        self.metrics = metrics
+        self.name = name
 
     def create(self):
         que = queue.LifoQueue(maxsize=25)
         with self.lock:
             self.que.append(que)
+            self._gauge()
         return que
 
     def remove(self, que):
         with self.lock:
             if que in self.que:
                 self.que.remove(que)
+            self._gauge()
 
     def broadcast(self, item):
         with self.lock:
@@ -33,54 +50,779 @@ class QueueSystem:
                 try:
                     q.put_nowait(item)
                 except queue.Full:
+                    # 溢れたQueueは読まれていないとして外す
                     self.que.remove(q)
+                    if self.metrics:
+                        self.metrics.inc('nem_queue_dropped_total', queue=self.name)
+            self._gauge()
+
+    def _gauge(self):
+        if self.metrics is None:
+            return
+        self.metrics.set('nem_queue_listeners', len(self.que), queue=self.name)
+        self.metrics.set('nem_queue_depth', max([q.qsize() for q in self.que] or [0]), queue=self.name)
+
+
+class PeerStatus:
+    """
+        Peer毎の状態、latencyとerrorは指数移動平均(EWMA)
+        接続失敗が続くとCircuitBreakerがopenになり、backoff秒の間は選ばれない
+        closed -> open -> half-open(1回だけ試す) -> closed or open
+    """
+    alpha = 0.2  # EWMAの重み
+    threshold = 3  # openになる連続失敗数
+    backoff = 5.0  # 最初のopen秒数、失敗毎に倍
+    max_backoff = 300.0
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self):
+        self.height = 0  # 最後に見たheight
+        self.checked = 0.0  # 最後に正常な応答を受けた時刻
+        self.latency = None  # 応答時間(秒)
+        self.error = 0.0  # 失敗率
+        self.failures = 0  # 連続接続失敗数
+        self.lags = 0  # 連続でBlock高が遅れていた数、応答が正常でも戻さない
+        self.open_until = 0.0
+
+    def __repr__(self):
+        return "<PeerStatus {} height={} latency={} error={:.2f}>".format(
+            self.state(), self.height, self.latency, self.error)
+
+    def report(self, ok, latency=None, height=None):
+        self.error += self.alpha * ((0.0 if ok else 1.0) - self.error)
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.alpha * (latency - self.latency)
+        if ok:
+            self.checked = time.time()
+            self.failures = 0
+            self.open_until = 0.0
+            if height is not None:
+                self.height = height
+
+    def fail(self):
+        self.report(ok=False)
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.open_until = time.time() + self._backoff()
+
+    def lag(self):
+        # 応答はあるがBlock高が遅れている、接続失敗と同じくopenにする
+        self.lags += 1
+        if self.lags >= self.threshold:
+            self.open_until = time.time() + self._backoff()
+
+    def _strikes(self):
+        return max(self.failures, self.lags)
+
+    def _backoff(self):
+        return min(self.max_backoff, self.backoff * 2 ** max(0, self._strikes() - self.threshold))
+
+    def state(self, now=None):
+        if self._strikes() < self.threshold:
+            return self.CLOSED
+        elif (now or time.time()) < self.open_until:
+            return self.OPEN
+        else:
+            return self.HALF_OPEN
+
+    def trial(self):
+        # half-openで1回だけ試す、結果が出るまで他からは選ばれない
+        self.open_until = time.time() + self._backoff()
+
+    def score(self):
+        # 小さいほど良い、未計測のPeerは優先して試す
+        latency = 0.0 if self.latency is None else self.latency
+        return (latency + 0.05) / max(0.05, 1.0 - self.error)
 
 
 class PeerStorage:
+    max_failures = 10  # この回数連続で接続失敗したPeerは削除する
+    save_delay = 10.0  # 変更をまとめてファイルに書くまでの秒数
+
     def __init__(self, path):
         self.path = path
         self.sets = set()
+        self.status = dict()  # url: PeerStatus
+        self.order = list()  # O(1)で選ぶためのurl一覧
+        self.position = dict()  # url: orderでのindex
+        self.lock = Lock()
+        self.save_timer = None
         self.load()
         atexit.register(self.save)
         atexit.register(self.load)
-        self.lock = Lock()
 
     def __repr__(self):
         return "<PeerStorage num={} file={}>".format(len(self.sets), self.path)
 
     def save(self):
+        with self.lock:
+            sets = set(self.sets)
         with open(self.path, mode='bw') as fp:
-            bjson.dump(self.sets, fp=fp)
+            bjson.dump(sets, fp=fp)
         logging.info("JsonDataBase saved to {}".format(os.path.split(self.path)[1]))
 
+    def save_later(self):
+        # 通信中にファイルを書かないよう、save_delay秒後に裏でまとめて保存
+        with self.lock:
+            if self.save_timer is not None:
+                return
+            self.save_timer = Timer(self.save_delay, self._delayed_save)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+
+    def _delayed_save(self):
+        with self.lock:
+            self.save_timer = None
+        self.save()
+
     def load(self):
         try:
             with open(self.path, mode='br') as fp:
-                with self.lock:
-                    self.sets.update(bjson.load(fp=fp))
+                items = bjson.load(fp=fp)
+            self.update(tuple(e) for e in items)
         except:
             with open(self.path, mode='bw') as fp:
                 bjson.dump(self.sets, fp=fp)
         logging.info("JsonDataBase load from {}".format(os.path.split(self.path)[1]))
 
-    def random(self):
-        return random.choice(list(self.sets))
+    def random(self, exclude=()):
+        # Power of two choices、2つ選んでscoreの良い方(openとexcludeのPeerは除く)
+        with self.lock:
+            if len(self.order) == 0 or len(exclude) and all(url in exclude for url in self.order):
+                raise IndexError('no peers')
+            now = time.time()
+            for dummy in range(8):
+                a = self.order[random.randrange(len(self.order))]
+                b = self.order[random.randrange(len(self.order))]
+                a_ok = a not in exclude and self.status[a].state(now) != PeerStatus.OPEN
+                b_ok = b not in exclude and self.status[b].state(now) != PeerStatus.OPEN
+                if a_ok and b_ok:
+                    url = a if self.status[a].score() <= self.status[b].score() else b
+                elif a_ok or b_ok:
+                    url = a if a_ok else b
+                else:
+                    continue
+                break
+            else:
+                # ほとんどopenなので、最も早く回復するPeerを試す
+                url = min((u for u in self.order if u not in exclude), key=lambda u: self.status[u].open_until)
+            if self.status[url].state(now) != PeerStatus.CLOSED:
+                self.status[url].trial()
+            return url
+
+    def failure(self, url):
+        # 接続失敗、連続max_failures回で削除
+        with self.lock:
+            if url not in self.status:
+                return
+            status = self.status[url]
+            status.fail()
+            if status.failures < self.max_failures:
+                return
+            self._remove(url)
+            logging.debug("remove peer %s" % (url,))
+        self.save_later()
+
+    def lagging(self, url):
+        # Block高の遅れ、連続max_failures回で削除
+        with self.lock:
+            if url not in self.status:
+                return
+            status = self.status[url]
+            status.lag()
+            if status.lags < self.max_failures:
+                return
+            self._remove(url)
+            logging.debug("remove lagging peer %s" % (url,))
+        self.save_later()
+
+    def caught_up(self, url):
+        with self.lock:
+            if url in self.status:
+                self.status[url].lags = 0
+
+    def report(self, url, ok=True, latency=None, height=None):
+        with self.lock:
+            if url in self.status:
+                self.status[url].report(ok=ok, latency=latency, height=height)
+
+    def report_response(self, url, call, response, latency):
+        # 応答時間・失敗率・生存確認をPeerの状態に反映する
+        if not response.ok:
+            self.report(url, ok=False, latency=latency)
+            return
+        height = None
+        if call in ('chain/last-block', 'chain/height'):
+            try:
+                height = response.json()['height']
+            except (ValueError, KeyError):
+                pass
+        self.report(url, ok=True, latency=latency, height=height)
+
+    def is_alive(self, url, ttl, height):
+        # ttl秒以内に確認済みでheight以上のBlockを持っている
+        status = self.status.get(url)
+        if status is None:
+            return False
+        return status.height >= height and time.time() - status.checked < ttl
+
+    def _insert(self, item):
+        if item in self.sets:
+            return
+        self.sets.add(item)
+        self.status[item] = PeerStatus()
+        self.position[item] = len(self.order)
+        self.order.append(item)
+
+    def _remove(self, item):
+        self.sets.discard(item)
+        self.status.pop(item, None)
+        index = self.position.pop(item)
+        last = self.order.pop()
+        if last != item:
+            self.order[index] = last
+            self.position[last] = index
 
     def add(self, item):
         with self.lock:
-            self.sets.add(item)
+            self._insert(item)
 
     def update(self, items):
         with self.lock:
-            self.sets.update(items)
+            for item in items:
+                self._insert(item)
 
     def __delitem__(self, key):
-        if key in self.sets:
-            with self.lock:
-                self.sets.remove(key)
+        with self.lock:
+            if key in self.sets:
+                self._remove(key)
 
     def __len__(self):
         return len(self.sets)
 
     def __contains__(self, item):
         return item in self.sets
+
+
+class SessionPool:
+    """
+        Peer毎にKeep-aliveなrequests.Sessionを貸し出す
+        同時に使うSessionはpeer毎にmaxsizeまで保持、max_idle秒使われないと閉じる
+    """
+    def __init__(self, maxsize=4, max_idle=60, headers=None):
+        self.maxsize = maxsize
+        self.max_idle = max_idle
+        self.headers = headers or {'Content-type': 'application/json'}
+        self.pool = dict()  # url: [(session, last_used), ..]
+        self.lock = Lock()
+        self.reused = 0  # 既存のSessionを再利用した回数
+        self.opened = 0  # 新しくSessionを作った回数
+        self.closed = 0  # 閉じたSessionの数
+
+    def __repr__(self):
+        return "<SessionPool peers={} reused={} opened={} closed={}>".format(
+            len(self.pool), self.reused, self.opened, self.closed)
+
+    @contextmanager
+    def session(self, url):
+        s = self._acquire(url)
+        try:
+            yield s
+        except Exception:
+            # 壊れた接続は戻さない
+            s.close()
+            with self.lock:
+                self.closed += 1
+            raise
+        else:
+            self._release(url, s)
+
+    def _acquire(self, url):
+        with self.lock:
+            self._evict_idle()
+            idle = self.pool.get(url)
+            if idle:
+                self.reused += 1
+                return idle.pop()[0]
+            self.opened += 1
+        s = requests.Session()
+        s.headers.update(self.headers)
+        return s
+
+    def _release(self, url, s):
+        with self.lock:
+            idle = self.pool.setdefault(url, list())
+            if len(idle) < self.maxsize:
+                idle.append((s, time.time()))
+                return
+            self.closed += 1
+        s.close()
+
+    def _evict_idle(self):
+        limit = time.time() - self.max_idle
+        for url in list(self.pool):
+            idle = self.pool[url]
+            for s, last in [e for e in idle if e[1] < limit]:
+                idle.remove((s, last))
+                s.close()
+                self.closed += 1
+            if len(idle) == 0:
+                del self.pool[url]
+
+    def discard(self, url):
+        with self.lock:
+            idle = self.pool.pop(url, list())
+            self.closed += len(idle)
+        for s, last in idle:
+            s.close()
+
+    def close(self):
+        for url in list(self.pool):
+            self.discard(url)
+
+    def counters(self):
+        with self.lock:
+            return {
+                'reused': self.reused, 'opened': self.opened, 'closed': self.closed,
+                'idle': sum(len(e) for e in self.pool.values())}
+
+
+class PeerLimiter:
+    """ Peer毎に同時に送るリクエストをlimitまでにする、空くまで待つ """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.cond = Condition(Lock())
+        self.inflight = dict()  # url: 送信中の数
+        self.requests = collections.Counter()  # url: 送った数
+
+    def __repr__(self):
+        return "<PeerLimiter limit={} peers={}>".format(self.limit, len(self.requests))
+
+    def free(self, url):
+        with self.cond:
+            return self.inflight.get(url, 0) < self.limit
+
+    @contextmanager
+    def slot(self, url):
+        with self.cond:
+            while self.inflight.get(url, 0) >= self.limit:
+                self.cond.wait()
+            self.inflight[url] = self.inflight.get(url, 0) + 1
+            self.requests[url] += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.inflight[url] -= 1
+                self.cond.notify_all()
+
+
+class MosaicCache:
+    """
+        namespace毎のMosaic定義とMosaic毎のsupplyのキャッシュ、それぞれmaxsize件までLRU
+        定義はttl秒、supplyはsupplyMutable=falseなら期限無し
+        変わり得るsupplyはsupply_blocks進むかsupply_ttl秒で取り直す
+        pathに保存し再起動後も使う
+    """
+    maxsize = 1000
+    ttl = 3600 * 24
+    supply_ttl = 600
+    supply_blocks = 10
+    save_delay = 10.0  # 変更をまとめてファイルに書くまでの秒数
+
+    def __init__(self, path):
+        self.path = path
+        self.definitions = collections.OrderedDict()  # namespace: [definition, time]
+        self.supplies = collections.OrderedDict()  # mosaic: [supply, time, height, mutable]
+        self.lock = Lock()
+        self.save_timer = None
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def __repr__(self):
+        return "<MosaicCache definitions={} supplies={} hits={} misses={}>".format(
+            len(self.definitions), len(self.supplies), self.hits, self.misses)
+
+    def load(self):
+        try:
+            with open(self.path, mode='r') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            self.definitions.update((k, v) for k, v in data.get('definitions', list()))
+            self.supplies.update((k, v) for k, v in data.get('supplies', list()))
+
+    def save(self):
+        with self.lock:
+            data = {'definitions': list(self.definitions.items()), 'supplies': list(self.supplies.items())}
+        # 書きかけのファイルを読まないよう置き換える
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, mode='w') as fp:
+            json.dump(data, fp)
+        os.replace(tmp_path, self.path)
+
+    def save_later(self):
+        with self.lock:
+            if self.save_timer is not None:
+                return
+            self.save_timer = Timer(self.save_delay, self._delayed_save)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+
+    def _delayed_save(self):
+        with self.lock:
+            self.save_timer = None
+        self.save()
+
+    def _get(self, cache, key, fresh):
+        with self.lock:
+            if key in cache and fresh(cache[key]):
+                cache.move_to_end(key)
+                self.hits += 1
+                return cache[key][0]
+            self.misses += 1
+            return None
+
+    def _put(self, cache, key, value):
+        with self.lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > self.maxsize:
+                cache.popitem(last=False)
+        self.save_later()
+
+    def get_definition(self, namespace):
+        # 無いか期限切れならNone
+        return self._get(self.definitions, namespace, lambda e: time.time() - e[1] < self.ttl)
+
+    def put_definition(self, namespace, definition):
+        self._put(self.definitions, namespace, [definition, time.time()])
+
+    def get_supply(self, mosaic, height):
+        def fresh(e):
+            supply, checked, checked_height, mutable = e
+            return not mutable or (time.time() - checked < self.supply_ttl and
+                                   height - checked_height < self.supply_blocks)
+        return self._get(self.supplies, mosaic, fresh)
+
+    def put_supply(self, mosaic, supply, height, mutable=True):
+        self._put(self.supplies, mosaic, [supply, time.time(), height, mutable])
+
+
+class SingleFlight:
+    """
+        同じkeyの呼び出しが重なったら1回だけ実行して結果を共有する
+        終わってからwindow秒の間に来た呼び出しも同じ結果を使う(例外は共有するが残さない)
+        共有した結果は書き換えないこと
+    """
+
+    def __init__(self, window=0.0):
+        self.window = window
+        self.lock = Lock()
+        self.calls = dict()  # key: [Event, 終了時刻, 結果, 例外]
+        self.executed = 0
+        self.coalesced = 0  # 他の呼び出しの結果を使った数
+
+    def __repr__(self):
+        return "<SingleFlight executed={} coalesced={}>".format(self.executed, self.coalesced)
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None and (not call[0].is_set() or time.time() - call[1] < self.window):
+                self.coalesced += 1
+                leader = False
+            else:
+                call = [Event(), None, None, None]
+                self.calls[key] = call
+                self.executed += 1
+                leader = True
+        if leader:
+            try:
+                call[2] = fn()
+            except Exception as e:
+                call[3] = e
+            call[1] = time.time()
+            call[0].set()
+            with self.lock:
+                # 期限の過ぎた結果と失敗は残さない
+                limit = call[1] - self.window
+                for k, e in list(self.calls.items()):
+                    if e[0].is_set() and (e[1] <= limit or e[3] is not None):
+                        del self.calls[k]
+        else:
+            call[0].wait()
+        if call[3] is not None:
+            raise call[3]
+        return call[2]
+
+    def counters(self):
+        with self.lock:
+            return {'executed': self.executed, 'coalesced': self.coalesced, 'keys': len(self.calls)}
+
+
+class HedgeDelay:
+    """
+        hedgeするcall毎に、別のPeerにも送るまでの待ち時間を決める
+        記録するのは先に返った応答の時間だけ(hedgeで負けた遅い応答は入れない)
+        min_samples未満の間はdefault、q分位点をfloor~capに収める
+    """
+
+    def __init__(self, default, floor, q=0.95, min_samples=20, maxlen=128):
+        self.default = default
+        self.floor = floor
+        self.q = q
+        self.min_samples = min_samples
+        self.maxlen = maxlen
+        self.latencies = dict()  # call: deque
+        self.lock = Lock()
+
+    def __repr__(self):
+        return "<HedgeDelay calls={}>".format(len(self.latencies))
+
+    def record(self, call, latency):
+        with self.lock:
+            if call not in self.latencies:
+                self.latencies[call] = collections.deque(maxlen=self.maxlen)
+            self.latencies[call].append(latency)
+
+    def delay(self, call, cap):
+        with self.lock:
+            latencies = sorted(self.latencies.get(call, ()))
+        if len(latencies) < self.min_samples:
+            delay = self.default
+        else:
+            delay = latencies[min(len(latencies) - 1, int(len(latencies) * self.q))]
+        return min(cap, max(self.floor, delay))
+
+
+class TokenBucket:
+    """ 1秒にrate個溜まり最大burst個、1リクエストに1個使う """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def __repr__(self):
+        return "<TokenBucket rate={} tokens={:.1f}>".format(self.rate, self.tokens)
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        # 1個使えるまでの秒数
+        self._refill(now)
+        return 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1.0
+
+    def drain(self, now):
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0)
+
+
+class RateLimiter:
+    """
+        Peer毎と全体のTokenBucket、両方にtokenがあれば送る
+        無ければ溜まるまで待つので、連続したpage取得は自然に遅くなる
+    """
+    evict_interval = 60  # 満タンに戻ったBucketを捨てる間隔
+
+    def __init__(self, peer_rate, peer_burst, global_rate, global_burst):
+        self.peer_rate = peer_rate
+        self.peer_burst = peer_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.buckets = dict()  # url: TokenBucket
+        self.evicted = time.time()
+        self.lock = Lock()
+        self.waited = 0  # 待った回数
+        self.wait_total = 0.0  # 待った秒数
+
+    def __repr__(self):
+        return "<RateLimiter peers={} waited={} wait_total={:.1f}s>".format(
+            len(self.buckets), self.waited, self.wait_total)
+
+    def _evict(self, now):
+        # 満タンのBucketは新しく作るのと同じなので捨てて良い、一度使っただけのPeerで増え続けない
+        if now - self.evicted < self.evict_interval:
+            return
+        self.evicted = now
+        for url in list(self.buckets):
+            bucket = self.buckets[url]
+            bucket.wait_time(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[url]
+
+    def _bucket(self, url):
+        self._evict(time.time())
+        if url not in self.buckets:
+            self.buckets[url] = TokenBucket(self.peer_rate, self.peer_burst)
+        return self.buckets[url]
+
+    def has_tokens(self, url):
+        with self.lock:
+            return self._bucket(url).wait_time(time.time()) == 0.0
+
+    def acquire(self, url):
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                bucket = self._bucket(url)
+                delay = max(bucket.wait_time(now), self.global_bucket.wait_time(now))
+                if delay == 0.0:
+                    bucket.take()
+                    self.global_bucket.take()
+                    if waited > 0.0:
+                        self.waited += 1
+                        self.wait_total += waited
+                    return waited
+            time.sleep(delay)
+            waited += delay
+
+    def penalize(self, url):
+        # 制限を受けたPeerはtokenが溜まり直すまで使わない
+        with self.lock:
+            self._bucket(url).drain(time.time())
+
+    def counters(self):
+        with self.lock:
+            return {'peers': len(self.buckets), 'waited': self.waited, 'wait_total': self.wait_total}
+
+
+class BlockNotifier:
+    """
+        新しいBlockを待つLoopに通知する
+    """
+    def __init__(self):
+        self.height = 0
+        self.closed = False
+        self.cond = Condition()
+
+    def publish(self, height):
+        with self.cond:
+            if height <= self.height:
+                return False
+            self.height = height
+            self.cond.notify_all()
+            return True
+
+    def wait(self, height, timeout=None):
+        # heightより新しいBlockを待つ、timeoutかclose()でNone
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or self.height > height, timeout)
+            if self.closed or self.height <= height:
+                return None
+            return self.height
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class PollSchedule:
+    """
+        監視対象毎の確認間隔、新しいTXがあれば短く、無ければfactor倍ずつmaxまで延ばす
+        nowは時刻でもBlock高でも良い
+    """
+    def __init__(self, min_interval, max_interval, factor=2.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.schedule = dict()  # key: [interval, 次に確認するnow]
+
+    def due(self, keys, now):
+        # 確認すべきkey、初めてのkeyは常に含む
+        return [k for k in keys if k not in self.schedule or self.schedule[k][1] <= now]
+
+    def done(self, key, busy, now):
+        # 確認した、失敗した時もbusy=Falseで呼ぶ
+        if busy or key not in self.schedule:
+            interval = self.min_interval
+        else:
+            interval = min(self.max_interval, self.schedule[key][0] * self.factor)
+        self.schedule[key] = [interval, now + interval]
+
+    def wait_time(self, keys, now):
+        # 次に確認すべきkeyまでの時間、未確認のkeyがあればmin_interval
+        if len(self.schedule) == 0 or any(k not in self.schedule for k in keys):
+            return self.min_interval
+        return max(0.0, min(e[1] for e in self.schedule.values()) - now)
+
+    def retain(self, keys):
+        # 監視対象から外れたkeyを忘れる
+        for k in set(self.schedule) - set(keys):
+            del self.schedule[k]
+
+
+class ResponseStats:
+    """ endpoint毎の応答の数・bytes・parse時間 """
+
+    def __init__(self):
+        self.calls = dict()  # call: {count, bytes, parsed, parse_time}
+        self.lock = Lock()
+
+    def _get(self, call):
+        if call not in self.calls:
+            self.calls[call] = {'count': 0, 'bytes': 0, 'parsed': 0, 'parse_time': 0.0}
+        return self.calls[call]
+
+    def received(self, call, size):
+        with self.lock:
+            stat = self._get(call)
+            stat['count'] += 1
+            stat['bytes'] += size
+
+    def parsed(self, call, elapsed):
+        with self.lock:
+            stat = self._get(call)
+            stat['parsed'] += 1
+            stat['parse_time'] += elapsed
+
+    def snapshot(self):
+        with self.lock:
+            return {call: dict(stat) for call, stat in self.calls.items()}
+
+
+class NemResponse:
+    """
+        NISの応答、json()は最初の1回だけparseして結果を使い回す
+        orjsonかujsonがあればそちらでparseする
+    """
+
+    def __init__(self, call, status_code, content, stats=None):
+        self.call = call
+        self.status_code = status_code
+        self.content = content
+        self.stats = stats
+        self._data = None
+        self._parsed = False
+        if stats is not None:
+            stats.received(call, len(content))
+
+    def __repr__(self):
+        return "<NemResponse [{}] {}>".format(self.status_code, self.call)
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        if not self._parsed:
+            begin = time.time()
+            self._data = fast_json.loads(self.content)
+            self._parsed = True
+            if self.stats is not None:
+                self.stats.parsed(self.call, time.time() - begin)
+        return self._data
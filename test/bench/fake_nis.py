@@ -0,0 +1,239 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from binascii import unhexlify
+from Cryptodome.Hash import keccak
+from nem_ed25519.key import get_address
+import collections
+import threading
+import hashlib
+import random
+import struct
+import json
+import time
+
+
+OTHER_PK = '1' * 64  # 相手側のアカウント
+PAGE = 25
+
+
+class FakeNIS(ThreadingMixIn, HTTPServer):
+    """
+        Benchmark用のNIS代わり、chain・account・送受金page・mosaic・announceを返す
+        latency + 0~jitter秒待ってから応答し、error_rateで500、drop_rateで切断する
+        アカウント毎にtxs個の送受金があり、announceしたTXは次のBlockで履歴に加わる
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0, drop_rate=0.0,
+                 txs=100, height=100000, main_net=False, seed=None):
+        super().__init__(('127.0.0.1', port), FakeHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.txs = txs
+        self.height = height
+        self.main_net = main_net
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.pks = dict()  # ck: pk、outgoingの署名者
+        self.announced = collections.defaultdict(list)  # (call, ck): [tx, ..]
+        self.next_id = 10 ** 6
+        self.hashes = set()  # announce済みのhash
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.other_ck = get_address(OTHER_PK, main_net=main_net)
+
+    @property
+    def url(self):
+        return 'http', '127.0.0.1', self.server_port
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='FakeNIS', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def register(self, pk):
+        """ pkのアカウントの送金履歴を作る """
+        ck = get_address(pk, main_net=self.main_net)
+        self.pks[ck] = pk
+        return ck
+
+    def next_block(self):
+        with self.lock:
+            self.height += 1
+            return self.height
+
+    def counters(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'errors': dict(self.errors)}
+
+    def _version(self, transfer_type):
+        return (1744830464 if self.main_net else -1744830464) + transfer_type
+
+    def _transfer(self, tx_id, height, signer, recipient, txhash, amount=100000000, mosaics=None):
+        tx = {
+            'type': 257, 'version': self._version(1), 'timeStamp': height * 60, 'deadline': height * 60 + 3600,
+            'signer': signer, 'recipient': recipient, 'amount': amount, 'fee': 50000,
+            'message': {'type': 1, 'payload': ('bench %d' % tx_id).encode().hex()},
+            'signature': '00' * 64}
+        if mosaics:
+            tx['version'] = self._version(2)
+            tx['mosaics'] = [
+                {'mosaicId': {'namespaceId': n.split(':')[0], 'name': n.split(':')[1]}, 'quantity': q}
+                for n, q in mosaics.items()]
+        return {'meta': {'innerHash': {}, 'id': tx_id, 'hash': {'data': txhash}, 'height': height},
+                'transaction': tx}
+
+    def history(self, call, ck):
+        """ 新しい順の全履歴 """
+        # 残高が足りるよう送金は入金より少なくする
+        if call == 'account/transfers/outgoing':
+            signer, recipient, amount = self.pks.get(ck, OTHER_PK), self.other_ck, 1000000
+        else:
+            signer, recipient, amount = OTHER_PK, ck, 100000000
+        txs = list()
+        for i in range(1, self.txs + 1):
+            txhash = hashlib.sha256(('%s/%s/%d' % (call, ck, i)).encode()).hexdigest()
+            # 5個に1つはMosaic送金
+            mosaics = {'bench:coin': 10} if i % 5 == 0 else None
+            txs.append(self._transfer(i, i, signer, recipient, txhash, amount, mosaics))
+        with self.lock:
+            announced = [tx for tx in self.announced[(call, ck)] if tx['meta']['height'] <= self.height]
+        return announced[::-1] + txs[::-1]
+
+    def page(self, call, ck, tx_id=None):
+        txs = self.history(call, ck)
+        if tx_id is not None:
+            txs = [tx for tx in txs if tx['meta']['id'] < tx_id]
+        return txs[:PAGE]
+
+    def announce(self, data):
+        """
+            transferのbinaryから署名者・宛先・金額を読み、次のBlockで承認されたとする
+            受付済みのTXならNone
+        """
+        raw = unhexlify(data['data'])
+        txhash = keccak.new(digest_bits=256, data=raw).hexdigest()
+        signer = raw[16:48].hex()
+        recipient = raw[64:104].decode()
+        amount = struct.unpack('<Q', raw[104:112])[0]
+        signer_ck = get_address(signer, main_net=self.main_net)
+        with self.lock:
+            if txhash in self.hashes:
+                return None  # 受付済み
+            self.hashes.add(txhash)
+            self.next_id += 1
+            tx = self._transfer(self.next_id, self.height + 1, signer, recipient, txhash, amount=amount)
+            self.announced[('account/transfers/outgoing', signer_ck)].append(tx)
+            self.announced[('account/transfers/incoming', recipient)].append(tx)
+        return txhash
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path, query = self._parse()
+        if self._inject(path):
+            return
+        server = self.server
+        if path in ('chain/last-block', 'node/active-peers/max-chain-height', 'chain/height'):
+            height = server.height
+            self.reply({'height': height, 'prevBlockHash': {'data': '%064x' % (height - 1)}})
+        elif path == 'account/get':
+            ck = query['address']
+            self.reply({
+                'account': {'address': ck, 'balance': 10 ** 12, 'publicKey': server.pks.get(ck),
+                            'multisigInfo': {}},
+                'meta': {'cosignatories': [], 'cosignatoryOf': [], 'status': 'LOCKED'}})
+        elif path in ('account/transfers/incoming', 'account/transfers/outgoing', 'account/transfers/all'):
+            tx_id = int(query['id']) if 'id' in query else None
+            self.reply({'data': server.page(path, query['address'], tx_id)})
+        elif path == 'account/unconfirmedTransactions':
+            self.reply({'data': []})
+        elif path == 'account/mosaic/owned':
+            self.reply({'data': [
+                {'mosaicId': {'namespaceId': 'nem', 'name': 'xem'}, 'quantity': 10 ** 12},
+                {'mosaicId': {'namespaceId': 'bench', 'name': 'coin'}, 'quantity': 10 ** 6}]})
+        elif path == 'namespace/mosaic/definition/page':
+            if query['namespace'] == 'bench' and 'id' not in query:
+                self.reply({'data': [{'meta': {'id': 1}, 'mosaic': {
+                    'creator': OTHER_PK, 'description': 'bench',
+                    'id': {'namespaceId': 'bench', 'name': 'coin'},
+                    'properties': [
+                        {'name': 'divisibility', 'value': '0'},
+                        {'name': 'initialSupply', 'value': '1000000'},
+                        {'name': 'supplyMutable', 'value': 'false'},
+                        {'name': 'transferable', 'value': 'true'}],
+                    'levy': {}}}]})
+            else:
+                self.reply({'data': []})
+        elif path == 'namespace':
+            self.reply({'fqn': query['namespace'], 'owner': self.server.other_ck, 'height': 10})
+        elif path == 'mosaic/supply':
+            self.reply({'mosaicId': query['mosaicId'], 'supply': 1000000})
+        else:
+            self.reply({'error': 'Not Found', 'message': path, 'status': 404}, code=404)
+
+    def do_POST(self):
+        path, query = self._parse()
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+        if self._inject(path):
+            return
+        if path == 'transaction/announce':
+            txhash = self.server.announce(body)
+            if txhash is None:
+                self.reply({'type': 1, 'code': 16, 'message': 'FAILURE_HASH_EXISTS'})
+            else:
+                self.reply({'type': 1, 'code': 1, 'message': 'SUCCESS',
+                            'transactionHash': {'data': txhash}, 'innerTransactionHash': {}})
+        else:
+            self.reply({'error': 'Not Found', 'message': path, 'status': 404}, code=404)
+
+    def _parse(self):
+        path = self.path.split('?')[0].lstrip('/')
+        query = dict()
+        if '?' in self.path:
+            query = dict(e.split('=', 1) for e in self.path.split('?', 1)[1].split('&') if '=' in e)
+        with self.server.lock:
+            self.server.requests[path] += 1
+        return path, query
+
+    def _inject(self, path):
+        # 遅延とエラーの注入、応答済みならTrue
+        server = self.server
+        with server.lock:
+            delay = server.latency + server.random.random() * server.jitter
+            dice = server.random.random()
+        if delay > 0:
+            time.sleep(delay)
+        if dice < server.drop_rate:
+            with server.lock:
+                server.errors['drop'] += 1
+            self.close_connection = True
+            return True
+        elif dice < server.drop_rate + server.error_rate:
+            with server.lock:
+                server.errors['500'] += 1
+            self.reply({'error': 'Internal Server Error', 'message': 'injected error', 'status': 500}, code=500)
+            return True
+        return False
+
+    def reply(self, body, code=200):
+        b = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(b)))
+        self.end_headers()
+        self.wfile.write(b)
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,380 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark with local FakeNIS (no internet)
+
+    PYTHONPATH=. python test/bench/run_bench.py --output bench.json
+    PYTHONPATH=. python test/bench/run_bench.py --latency 0.05 --error-rate 0.05 --baseline bench.json
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkdtemp
+import argparse
+import platform
+import tempfile
+import threading
+import logging
+import bjson
+import json
+import time
+import sys
+import os
+from fake_nis import FakeNIS
+
+
+def summarize(samples, elapsed=None):
+    """ 所要時間のリストから件数・平均・p50・p95・最大・1秒あたりの数 """
+    if len(samples) == 0:
+        return {'count': 0}
+    s = sorted(samples)
+    elapsed = sum(s) if elapsed is None else elapsed
+    return {
+        'count': len(s),
+        'mean': sum(s) / len(s),
+        'p50': s[len(s) // 2],
+        'p95': s[min(len(s) - 1, int(len(s) * 0.95))],
+        'max': s[-1],
+        'per_sec': len(s) / elapsed if elapsed > 0 else None}
+
+
+def setup_env(fake):
+    # tmpとhomeを一時フォルダにし、Peerは偽NISだけにする
+    tmp_dir = mkdtemp(prefix='nem_bench_')
+    tempfile.tempdir = tmp_dir
+    os.environ['HOME'] = tmp_dir
+    os.mkdir(os.path.join(tmp_dir, 'nem_python_test'))
+    with open(os.path.join(tmp_dir, 'nem_python_test', 'peer.json'), mode='bw') as fp:
+        # 5個未満だと既定のPeerが足されるので到達しないPeerで埋める
+        bjson.dump({fake.url} | {('http', '127.0.0.%d' % i, fake.server_port) for i in range(2, 6)}, fp=fp)
+    return tmp_dir
+
+
+def create_nem():
+    from nem_python.nem_connect import NemConnect
+    # 偽NISの応答を測るので送信数の制限は外す
+    NemConnect.peer_rate = NemConnect.global_rate = 10000
+    NemConnect.peer_burst = NemConnect.global_burst = 10000
+    nem = NemConnect(main_net=False)
+    for url in list(nem.peers.sets):
+        if url[1] != '127.0.0.1':
+            del nem.peers[url]
+    return nem
+
+
+def bench_transfer_all(nem, fake, accounts):
+    """ get_account_transfer_all、1回目は全取得、2回目はキャッシュ済み """
+    cks = ['TBENCH%034d' % i for i in range(accounts)]
+    result = dict()
+    for name in ('cold', 'warm'):
+        samples = list()
+        begin = time.time()
+        for ck in cks:
+            t = time.time()
+            txs = nem.get_account_transfer_all(ck, nem.TRANSFER_INCOMING)
+            samples.append(time.time() - t)
+            assert len(txs) == fake.txs
+        elapsed = time.time() - begin
+        result[name] = summarize(samples, elapsed)
+        result[name]['txs_per_sec'] = fake.txs * len(cks) / elapsed
+    return result
+
+
+def bench_polling(nem, fake, accounts, duration, block_time):
+    """ 監視Loop、block_time毎にBlockを進めduration秒のSweep時間 """
+    nem.block_interval = block_time / 2
+    nem.mempool_min_interval = block_time / 2
+    nem.confirmed_max_skip = 1
+    for i in range(accounts):
+        nem.monitor_cks.append('TPOLL%035d' % i)
+    received = nem.received_que.create()
+    nem.start()
+    end = time.time() + duration
+    while time.time() < end:
+        time.sleep(block_time)
+        fake.next_block()
+    nem.stop()
+    nem.received_que.remove(received)
+    result = dict()
+    for loop, stats in nem.poll_stats.items():
+        result[loop] = {
+            'sweeps': stats['sweeps'], 'addresses': stats['addresses'], 'max': stats['max'],
+            'mean': stats['total'] / stats['sweeps'] if stats['sweeps'] else None}
+    return result
+
+
+def bench_announce(nem, fake, count, workers):
+    """ 署名済みTXのtransaction_announce """
+    from nem_python.transaction_builder import TransactionBuilder
+    from nem_python.nem_connect import NemConnectError
+    from nem_ed25519.key import secret_key, public_key
+    from nem_ed25519.signature import sign
+    sk = secret_key()
+    pk = public_key(sk)
+    signed = list()
+    for i in range(count):
+        tx_dict = nem.mosaic_transfer(pk, fake.other_ck, {'nem:xem': i + 1}, msg_body=b'bench')
+        tx_hex = TransactionBuilder().encode(tx_dict)
+        signed.append((tx_hex, sign(msg=bytes.fromhex(tx_hex), sk=sk, pk=pk).hex()))
+
+    def announce(args):
+        t = time.time()
+        try:
+            nem.transaction_announce(*args)
+        except NemConnectError:
+            return None  # 注入したエラー
+        return time.time() - t
+
+    begin = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        samples = list(pool.map(announce, signed))
+    result = summarize([e for e in samples if e is not None], time.time() - begin)
+    result['failed'] = samples.count(None)
+    return result
+
+
+def bench_account(nem, fake, sends):
+    """ Account._initializeとAccount.send、send_many """
+    from nem_python.engine.account import Account
+    from nem_ed25519.key import secret_key, public_key
+    sk = secret_key()
+    pk = public_key(sk)
+    fake.register(pk)
+    account = Account(nem, pk, sk=sk, main_net=False)
+    result = dict()
+
+    begin = time.time()
+    db = account.create_connect()
+    incoming_many, outgoing_many = account._initialize(db)
+    result['initialize'] = {
+        'elapsed': time.time() - begin, 'incoming': len(incoming_many), 'outgoing': len(outgoing_many)}
+
+    samples = list()
+    failed = 0
+    begin = time.time()
+    for i in range(sends):
+        t = time.time()
+        try:
+            account.send(from_id=account.owner_id, to_address=fake.other_ck, mosaics={'nem:xem': 1000 + i},
+                         msg=b'bench', only_check=False, db=db)
+            samples.append(time.time() - t)
+        except Exception as e:
+            logging.warning("send failed %s" % e)
+            failed += 1
+        fake.next_block()
+    result['send'] = summarize(samples, time.time() - begin)
+    result['send']['failed'] = failed
+
+    # send_manyは全TXを台帳に書いてからannounceする
+    entries = [(fake.other_ck, {'nem:xem': 2000 + i}, b'bench many') for i in range(sends)]
+    begin = time.time()
+    txhashes = account.send_many(from_id=account.owner_id, entries=entries, workers=1, db=db)
+    elapsed = time.time() - begin
+    with db as conn:
+        rows = conn.execute("SELECT COUNT(DISTINCT `txhash`) FROM `outgoing_table` WHERE `txhash` IN (%s)" % ', '.join(
+            'x\'%s\'' % txhash for txhash in txhashes if txhash)).fetchone()[0]
+    result['send_many'] = {'count': sends, 'elapsed': elapsed, 'per_sec': sends / elapsed,
+                           'failed': txhashes.count(None), 'ledger': rows}
+    fake.next_block()
+    db.close()
+
+    # 承認待ちのthreadが終わるまで待つ、announceからの時間はmetricsに記録される
+    for thread in threading.enumerate():
+        if thread.name == 'Wait':
+            thread.join()
+    for labels, h in nem.metrics.snapshot()['histograms'].get('account_confirm_seconds', list()):
+        result['confirm'] = {'count': h['count'], 'mean': h['sum'] / h['count'] if h['count'] else None}
+    return result
+
+
+def bench_batch(nem, fake, count, workers):
+    """ 送金TXの作成・署名、1件ずつ(mosaic_transfer+encode+sign)とbatch_sign """
+    from nem_python.transaction_builder import TransactionBuilder
+    from nem_python.batch_sign import create_snapshot, batch_sign
+    from nem_python.signer import Signer
+    from nem_ed25519.key import secret_key, public_key
+    from nem_ed25519.signature import sign
+    sk = secret_key()
+    pk = public_key(sk)
+    entries = [(fake.other_ck, {'nem:xem': i + 1, 'bench:coin': 1}, b'payroll %d' % i) for i in range(count)]
+    result = {'workers': workers}
+
+    begin = time.time()
+    for ck, mosaics, msg in entries:
+        tx_hex = TransactionBuilder().encode(nem.mosaic_transfer(pk, ck, mosaics, msg_body=msg))
+        sign(msg=bytes.fromhex(tx_hex), sk=sk, pk=pk)
+    elapsed = time.time() - begin
+    result['single'] = {'count': count, 'elapsed': elapsed, 'per_sec': count / elapsed}
+
+    snapshot = create_snapshot(nem, {'nem:xem', 'bench:coin'})
+    signer = Signer(sk, pk)
+    for name, n in (('batch_1', 1), ('batch_cold', workers), ('batch', workers)):
+        # batch_coldはPoolの起動を含む、batchは起動済みのPoolを使い回す
+        begin = time.time()
+        batch_sign(snapshot, signer, entries, workers=n)
+        elapsed = time.time() - begin
+        result[name] = {'count': count, 'elapsed': elapsed, 'per_sec': count / elapsed}
+    # Process数毎の速度、CPU数より多くしても速くならない
+    result['cpu_count'] = os.cpu_count()
+    result['scaling'] = dict()
+    for n in range(2, workers + 1):
+        batch_sign(snapshot, signer, entries[:n], workers=n)
+        begin = time.time()
+        batch_sign(snapshot, signer, entries, workers=n)
+        elapsed = time.time() - begin
+        result['scaling'][n] = {'elapsed': elapsed, 'per_sec': count / elapsed,
+                                'speedup': result['batch_1']['elapsed'] / elapsed}
+    return result
+
+
+def bench_sign(count, msg_size):
+    """ 署名と暗号化、nem_ed25519を毎回呼ぶのと鍵を展開済みのSigner """
+    from nem_python.signer import Signer
+    from nem_ed25519.key import secret_key, public_key
+    from nem_ed25519.signature import sign
+    from nem_ed25519.encrypt import encrypt
+    sk = secret_key()
+    pk = public_key(sk)
+    other_pk = public_key(secret_key())
+    msgs = [os.urandom(msg_size) for dummy in range(count)]
+    result = {'bytes': msg_size}
+    begin = time.time()
+    signer = Signer(sk, pk)
+    signer.sign(msgs[0])  # 固定基点の表を作る
+    result['setup'] = {'elapsed': time.time() - begin}
+    for name, fn in (
+            ('sign', lambda: [sign(msg=msg, sk=sk, pk=pk) for msg in msgs]),
+            ('signer', lambda: [signer.sign(msg) for msg in msgs]),
+            ('signer_many', lambda: signer.sign_many(msgs)),
+            ('encrypt', lambda: [encrypt(sk, other_pk, msg) for msg in msgs]),
+            ('signer_encrypt', lambda: [signer.encrypt(other_pk, msg) for msg in msgs])):
+        begin = time.time()
+        fn()
+        elapsed = time.time() - begin
+        result[name] = {'count': count, 'mean': elapsed / count, 'per_sec': count / elapsed}
+    return result
+
+
+def bench_encode(count, mosaics):
+    """ 多数のMosaicを含む送金TXのTransactionBuilder encode/decode """
+    from nem_python.transaction_builder import TransactionBuilder
+    tx_dict = {
+        'type': 257, 'version': -1744830462, 'signer': 'a' * 64, 'timeStamp': 90000000, 'deadline': 90003600,
+        'recipient': 'T' * 40, 'amount': 1000000, 'fee': 150000, 'message': {'type': 1, 'payload': '00' * 64},
+        'mosaics': [{'mosaicId': {'namespaceId': 'bench%d' % i, 'name': 'coin'}, 'quantity': i}
+                    for i in range(mosaics)]}
+    result = {'mosaics': mosaics, 'bytes': TransactionBuilder().size(tx_dict)}
+    for name in ('encode', 'encode_raw'):
+        begin = time.time()
+        for dummy in range(count):
+            getattr(TransactionBuilder(), name)(tx_dict)
+        elapsed = time.time() - begin
+        result[name] = {'count': count, 'mean': elapsed / count, 'per_sec': count / elapsed}
+    # decodeは監査で大量に読むので、Mosaic無しの送金も測る
+    tb = TransactionBuilder()
+    simple = dict(tx_dict)
+    del simple['mosaics']
+    for name, tx in (('decode', tx_dict), ('decode_simple', simple)):
+        raw = memoryview(tb.encode_raw(tx))
+        begin = time.time()
+        for dummy in range(count):
+            tb.decode(raw)
+        elapsed = time.time() - begin
+        result[name] = {'count': count, 'mean': elapsed / count, 'per_sec': count / elapsed}
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """ baselineより遅くなった値(mean, p95, max, elapsed)を返す """
+    slower = list()
+
+    def walk(now, old, path):
+        for key, value in now.items():
+            if key not in old:
+                continue
+            if isinstance(value, dict):
+                walk(value, old[key], path + (key,))
+            elif key in ('mean', 'p95', 'max', 'elapsed') and value and old[key]:
+                if value > old[key] * (1 + tolerance):
+                    slower.append(('/'.join(path + (key,)), old[key], value))
+
+    walk(results, baseline, tuple())
+    return slower
+
+
+def main():
+    p = argparse.ArgumentParser(description='nem_python benchmark with local FakeNIS')
+    p.add_argument('--output', default='bench.json', help='result json file')
+    p.add_argument('--baseline', default=None, help='previous result json, exit 1 if slower')
+    p.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown ratio with baseline')
+    p.add_argument('--latency', type=float, default=0.0, help='fake NIS response delay seconds')
+    p.add_argument('--jitter', type=float, default=0.0, help='extra random delay 0~jitter seconds')
+    p.add_argument('--error-rate', type=float, default=0.0, help='ratio of 500 response')
+    p.add_argument('--drop-rate', type=float, default=0.0, help='ratio of closed connection')
+    p.add_argument('--txs', type=int, default=250, help='transfers per account')
+    p.add_argument('--accounts', type=int, default=20)
+    p.add_argument('--announces', type=int, default=50)
+    p.add_argument('--announce-workers', type=int, default=4)
+    p.add_argument('--sends', type=int, default=10)
+    p.add_argument('--encodes', type=int, default=2000)
+    p.add_argument('--batch', type=int, default=200, help='transfers in build-and-sign bench')
+    p.add_argument('--batch-workers', type=int, default=os.cpu_count() or 1)
+    p.add_argument('--signs', type=int, default=500, help='messages in sign bench')
+    p.add_argument('--mosaics', type=int, default=50, help='mosaics per transfer in encode bench')
+    p.add_argument('--poll-duration', type=float, default=10.0)
+    p.add_argument('--block-time', type=float, default=1.0)
+    p.add_argument('--only', default=None, help='comma separated: encode,sign,batch,transfer_all,polling,announce,account')
+    p.add_argument('--seed', type=int, default=0)
+    args = p.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    fake = FakeNIS(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                   drop_rate=args.drop_rate, txs=args.txs, seed=args.seed).start()
+    setup_env(fake)
+    only = set(args.only.split(',')) if args.only else {
+        'encode', 'sign', 'batch', 'transfer_all', 'polling', 'announce', 'account'}
+    results = dict()
+    if 'encode' in only:
+        results['encode'] = bench_encode(args.encodes, args.mosaics)
+    if 'sign' in only:
+        results['sign'] = bench_sign(args.signs, 200)
+    nem = create_nem()
+    if 'batch' in only:
+        results['batch'] = bench_batch(nem, fake, args.batch, args.batch_workers)
+    if 'transfer_all' in only:
+        results['transfer_all'] = bench_transfer_all(nem, fake, args.accounts)
+    if 'announce' in only:
+        results['announce'] = bench_announce(nem, fake, args.announces, args.announce_workers)
+    if 'account' in only:
+        results['account'] = bench_account(nem, fake, args.sends)
+    if 'polling' in only:
+        # Loopはstopで止まるので最後に
+        results['polling'] = bench_polling(nem, fake, args.accounts, args.poll_duration, args.block_time)
+    else:
+        nem.stop()
+
+    output = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'results': results,
+        'server': fake.counters(),
+        'metrics': nem.metrics.snapshot()['counters']}
+    with open(args.output, mode='w') as fp:
+        json.dump(output, fp, indent=2, sort_keys=True, default=str)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    fake.stop()
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        slower = compare(results, baseline['results'], args.tolerance)
+        for path, old, new in slower:
+            print("slower %s %.4f -> %.4f" % (path, old, new))
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+"""
+通信のテスト用の偽NIS、応答は各テストのHandlerで決める
+
+    class Handler(NisHandler):
+        def do_GET(self):
+            self.reply({'height': 100})
+
+    def test(fake_nis):
+        server = fake_nis(Handler, main_net=False)
+        nem = only_peer(NemConnect(main_net=False), server)
+"""
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from tempfile import mkdtemp
+import tempfile
+import threading
+import bjson
+import json
+import os
+import pytest
+
+
+class NisServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    @property
+    def url(self):
+        return 'http', '127.0.0.1', self.server_port
+
+
+class NisHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def parse(self):
+        # (path, query)
+        path = self.path.split('?')[0].lstrip('/')
+        query = dict()
+        if '?' in self.path:
+            query = dict(e.split('=', 1) for e in self.path.split('?', 1)[1].split('&') if '=' in e)
+        return path, query
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+
+    def reply(self, body, code=200, chunked=False):
+        b = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(b), 7):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(b[i:i + 7]), b[i:i + 7]))
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(b)))
+            self.end_headers()
+            self.wfile.write(b)
+
+    def log_message(self, *args):
+        pass
+
+
+def only_peer(nem, server):
+    """ NemConnect/AsyncNemConnectのPeerを偽NISだけにする """
+    for url in nem.peers.sets - {server.url}:
+        del nem.peers[url]
+    return nem
+
+
+def _only_server(monkeypatch, url, main_net):
+    # tmpフォルダを新しくし、そのpeer.jsonをurlのPeerにする
+    tmp_dir = mkdtemp()
+    monkeypatch.setattr(tempfile, 'tempdir', tmp_dir)
+    dir_name = os.path.join(tmp_dir, 'nem_python' + ('' if main_net else '_test'))
+    os.mkdir(dir_name)
+    with open(os.path.join(dir_name, 'peer.json'), mode='bw') as fp:
+        # 5個未満だと既定のPeerが足されるので別のアドレスで埋める(only_peerで消す)
+        bjson.dump({(url[0], '127.0.0.%d' % i, url[2]) for i in range(1, 6)}, fp=fp)
+    return tmp_dir
+
+
+@pytest.fixture
+def fake_nis(monkeypatch):
+    """ handlerで応答する偽NISを立て、tmpフォルダのpeer.jsonをそのPeerにする """
+    servers = list()
+
+    def start(handler, main_net=True):
+        server = NisServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        _only_server(monkeypatch, server.url, main_net)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def fake_chain(monkeypatch):
+    """
+    test/bench/fake_nis.pyのFakeNIS(testnet)、送受金履歴を持ちannounceしたTXは次のBlockで承認される
+    Accountのdbを置くHOMEも一時フォルダにする
+    """
+    from bench.fake_nis import FakeNIS
+    server = FakeNIS(txs=10).start()
+    monkeypatch.setenv('HOME', _only_server(monkeypatch, server.url, main_net=False))
+    yield server
+    server.stop()
@@ -0,0 +1,112 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from binascii import hexlify, unhexlify
+from nem_ed25519.key import secret_key, public_key
+import threading
+import time
+import pytest
+from nem_python.nem_connect import NemConnect, NemConnectError, AnnounceRejectedError
+from nem_python.transaction_builder import TransactionBuilder
+from nem_python.engine.account import Account
+from conftest import only_peer
+
+
+def open_account(fake, monkeypatch):
+    # 偽NISだけなので送信数の制限は外す
+    for name in ('peer_rate', 'peer_burst', 'global_rate', 'global_burst'):
+        monkeypatch.setattr(NemConnect, name, 10000)
+    nem = only_peer(NemConnect(main_net=False), fake)
+    sk = secret_key()
+    pk = public_key(sk)
+    fake.register(pk)
+    account = Account(nem, pk, sk=sk, main_net=False)
+    account.wait_interval = 0.1
+    account.reannounce_interval = 0
+    db = account.create_connect()
+    account._initialize(db)
+    return nem, account, db
+
+
+def outgoing_heights(db, txhash):
+    with db as conn:
+        f = conn.execute("SELECT `height` FROM `outgoing_table` WHERE `txhash` = ?", (unhexlify(txhash),))
+        return [height for (height,) in f.fetchall()]
+
+
+def wait_confirmed(account, fake, timeout=20):
+    # Blockを進めて承認待ちが無くなるまで待つ
+    end = time.time() + timeout
+    while account.waiting_thread is not None and time.time() < end:
+        fake.next_block()
+        time.sleep(0.1)
+    if account.waiting_thread is not None:
+        # 見つからなかった、Wait threadを終わらせる
+        with account.waiting_lock:
+            account.waiting.clear()
+        assert False, 'not confirmed'
+
+
+def test_send_confirm(fake_chain, monkeypatch):
+    nem, account, db = open_account(fake_chain, monkeypatch)
+    txhash = account.send(account.owner_id, fake_chain.other_ck, {'nem:xem': 1000}, only_check=False, db=db)
+    assert outgoing_heights(db, txhash) == [None]
+    # 後から26件以上の送金が同じBlockに入っても、newestの25件より前まで遡って見つける
+    for i in range(30):
+        tx_hex = TransactionBuilder().encode(nem.mosaic_transfer(account.pk, fake_chain.other_ck, {'nem:xem': 2000 + i}))
+        nem.transaction_announce(tx_hex, hexlify(account.signer.sign(unhexlify(tx_hex))).decode())
+    wait_confirmed(account, fake_chain)
+    heights = outgoing_heights(db, txhash)
+    assert len(heights) == 1 and heights[0] is not None
+    db.close()
+    nem.stop()
+
+
+def test_send_unknown_result(fake_chain, monkeypatch):
+    nem, account, db = open_account(fake_chain, monkeypatch)
+    announce = nem.transaction_announce
+    failed = list()
+
+    def timeout(tx_hex, sign_hex):
+        # 受け付けられたか分からない通信エラー
+        if len(failed) == 0:
+            failed.append(tx_hex)
+            raise NemConnectError('read timeout')
+        return announce(tx_hex, sign_hex)
+
+    # 台帳は残し、announceし直して承認を待つ
+    nem.transaction_announce = timeout
+    txhash = account.send(account.owner_id, fake_chain.other_ck, {'nem:xem': 1000}, only_check=False, db=db)
+    assert len(failed) == 1 and outgoing_heights(db, txhash) == [None]
+    wait_confirmed(account, fake_chain)
+    heights = outgoing_heights(db, txhash)
+    assert len(heights) == 1 and heights[0] is not None
+
+    # NISが断った時だけ台帳から戻す
+    def rejected(tx_hex, sign_hex):
+        raise AnnounceRejectedError('FAILURE_INSUFFICIENT_BALANCE')
+
+    nem.transaction_announce = rejected
+    with pytest.raises(AnnounceRejectedError):
+        account.send(account.owner_id, fake_chain.other_ck, {'nem:xem': 1001}, only_check=False, db=db)
+    with db as conn:
+        assert conn.execute("SELECT COUNT(*) FROM `outgoing_table` WHERE `height` IS NULL").fetchone()[0] == 0
+    assert account.waiting_thread is None
+    db.close()
+    nem.stop()
+
+
+def test_send_many(fake_chain, monkeypatch):
+    nem, account, db = open_account(fake_chain, monkeypatch)
+    # newestの25件より多いbatch、1つのWait threadで全て承認される
+    entries = [(fake_chain.other_ck, {'nem:xem': 3000 + i}, b'many %d' % i) for i in range(40)]
+    txhashes = account.send_many(account.owner_id, entries, workers=1, db=db)
+    assert len(set(txhashes)) == 40 and None not in txhashes
+    assert [t.name for t in threading.enumerate()].count('Wait') == 1
+    assert all(outgoing_heights(db, txhash) == [None] for txhash in txhashes)
+    wait_confirmed(account, fake_chain)
+    for txhash in txhashes:
+        heights = outgoing_heights(db, txhash)
+        assert len(heights) == 1 and heights[0] is not None
+    db.close()
+    nem.stop()
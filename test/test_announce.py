@@ -0,0 +1,78 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from binascii import unhexlify
+from Cryptodome.Hash import keccak
+import threading
+import pytest
+from nem_python.nem_connect import NemConnect, NemConnectError, AnnounceRejectedError
+from nem_python.transaction_builder import TransactionBuilder
+from conftest import NisHandler, only_peer
+
+CK = 'TBULEAUG2CZQISUR442HWA6UAKGWIXHDABJVIPS4'
+TX = {'type': 257, 'version': -1744830463, 'signer': 'a' * 64, 'timeStamp': 90000000, 'deadline': 90003600,
+      'recipient': CK, 'amount': 1234567, 'fee': 50000, 'message': {'type': 1, 'payload': '68656c6c6f'}}
+
+
+class Handler(NisHandler):
+    def do_GET(self):
+        self.reply({'height': 100, 'prevBlockHash': {'data': 'ab'}})
+
+    def do_POST(self):
+        body = self.read_json()
+        if body['signature'] == 'ff' * 64:
+            return self.reply({'type': 1, 'code': 5, 'message': 'FAILURE_INSUFFICIENT_BALANCE'})
+        elif body['signature'] == 'ee' * 64:
+            return self.reply({'error': 'Internal Server Error', 'message': 'busy', 'status': 500}, code=500)
+        raw = unhexlify(body['data'])
+        if raw[:4] == b'\x04\x10\x00\x00':
+            inner = raw[64:]
+            txhash, inner_hash = keccak.new(digest_bits=256, data=raw).hexdigest(), \
+                keccak.new(digest_bits=256, data=inner).hexdigest()
+        else:
+            txhash, inner_hash = keccak.new(digest_bits=256, data=raw).hexdigest(), None
+        with self.server.lock:
+            exists = txhash in self.server.hashes
+            self.server.hashes.add(txhash)
+        if exists:
+            self.reply({'type': 1, 'code': 16, 'message': 'FAILURE_HASH_EXISTS'})
+        else:
+            self.reply({'type': 1, 'code': 1, 'message': 'SUCCESS', 'transactionHash': {'data': txhash},
+                        'innerTransactionHash': {'data': inner_hash} if inner_hash else {}})
+
+
+def test(fake_nis):
+    server = fake_nis(Handler, main_net=False)
+    server.hashes = set()
+    server.lock = threading.Lock()
+    nem = only_peer(NemConnect(main_net=False), server)
+
+    # hashはannounce前に決まり、NISの返す値と同じ
+    tb = TransactionBuilder()
+    tx_hex = tb.encode(TX)
+    assert tb.inner_txhash is None
+    assert nem.transaction_announce(tx_hex, '00' * 64) == tb.txhash
+    # POSTの応答時間もPeerの状態に入る
+    assert nem.peers.status[server.url].latency is not None
+    labels = [e for e, h in nem.metrics.snapshot()['histograms']['nem_request_seconds']]
+    assert {'method': 'POST', 'call': 'transaction/announce'} in labels
+    assert all('peer' not in e for e in labels)
+    # 同じTXの再announceも成功
+    assert nem.transaction_announce(tx_hex, '00' * 64) == tb.txhash
+    assert nem.announce_log[-1]['results'][0]['message'] == 'FAILURE_HASH_EXISTS'
+
+    # マルチシグはinner transactionのhash
+    wrap = {'type': 4100, 'version': -1744830463, 'signer': 'b' * 64, 'timeStamp': 90000000,
+            'deadline': 90003600, 'fee': 150000, 'otherTrans': TX}
+    tx_hex = tb.encode(wrap)
+    assert tb.inner_txhash == keccak.new(digest_bits=256, data=TransactionBuilder().encode_raw(TX)).hexdigest()
+    assert nem.transaction_announce(tx_hex, '00' * 64) == tb.inner_txhash
+    assert nem.transaction_announce(tx_hex, '00' * 64) == tb.inner_txhash
+
+    # NISが断った時だけAnnounceRejectedError、5xxは受け付けられたか分からない
+    with pytest.raises(AnnounceRejectedError):
+        nem.transaction_announce(tx_hex, 'ff' * 64)
+    with pytest.raises(NemConnectError) as e:
+        nem.transaction_announce(tx_hex, 'ee' * 64)
+    assert not isinstance(e.value, AnnounceRejectedError)
+    nem.stop()
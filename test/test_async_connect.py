@@ -0,0 +1,158 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import pytest
+from binascii import unhexlify
+from nem_python.async_connect import AsyncNemConnect
+from nem_python.nem_connect import NemConnectError, AnnounceRejectedError
+from nem_python.transaction_builder import TransactionBuilder, announce_hash
+from conftest import NisHandler, only_peer
+
+TX = {'type': 257, 'version': 1744830465, 'signer': 'a' * 64, 'timeStamp': 90000000, 'deadline': 90003600,
+      'recipient': 'NBULEAUG2CZQISUR442HWA6UAKGWIXHDABJVIPS4', 'amount': 1, 'fee': 50000,
+      'message': {'type': 1, 'payload': ''}}
+
+
+class Handler(NisHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0].lstrip('/')
+        if path in ('chain/last-block', 'node/active-peers/max-chain-height'):
+            self.reply({'height': 100})
+        elif path == 'account/get':
+            self.reply({'account': {'address': self.path.split('address=')[1]}})
+        elif path == 'account/transfers/incoming':
+            # 3ページ目で終わり
+            page = int(self.path.split('id=')[1]) - 1 if 'id=' in self.path else 30
+            self.reply({'data': [{'meta': {'id': i}} for i in range(page, page - 10, -1) if i > 10]})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = self.read_json()
+        txhash = announce_hash(unhexlify(body['data']))
+        self.reply({'message': 'SUCCESS', 'transactionHash': {'data': txhash}}, chunked=True)
+
+
+def test(fake_nis):
+    server = fake_nis(Handler)
+
+    async def main():
+        nem = only_peer(AsyncNemConnect(), server)
+        assert await nem.connect() == 100
+        infos = await asyncio.gather(*[nem.get_account_info('N%d' % i) for i in range(50)])
+        assert [e['account']['address'] for e in infos] == ['N%d' % i for i in range(50)]
+        history = await nem.get_account_transfer_all('N0')
+        assert [e['meta']['id'] for e in history] == list(range(30, 10, -1))
+        tb = TransactionBuilder()
+        tx_hex = tb.encode(TX)
+        assert await nem.transaction_announce(tx_hex, '00' * 64) == tb.txhash
+        counters = nem.http.counters()
+        print(counters)
+        assert counters['reused'] > counters['opened']
+        nem.close()
+
+    asyncio.new_event_loop().run_until_complete(main())
+
+
+class MosaicHandler(NisHandler):
+    def do_GET(self):
+        path, query = self.parse()
+        self.server.calls.append(path)
+        if path in ('chain/last-block', 'node/active-peers/max-chain-height'):
+            self.reply({'height': 100})
+        elif path == 'namespace/mosaic/definition/page':
+            self.reply({'data': [] if 'id' in query else [{'meta': {'id': 1}, 'mosaic': {
+                'id': {'namespaceId': 'bench', 'name': 'coin'}, 'levy': {},
+                'properties': [{'name': 'divisibility', 'value': '0'},
+                               {'name': 'supplyMutable', 'value': 'false'}]}}]})
+        elif path == 'mosaic/supply':
+            self.reply({'mosaicId': query['mosaicId'], 'supply': 1000000})
+        else:
+            self.send_error(404)
+
+
+def test_mosaic_cache(fake_nis):
+    server = fake_nis(MosaicHandler)
+    server.calls = list()
+
+    async def main():
+        nem = only_peer(AsyncNemConnect(), server)
+        await nem.connect()
+        for dummy in range(3):
+            assert 'bench:coin' in await nem.get_namespace2definition('bench')
+            assert await nem.get_mosaic_supply('bench:coin') == 1000000
+        # NemConnectと同じ上限付きキャッシュ、2回目以降は通信しない
+        assert server.calls.count('namespace/mosaic/definition/page') == 2
+        assert server.calls.count('mosaic/supply') == 1
+        nem.close()
+        return nem.mosaic_cache.path
+
+    path = asyncio.new_event_loop().run_until_complete(main())
+    assert os.path.exists(path)
+
+
+def test_lagging_peer(fake_nis):
+    # 遅れたPeerしか無ければ各Peer1回でエラー
+    server = fake_nis(MosaicHandler)
+    server.calls = list()
+
+    async def main():
+        nem = only_peer(AsyncNemConnect(), server)
+        nem.height = 200
+        try:
+            await nem._random_choice_url()
+        except NemConnectError:
+            pass
+        else:
+            raise AssertionError('lagging peer is chosen')
+        nem.close()
+
+    asyncio.new_event_loop().run_until_complete(main())
+    assert server.calls == ['chain/last-block']
+
+
+class AnnounceHandler(NisHandler):
+    def do_GET(self):
+        self.reply({'height': 100})
+
+    def do_POST(self):
+        body = self.read_json()
+        if body['signature'] == 'ff' * 64:
+            return self.reply({'type': 1, 'code': 5, 'message': 'FAILURE_INSUFFICIENT_BALANCE'})
+        elif body['signature'] == 'ee' * 64:
+            return self.reply({'error': 'Internal Server Error', 'message': 'busy', 'status': 500}, code=500)
+        txhash = announce_hash(unhexlify(body['data']))
+        if txhash in self.server.hashes:
+            self.reply({'type': 1, 'code': 16, 'message': 'FAILURE_HASH_EXISTS'})
+        else:
+            self.server.hashes.add(txhash)
+            self.reply({'type': 1, 'code': 1, 'message': 'SUCCESS', 'transactionHash': {'data': txhash},
+                        'innerTransactionHash': {}})
+
+
+def test_announce_again(fake_nis):
+    server = fake_nis(AnnounceHandler)
+    server.hashes = set()
+    tb = TransactionBuilder()
+    tx_hex = tb.encode(TX)
+
+    async def main():
+        nem = only_peer(AsyncNemConnect(), server)
+        await nem.connect()
+        # NemConnectと同じく、受付済みのTXの再announceも手元のhashで成功
+        assert await nem.transaction_announce(tx_hex, '00' * 64) == tb.txhash
+        assert await nem.transaction_announce(tx_hex, '00' * 64) == tb.txhash
+        with pytest.raises(AnnounceRejectedError):
+            await nem.transaction_announce(tx_hex, 'ff' * 64)
+        try:
+            await nem.transaction_announce(tx_hex, 'ee' * 64)
+            assert False
+        except AnnounceRejectedError:
+            assert False
+        except NemConnectError:
+            pass
+        nem.close()
+
+    asyncio.new_event_loop().run_until_complete(main())
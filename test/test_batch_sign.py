@@ -0,0 +1,66 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from binascii import unhexlify
+from nem_ed25519.key import secret_key, public_key
+from nem_ed25519.signature import verify
+import pytest
+from nem_python.batch_sign import batch_sign, send_fee, levy_fee, BatchSignError
+from nem_python.transaction_builder import TransactionBuilder, tx_hash
+from nem_python.signer import Signer
+
+CK = 'TBULEAUG2CZQISUR442HWA6UAKGWIXHDABJVIPS4'
+SNAPSHOT = {'main_net': False, 'retention': 7200, 'mosaics': {
+    'nem:xem': {'divisibility': 6, 'supply': 8999999999, 'levy': {}},
+    'bench:coin': {'divisibility': 0, 'supply': 1000000, 'levy': {
+        'type': 2, 'fee': 100, 'recipient': CK, 'mosaicId': {'namespaceId': 'nem', 'name': 'xem'}}}}}
+
+
+def test_fee():
+    assert send_fee(SNAPSHOT, {'nem:xem': 10 ** 12}) == {'nem:xem': 1250000}
+    assert send_fee(SNAPSHOT, {'nem:xem': 10 ** 6, 'bench:coin': 10}) == {'nem:xem': 100000}
+    assert levy_fee(SNAPSHOT, {'nem:xem': 10 ** 6, 'bench:coin': 1000}) == {'nem:xem': 10}
+    with pytest.raises(BatchSignError):
+        send_fee(SNAPSHOT, {'unknown:coin': 1})
+
+
+def test_batch_sign():
+    sk = secret_key()
+    pk = public_key(sk)
+    entries = [(CK, {'nem:xem': i + 1}, b'pay %d' % i) for i in range(6)]
+    entries.append((CK, {'bench:coin': 1000}, b''))
+    signer = Signer(sk, pk)
+    signed = batch_sign(SNAPSHOT, signer, entries, workers=2)
+    assert len(signed) == len(entries)
+    tb = TransactionBuilder()
+    for (ck, mosaics, msg), (tx_dict, tx_hex, sign_hex, txhash, fee) in zip(entries, signed):
+        # 順番通り、署名とhashが正しい
+        raw = unhexlify(tx_hex)
+        verify(msg=raw, sign=unhexlify(sign_hex), pk=pk)
+        assert txhash == tx_hash(raw)
+        tx = tb.decode(raw)
+        assert tx['recipient'] == ck and tx['message'].get('payload', '') == msg.hex()
+    assert signed[0][0]['amount'] == 1 and signed[0][4] == {'nem:xem': 50000 + 50000}
+    assert signed[-1][0]['mosaics'][0]['quantity'] == 1000 and signed[-1][4] == {'nem:xem': 350000 + 10}
+
+    # timeStampは全て同じ
+    assert len({tx_dict['timeStamp'] for tx_dict, tx_hex, sign_hex, txhash, fee in signed}) == 1
+
+    # 同じ内容のTXは1つしか承認されない、別Processで作っても同じhash
+    with pytest.raises(BatchSignError):
+        batch_sign(SNAPSHOT, signer, [entries[0], entries[0]], workers=1)
+    with pytest.raises(BatchSignError):
+        batch_sign(SNAPSHOT, signer, [entries[0], entries[1], entries[0]], workers=2, chunksize=1)
+
+
+def test_pool_reuse():
+    from nem_python import batch_sign as bs
+    sk = secret_key()
+    signer = Signer(sk, public_key(sk))
+    entries = [(CK, {'nem:xem': i + 1}, b'') for i in range(4)]
+    bs.batch_sign(SNAPSHOT, signer, entries, workers=2)
+    pool = bs._pools[2]
+    bs.batch_sign(SNAPSHOT, signer, entries[:2], workers=2)
+    assert bs._pools[2] is pool
+    bs.close_pool()
+    assert len(bs._pools) == 0
@@ -0,0 +1,53 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from nem_python.nem_connect import NemConnect
+from conftest import NisHandler, only_peer
+
+NUM = 60  # 1アカウントのTX数
+
+
+class Handler(NisHandler):
+    def do_GET(self):
+        path, query = self.parse()
+        if path in ('chain/last-block', 'node/active-peers/max-chain-height'):
+            self.reply({'height': 100})
+            return
+        server = self.server
+        with server.lock:
+            server.inflight += 1
+            server.max_inflight = max(server.max_inflight, server.inflight)
+        time.sleep(0.01)
+        ck = query['address']
+        cursor = int(query.get('id', NUM + 1))
+        with server.lock:
+            server.inflight -= 1
+            # 同じアカウントのpageは順番に来る
+            assert server.cursors.get(ck, NUM + 1) == cursor
+            ids = list(range(cursor - 1, max(cursor - 26, 0), -1))
+            server.cursors[ck] = ids[-1] if ids else 0
+        self.reply({'data': [{'meta': {'id': i, 'height': i, 'hash': {'data': '%s%d' % (ck, i)}}} for i in ids]})
+
+
+def test(fake_nis, monkeypatch):
+    server = fake_nis(Handler)
+    server.inflight = 0
+    server.max_inflight = 0
+    server.cursors = dict()  # ck: 前回返した最後のid
+    server.lock = threading.Lock()
+
+    monkeypatch.setattr(NemConnect, 'peer_rate', 1000)
+    monkeypatch.setattr(NemConnect, 'peer_burst', 1000)
+    nem = only_peer(NemConnect(), server)
+    nem.bulk_peer_limit = 3
+    reports = list()
+    cks = ['N%d' % i for i in range(20)]
+    result = nem.sync_histories(cks, progress=reports.append)
+    assert result == {(ck, nem.TRANSFER_INCOMING): True for ck in cks}
+    assert 1 < server.max_inflight <= 3
+    assert [r['done'] for r in reports] == list(range(1, 21))
+    assert nem.sync_report['txs'] == NUM * 20 and nem.sync_report['requests'] == 4 * 20
+    assert [e['meta']['id'] for e in nem.history.read(nem.TRANSFER_INCOMING, 'N7')] == list(range(NUM, 0, -1))
+    nem.stop()
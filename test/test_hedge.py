@@ -0,0 +1,58 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+import time
+from nem_python.nem_connect import NemConnect
+from nem_python.utils import HedgeDelay
+from conftest import NisHandler, only_peer
+
+
+def test_delay():
+    hedge = HedgeDelay(default=1.0, floor=0.2)
+    assert hedge.delay('chain/last-block', cap=2.5) == 1.0
+    # 1つの遅い応答では変わらない
+    hedge.record('chain/last-block', 9.0)
+    assert hedge.delay('chain/last-block', cap=2.5) == 1.0
+    for dummy in range(30):
+        hedge.record('chain/last-block', 0.05)
+    assert hedge.delay('chain/last-block', cap=2.5) == 0.2
+    # 他のcallの応答時間は入らない、遅くてもtimeoutから決まる上限まで
+    for dummy in range(30):
+        hedge.record('account/transfers/outgoing', 8.0)
+    assert hedge.delay('chain/last-block', cap=2.5) == 0.2
+    assert hedge.delay('account/transfers/outgoing', cap=2.5) == 2.5
+
+
+class Handler(NisHandler):
+    def do_GET(self):
+        path, query = self.parse()
+        if path == 'account/get':
+            time.sleep(self.server.stall)
+            self.reply({'account': {'address': query['address'], 'port': self.server.server_port}})
+        else:
+            self.reply({'height': 100, 'prevBlockHash': {'data': 'ab'}})
+
+
+def test_hedge(fake_nis):
+    stalled = fake_nis(Handler, main_net=False)
+    stalled.stall = 3.0
+    fast = fake_nis(Handler, main_net=False)
+    fast.stall = 0.0
+    nem = only_peer(NemConnect(main_net=False), fast)
+    nem.peers.add(stalled.url)
+    nem.hedged = True
+    nem.hedge.default = 0.3
+    # 最初は止まったPeerを選ぶ
+    order = [stalled.url, fast.url]
+    nem._random_choice_url = lambda: order.pop(0) if order else fast.url
+
+    delay = nem.hedge.delay('account/get', cap=nem.timeout * nem.hedge_max_ratio)
+    begin = time.time()
+    info = nem.get_account_info('TA')
+    elapsed = time.time() - begin
+    assert info['account']['port'] == fast.server_port
+    assert delay <= elapsed < delay + 0.5
+    # 記録されるのは先に返った速い応答だけ
+    latencies = list(nem.hedge.latencies['account/get'])
+    assert len(latencies) == 1 and latencies[0] < 0.5
+    nem.stop()
@@ -0,0 +1,71 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from tempfile import mkdtemp
+import os
+from nem_python.history_store import HistoryStore
+
+
+class FakeNis:
+    # idが新しい程大きい、1page 25件
+    def __init__(self, num):
+        self.ids = list(range(num, 0, -1))
+        self.pages = 0
+
+    def iterate(self, cursor):
+        while True:
+            self.pages += 1
+            ids = self.ids if cursor is None else [i for i in self.ids if i < cursor]
+            if len(ids) == 0:
+                return
+            for i in ids[:25]:
+                yield {'meta': {'id': i, 'height': i * 10}}
+            cursor = ids[:25][-1]
+
+    def add(self, num):
+        top = self.ids[0] if self.ids else 0
+        self.ids = list(range(top + num, top, -1)) + self.ids
+
+
+def sync(store, nis, c=100):
+    return store.sync(kind='account/transfers/incoming', ck='NCK', iterate=nis.iterate,
+                      key=lambda e: e['meta']['id'], height=lambda e: e['meta']['height'], limit=c * 25)
+
+
+def ids(store):
+    return [e['meta']['id'] for e in store.read(kind='account/transfers/incoming', ck='NCK')]
+
+
+def test_incremental():
+    store = HistoryStore(os.path.join(mkdtemp(), 'history.db'))
+    nis = FakeNis(60)
+    # 途中で止まっても続きから
+    assert not sync(store, nis, c=2)
+    assert ids(store) == list(range(60, 10, -1))
+    assert sync(store, nis)
+    assert ids(store) == list(range(60, 0, -1))
+    # 新しい分だけ取得
+    nis.add(3)
+    nis.pages = 0
+    assert sync(store, nis)
+    assert nis.pages == 1 and ids(store) == list(range(63, 0, -1))
+    # 差が大きくc pageで追いつかない
+    nis.add(80)
+    assert not sync(store, nis, c=2)
+    assert sync(store, nis)
+    assert ids(store) == list(range(143, 0, -1))
+    assert [e['meta']['id'] for e in store.iter_read(
+        kind='account/transfers/incoming', ck='NCK', oldest_first=True, batch=7)] == list(range(1, 144))
+
+
+def test_evict():
+    store = HistoryStore(os.path.join(mkdtemp(), 'history.db'))
+    sync(store, FakeNis(30))
+    store.sync(kind='account/harvests', ck='NCK', iterate=FakeNis(30).iterate,
+               key=lambda e: e['meta']['id'], height=lambda e: e['meta']['height'])
+    size = store.total_size()
+    assert size > 0
+    assert store.evict(size) == []
+    store.read(kind='account/transfers/incoming', ck='NCK')
+    assert store.evict(size - 1) == [('account/harvests', 'NCK')]
+    assert len(ids(store)) == 30
@@ -0,0 +1,53 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import time
+from nem_python.metrics import Metrics, TimedConnection
+from nem_python.utils import QueueSystem
+
+
+def test_registry():
+    m = Metrics(buckets=(0.1, 1.0))
+    m.inc('nem_request_errors_total', call='chain/height', peer='127.0.0.1:7890')
+    m.inc('nem_request_errors_total', call='chain/height', peer='127.0.0.1:7890')
+    m.set('nem_queue_depth', 3, queue='received')
+    m.observe('nem_request_seconds', 0.05, call='chain/height')
+    m.observe('nem_request_seconds', 0.5, call='chain/height')
+    with m.timer('nem_request_seconds', call='chain/height'):
+        time.sleep(0.01)
+
+    snap = m.snapshot()
+    assert snap['counters']['nem_request_errors_total'] == [({'call': 'chain/height', 'peer': '127.0.0.1:7890'}, 2)]
+    assert snap['gauges']['nem_queue_depth'] == [({'queue': 'received'}, 3)]
+    labels, h = snap['histograms']['nem_request_seconds'][0]
+    assert h['count'] == 3 and h['buckets'] == {0.1: 2, 1.0: 3}
+
+    text = m.prometheus()
+    assert '# TYPE nem_request_errors_total counter' in text
+    assert 'nem_request_errors_total{call="chain/height",peer="127.0.0.1:7890"} 2' in text
+    assert 'nem_request_seconds_bucket{call="chain/height",le="+Inf"} 3' in text
+    assert 'nem_request_seconds_count{call="chain/height"} 3' in text
+
+
+def test_queue_drop():
+    m = Metrics()
+    qs = QueueSystem(metrics=m, name='received')
+    qs.create()
+    for i in range(26):
+        qs.broadcast(i)
+    snap = m.snapshot()
+    assert snap['counters']['nem_queue_dropped_total'] == [({'queue': 'received'}, 1)]
+    assert snap['gauges']['nem_queue_listeners'] == [({'queue': 'received'}, 0)]
+
+
+def test_timed_connection():
+    m = Metrics()
+    db = sqlite3.connect(':memory:', factory=TimedConnection)
+    db.metrics = m
+    db.execute("CREATE TABLE `t` (`a` INTEGER)")
+    db.execute("    ")
+    db.executemany("INSERT INTO `t` VALUES (?)", [(1,), (2,)])
+    assert db.execute("select count(*) from `t`").fetchone()[0] == 2
+    ops = {labels['op'] for labels, h in m.snapshot()['histograms']['account_sql_seconds']}
+    assert ops == {'CREATE', 'INSERT', 'SELECT', 'EMPTY'}
@@ -0,0 +1,37 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from tempfile import mkdtemp
+import os
+import time
+from nem_python.utils import MosaicCache
+
+
+def test_cache():
+    path = os.path.join(mkdtemp(), 'mosaic.json')
+    cache = MosaicCache(path)
+    cache.maxsize = 2
+    assert cache.get_definition('a') is None
+    cache.put_definition('a', {'a:x': 1})
+    cache.put_definition('b', {'b:x': 1})
+    assert cache.get_definition('a') == {'a:x': 1}
+    cache.put_definition('c', {'c:x': 1})
+    # 最近使っていないbから消える
+    assert cache.get_definition('b') is None
+    assert cache.get_definition('a') is not None
+
+    cache.put_supply('a:x', 100, height=10, mutable=False)
+    cache.put_supply('c:x', 200, height=10, mutable=True)
+    assert cache.get_supply('a:x', height=1000) == 100
+    assert cache.get_supply('c:x', height=15) == 200
+    assert cache.get_supply('c:x', height=20) is None
+    cache.supplies['c:x'][1] = time.time() - cache.supply_ttl
+    assert cache.get_supply('c:x', height=10) is None
+
+    # 再起動後も使える
+    cache.save()
+    cache = MosaicCache(path)
+    assert cache.get_definition('a') == {'a:x': 1}
+    assert cache.get_supply('a:x', height=1000) == 100
+    cache.definitions['a'][1] = time.time() - cache.ttl
+    assert cache.get_definition('a') is None
@@ -0,0 +1,114 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from nem_python.utils import PeerStorage, PeerStatus
+from nem_python.nem_connect import NemConnect, NemConnectError
+from collections import Counter
+import pytest
+from tempfile import mkdtemp
+import os
+
+
+def get_storage(num=10):
+    peers = PeerStorage(path=os.path.join(mkdtemp(), 'peer.json'))
+    peers.update([('http', '10.0.0.%d' % i, 7890) for i in range(num)])
+    return peers
+
+
+def test_weighted_choice():
+    peers = get_storage()
+    fast, slow = ('http', '10.0.0.0', 7890), ('http', '10.0.0.9', 7890)
+    for dummy in range(5):
+        peers.report(fast, ok=True, latency=0.05)
+        peers.report(slow, ok=False, latency=3.0)
+    count = Counter(peers.random() for dummy in range(5000))
+    print(count[fast], count[slow])
+    # slowは自分同士で選ばれた時だけ(約1%)
+    assert count[slow] < 5000 * 0.03
+    assert count[fast] > count[slow] * 2
+
+
+def test_remove_and_reload():
+    peers = get_storage()
+    del peers[('http', '10.0.0.3', 7890)]
+    del peers[('http', '10.0.0.9', 7890)]
+    assert len(peers) == len(peers.order) == 8
+    assert all(peers.order[i] == url for url, i in peers.position.items())
+    peers.save()
+    assert len(PeerStorage(path=peers.path)) == 8
+
+
+def test_circuit_breaker():
+    peers = get_storage(num=2)
+    bad, good = ('http', '10.0.0.0', 7890), ('http', '10.0.0.1', 7890)
+    mtime = os.stat(peers.path).st_mtime
+    for dummy in range(PeerStatus.threshold):
+        peers.failure(bad)
+    assert peers.status[bad].state() == PeerStatus.OPEN
+    assert all(peers.random() == good for dummy in range(100))
+
+    # backoffが過ぎればhalf-openで1回だけ試される
+    peers.status[bad].open_until = 0.0
+    assert peers.status[bad].state() == PeerStatus.HALF_OPEN
+    del peers[good]
+    assert peers.random() == bad
+    assert peers.status[bad].state() == PeerStatus.OPEN
+    peers.report(bad, ok=True, latency=0.1)
+    assert peers.status[bad].state() == PeerStatus.CLOSED
+
+    # 連続して失敗し続けたPeerだけ削除、保存は後でまとめて
+    for dummy in range(PeerStorage.max_failures):
+        peers.failure(bad)
+    assert bad not in peers
+    assert peers.save_timer is not None
+    assert os.stat(peers.path).st_mtime == mtime
+
+
+def test_lagging_peer():
+    peers = get_storage(num=1)
+    url = ('http', '10.0.0.0', 7890)
+    for dummy in range(PeerStatus.threshold):
+        # 応答は正常でもBlock高の遅れは数え続ける
+        peers.report(url, ok=True, latency=0.1, height=100)
+        peers.lagging(url)
+    assert peers.status[url].state() == PeerStatus.OPEN
+    peers.caught_up(url)
+    assert peers.status[url].state() == PeerStatus.CLOSED
+    for dummy in range(PeerStorage.max_failures):
+        peers.report(url, ok=True, latency=0.1, height=100)
+        peers.lagging(url)
+    assert url not in peers
+
+
+class Block:
+    ok = True
+
+    def json(self):
+        return {'height': 100}
+
+
+def test_random_choice_lagging():
+    # 全Peerが遅れていても無限に問い合わせず、各Peer1回でエラー
+    nem = NemConnect.__new__(NemConnect)
+    nem.peers = get_storage(num=3)
+    nem.height = 200
+    calls = list()
+
+    def get(call, url, data=None):
+        calls.append(url)
+        nem.peers.report(url, ok=True, latency=0.01, height=100)
+        return Block()
+
+    nem._get = get
+    with pytest.raises(NemConnectError):
+        nem._random_choice_url()
+    assert sorted(calls) == sorted(nem.peers.sets)
+    assert all(status.lags == 1 for status in nem.peers.status.values())
+
+
+if __name__ == '__main__':
+    test_weighted_choice()
+    test_remove_and_reload()
+    test_circuit_breaker()
+    test_lagging_peer()
+    test_random_choice_lagging()
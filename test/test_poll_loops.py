@@ -0,0 +1,109 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+from nem_python.nem_connect import NemConnect
+from nem_python.metrics import Metrics
+from conftest import NisHandler, only_peer
+
+A = 'TA' + 'A' * 38
+B = 'TB' + 'B' * 38
+LOOPS = ('PeerUpdate', 'MultisigCheck', 'ReceiveCheck', 'HeightCheck')
+
+
+class ChainHandler(NisHandler):
+    def do_GET(self):
+        path, query = self.parse()
+        server = self.server
+        if path in ('chain/last-block', 'node/active-peers/max-chain-height', 'chain/height'):
+            self.reply({'height': server.height, 'prevBlockHash': {'data': '%064x' % (server.height - 1)}})
+        elif path in ('account/transfers/incoming', 'account/unconfirmedTransactions'):
+            with server.lock:
+                server.calls.append((path, query['address'], server.height))
+            self.reply({'data': []})
+        else:
+            self.send_error(404)
+
+
+def polls(server, path):
+    with server.lock:
+        return [(ck, height) for p, ck, height in server.calls if p == path]
+
+
+def wait_polls(server, path, count, timeout=3.0):
+    end = time.time() + timeout
+    while len(polls(server, path)) < count and time.time() < end:
+        time.sleep(0.02)
+    time.sleep(0.2)  # 余計なPollが無いことも見る
+    return polls(server, path)
+
+
+def test_block_driven(fake_nis):
+    server = fake_nis(ChainHandler, main_net=False)
+    server.height = 100
+    server.calls = list()
+    server.lock = threading.Lock()
+    nem = only_peer(NemConnect(main_net=False), server)
+    nem.block_interval = 0.05
+    nem.mempool_min_interval = 0.05
+    nem.mempool_max_interval = 0.2
+    nem.confirmed_max_skip = 1
+    nem.single_flight.window = 0.0
+    nem.monitor_cks.append(A)
+    nem.start()
+
+    # 新しいBlockが来るまで承認済みTXは確認しない、未承認TXは自分の間隔で確認する
+    time.sleep(0.3)
+    assert polls(server, 'account/transfers/incoming') == []
+    assert (A, 100) in polls(server, 'account/unconfirmedTransactions')
+
+    # Block毎に1回ずつ
+    for height in (101, 102, 103):
+        server.height = height
+        assert wait_polls(server, 'account/transfers/incoming', height - 100) == \
+            [(A, h) for h in range(101, height + 1)]
+
+    # 後から加えたアドレスも次のBlockから確認する
+    nem.monitor_cks.append(B)
+    server.height = 104
+    incoming = wait_polls(server, 'account/transfers/incoming', 5)
+    assert sorted(incoming[3:]) == [(A, 104), (B, 104)]
+    assert (B, 104) in wait_polls(server, 'account/unconfirmedTransactions', 0)
+
+    # Sweep毎の所要時間とアドレス数
+    assert nem.poll_stats['received']['sweeps'] == 4 and nem.poll_stats['received']['addresses'] == 1
+    assert nem.poll_stats['multisig']['sweeps'] > 0
+    loops = {labels['loop'] for labels, h in nem.metrics.snapshot()['histograms']['nem_poll_sweep_seconds']}
+    assert loops == {'received', 'multisig'}
+
+    # stop()ですぐに全てのLoopが終わる
+    begin = time.time()
+    nem.stop()
+    for thread in threading.enumerate():
+        if thread.name in LOOPS:
+            thread.join(timeout=2.0)
+            assert not thread.is_alive(), thread.name
+    assert time.time() - begin < 1.0
+    count = len(server.calls)
+    time.sleep(0.3)
+    assert len(server.calls) == count
+
+
+def test_sweep_budget(caplog):
+    nem = NemConnect.__new__(NemConnect)
+    nem.metrics = Metrics()
+    nem.poll_stats = dict()
+    # Loop毎の時間で警告、承認済みTXはBlock間隔、未承認TXはmempool_max_interval
+    with caplog.at_level(logging.WARNING):
+        nem._record_sweep('received', 40.0, 300, budget=60)
+        nem._record_sweep('multisig', 40.0, 300, budget=30)
+    assert [r.getMessage().split()[1] for r in caplog.records] == ['multisig']
+    nem._record_sweep('received', 10.0, 200, budget=60)
+    stats = nem.poll_stats['received']
+    assert stats['sweeps'] == 2 and stats['max'] == 40.0 and stats['last'] == 10.0 and stats['addresses'] == 200
+    snap = nem.metrics.snapshot()
+    assert ({'loop': 'received'}, 200) in snap['gauges']['nem_poll_addresses']
+    h = dict((labels['loop'], h) for labels, h in snap['histograms']['nem_poll_sweep_seconds'])
+    assert h['received']['count'] == 2 and h['multisig']['count'] == 1
@@ -0,0 +1,167 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from socketserver import ThreadingTCPServer, BaseRequestHandler
+import threading
+import hashlib
+import base64
+import struct
+import socket
+import json
+import time
+from nem_python.nem_connect import NemConnect
+from conftest import NisHandler, only_peer
+
+CK = 'TBULEAUG2CZQISUR442HWA6UAKGWIXHDABJVIPS4'
+SIGNER = 'a' * 64
+HEIGHT = [100]
+
+
+class Handler(NisHandler):
+    def do_GET(self):
+        path = self.parse()[0]
+        if path in ('chain/last-block', 'node/active-peers/max-chain-height'):
+            self.reply({'height': HEIGHT[0], 'prevBlockHash': {'data': 'ab'}})
+        elif path == 'account/get':
+            self.reply({
+                'account': {'multisigInfo': {'cosignatoriesCount': 2, 'minCosignatories': 2}},
+                'meta': {'cosignatories': [{'address': 'A'}, {'address': 'B'}]}})
+        else:
+            self.reply({'data': []})
+
+
+class StompServer(ThreadingTCPServer):
+    """ NISのWebsocket(STOMP)の代わり """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StompHandler)
+        self.clients = list()
+        self.subscriptions = set()
+
+    def push(self, destination, body):
+        frame = 'MESSAGE\ndestination:%s\nsubscription:sub-0\n\n%s\x00' % (destination, json.dumps(body))
+        for client in list(self.clients):
+            client.send_frame(frame.encode())
+
+    def drop(self):
+        for client in list(self.clients):
+            client.request.shutdown(socket.SHUT_RDWR)
+
+
+class StompHandler(BaseRequestHandler):
+    def handle(self):
+        header = b''
+        while b'\r\n\r\n' not in header:
+            header += self.request.recv(1024)
+        key = [line.split(b': ')[1] for line in header.split(b'\r\n') if line.startswith(b'Sec-WebSocket-Key')][0]
+        accept = base64.b64encode(hashlib.sha1(key + b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11').digest())
+        self.request.sendall(
+            b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+            b'Connection: Upgrade\r\nSec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        self.server.clients.append(self)
+        try:
+            while True:
+                for frame in self.recv_frame().split(b'\x00'):
+                    command = frame.split(b'\n')[0]
+                    if command == b'CONNECT':
+                        self.send_frame(b'CONNECTED\nversion:1.1\n\n\x00')
+                    elif command == b'SUBSCRIBE':
+                        headers = dict(line.split(b':', 1) for line in frame.split(b'\n')[1:] if b':' in line)
+                        self.server.subscriptions.add(headers[b'destination'].decode())
+        except Exception:
+            pass
+        finally:
+            self.server.clients.remove(self)
+
+    def recv_exact(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def recv_frame(self):
+        b0, b1 = self.recv_exact(2)
+        length = b1 & 0x7f
+        if length == 126:
+            length = struct.unpack('>H', self.recv_exact(2))[0]
+        mask = self.recv_exact(4)
+        if b0 & 0x0f == 0x8:
+            raise ConnectionError
+        return bytes(b ^ mask[i % 4] for i, b in enumerate(self.recv_exact(length)))
+
+    def send_frame(self, payload):
+        if len(payload) < 126:
+            header = struct.pack('>BB', 0x81, len(payload))
+        else:
+            header = struct.pack('>BBH', 0x81, 126, len(payload))
+        self.request.sendall(header + payload)
+
+
+def wait_until(fn, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        if fn():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test(fake_nis):
+    server = fake_nis(Handler, main_net=False)
+    stomp = StompServer()
+    threading.Thread(target=stomp.serve_forever, daemon=True).start()
+
+    nem = only_peer(NemConnect(main_net=False), server)
+    nem.ws_port = stomp.server_address[1]
+    nem.monitor_cks.append(CK)
+    received = nem.received_que.create()
+    multisig = nem.multisig_que.create()
+    nem.start(push=True)
+    assert wait_until(lambda: nem.push_active.is_set() and '/unconfirmed/' + CK in stomp.subscriptions)
+    assert {'/blocks/new', '/transactions/' + CK} <= stomp.subscriptions
+
+    # 新Block
+    HEIGHT[0] = 120
+    stomp.push('/blocks/new', {'height': 120})
+    assert wait_until(lambda: nem.blocks.height == 120)
+
+    # 入金、同じTXは一度だけ通知
+    tx = {
+        'meta': {'innerHash': {}, 'id': 1, 'hash': {'data': 'ff' * 32}, 'height': 121},
+        'transaction': {
+            'type': 257, 'version': -1744830463, 'timeStamp': 0, 'deadline': 3600, 'signer': SIGNER,
+            'recipient': CK, 'amount': 1000000, 'fee': 50000, 'message': {}, 'signature': '00'}}
+    stomp.push('/transactions/' + CK, tx)
+    stomp.push('/transactions/' + CK, tx)
+    r = received.get(timeout=5)
+    assert r['txhash'] == 'ff' * 32 and r['coin'] == {'nem:xem': 1000000}
+    time.sleep(0.5)
+    assert received.empty()
+
+    # 送金は通知しない
+    out_tx = json.loads(json.dumps(tx))
+    out_tx['meta']['hash']['data'] = 'ee' * 32
+    out_tx['transaction']['recipient'] = 'TOTHER'
+    stomp.push('/transactions/' + CK, out_tx)
+    time.sleep(0.5)
+    assert received.empty()
+
+    # 未承認マルチシグ
+    inner = dict(tx['transaction'], recipient='TOTHER')
+    stomp.push('/unconfirmed/' + CK, {
+        'meta': {'innerHash': {}, 'id': 0, 'hash': {'data': 'dd' * 32}, 'height': 9223372036854775807},
+        'transaction': {'type': 4100, 'otherTrans': inner, 'signatures': [], 'signature': '00'}})
+    m = multisig.get(timeout=5)
+    assert m['type'] == 'new' and m['txhash'] == 'dd' * 32 and m['all_cosigner'] == ['A', 'B']
+
+    # 切れたらPollingに戻る
+    stomp.drop()
+    assert wait_until(lambda: not nem.push_active.is_set())
+
+    nem.stop()
+    stomp.shutdown()
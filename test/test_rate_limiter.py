@@ -0,0 +1,47 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+from nem_python.utils import RateLimiter
+
+A = ('http', '127.0.0.1', 7890)
+B = ('http', '127.0.0.2', 7890)
+
+
+def test_peer_bucket():
+    limiter = RateLimiter(peer_rate=20, peer_burst=5, global_rate=1000, global_burst=1000)
+    begin = time.time()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(limiter.acquire, [A] * 25))
+    # burst分はすぐ、残り20個は1秒かけて
+    assert 0.9 < time.time() - begin < 1.5
+    assert not limiter.has_tokens(A) and limiter.has_tokens(B)
+    assert limiter.counters()['waited'] > 0
+
+
+def test_global_bucket():
+    limiter = RateLimiter(peer_rate=1000, peer_burst=1000, global_rate=20, global_burst=5)
+    begin = time.time()
+    for i in range(15):
+        limiter.acquire(A if i % 2 else B)
+    assert 0.4 < time.time() - begin < 0.8
+
+
+def test_penalize():
+    limiter = RateLimiter(peer_rate=10, peer_burst=10, global_rate=1000, global_burst=1000)
+    limiter.penalize(A)
+    assert not limiter.has_tokens(A)
+    assert 0.05 < limiter.acquire(A) < 0.2
+
+
+def test_evict():
+    limiter = RateLimiter(peer_rate=5, peer_burst=2, global_rate=100000, global_burst=100000)
+    limiter.evict_interval = 0.1
+    for i in range(1000):
+        limiter.acquire(('http', '10.0.%d.%d' % (i // 256, i % 256), 7890))
+    limiter.penalize(A)
+    time.sleep(0.25)
+    # 満タンに戻ったPeerは消える、制限中のPeerは残る
+    limiter.acquire(B)
+    assert set(limiter.buckets) == {A, B}
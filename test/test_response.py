@@ -0,0 +1,22 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+from nem_python.utils import NemResponse, ResponseStats
+
+
+def test_parse_once():
+    stats = ResponseStats()
+    r = NemResponse('account/get', 200, b'{"account": {"balance": 1}}', stats)
+    assert r.ok and r.json() is r.json()
+    assert r.json()['account']['balance'] == 1
+    NemResponse('account/get', 200, b'{}', stats)
+    s = stats.snapshot()['account/get']
+    assert s['count'] == 2 and s['bytes'] == 29 and s['parsed'] == 1
+
+
+def test_error():
+    r = NemResponse('transaction/announce', 400, b'not json')
+    assert not r.ok
+    with pytest.raises(ValueError):
+        r.json()
@@ -0,0 +1,47 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import threading
+from nem_python.utils import SessionPool
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"height": 1}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test():
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = ('http', '127.0.0.1', server.server_port)
+    uri = "http://127.0.0.1:%d/chain/height" % url[2]
+    pool = SessionPool(maxsize=2)
+    for i in range(5):
+        with pool.session(url) as s:
+            assert s.get(uri, timeout=3).json()['height'] == 1
+    c = pool.counters()
+    print(c)
+    assert c['opened'] == 1 and c['reused'] == 4
+
+    # idle session is closed
+    pool.max_idle = 0
+    with pool.session(url) as s:
+        s.get(uri, timeout=3)
+    pool.close()
+    assert pool.counters()['idle'] == 0
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,34 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from nem_ed25519.key import secret_key, public_key
+from nem_ed25519.signature import sign
+from nem_ed25519.encrypt import encrypt, decrypt
+from nem_ed25519.utils import scalarmult_B, encodepoint, L
+from nem_python.signer import Signer, scalarmult_base, _encode_many
+
+PUB = '80d2ae0d784d28db38b5b85fd77e190981cea6f4328235ec173a90c2853c0761'
+PRI = '6a858fb93e0202fa62f894e591478caa23b06f90471e7976c30fb95efda4b312'
+MSG = "how silent! the cicada's voice soaks into the rocks.".encode()
+
+
+def test_sign():
+    signer = Signer(PRI)
+    assert signer.pk == PUB
+    assert signer.sign(MSG) == sign(msg=MSG, sk=PRI, pk=PUB)
+    msgs = [MSG * i for i in range(8)]
+    assert signer.sign_many(msgs) == [sign(msg=msg, sk=PRI, pk=PUB) for msg in msgs]
+    assert signer.sign_many([]) == []
+    for e in (0, 1, 15, 16, L - 1, L, L + 1, 2 ** 253 - 1):
+        assert _encode_many([scalarmult_base(e)]) == [encodepoint(scalarmult_B(e))]
+
+
+def test_encrypt():
+    sk = secret_key()
+    pk = public_key(sk)
+    signer = Signer(PRI, PUB)
+    for dummy in range(2):
+        # 2回目は共有鍵を使い回す
+        assert decrypt(sk=sk, pk=PUB, enc=signer.encrypt(pk, MSG)) == MSG
+        assert signer.decrypt(pk, encrypt(sk=sk, pk=PUB, msg=MSG)) == MSG
+    assert list(signer.shared) == [pk]
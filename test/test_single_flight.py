@@ -0,0 +1,43 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import pytest
+from nem_python.utils import SingleFlight
+
+
+def test_coalesce():
+    sf = SingleFlight(window=0.2)
+    calls = list()
+    gate = threading.Event()
+
+    def fetch():
+        calls.append(1)
+        gate.wait()
+        return {'height': 100}
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        futures = [pool.submit(sf.do, 'chain/last-block', fetch) for dummy in range(10)]
+        time.sleep(0.1)
+        gate.set()
+        results = [f.result() for f in futures]
+    assert len(calls) == 1 and all(r is results[0] for r in results)
+    # window内は使い回す、過ぎれば取り直す
+    assert sf.do('chain/last-block', fetch) is results[0]
+    time.sleep(0.3)
+    sf.do('chain/last-block', fetch)
+    assert len(calls) == 2
+    assert sf.counters()['coalesced'] == 10
+
+
+def test_error_not_kept():
+    sf = SingleFlight(window=10)
+
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        sf.do('a', fail)
+    assert sf.do('a', lambda: 1) == 1
@@ -0,0 +1,104 @@
+#!/user/env python3
+# -*- coding: utf-8 -*-
+
+from binascii import unhexlify
+import pytest
+from nem_python.transaction_builder import TransactionBuilder, TransactionBuilderError
+
+PK1 = 'a' * 64
+PK2 = 'b' * 64
+PK3 = '0123456789abcdef' * 4
+CK = 'TBULEAUG2CZQISUR442HWA6UAKGWIXHDABJVIPS4'
+v1 = {'type': 257, 'version': -1744830463, 'signer': PK1, 'timeStamp': 90000000, 'deadline': 90003600,
+      'recipient': CK, 'amount': 1234567, 'fee': 50000, 'message': {'type': 1, 'payload': '68656c6c6f'}}
+v1_nomsg = dict(v1, message={'type': 1, 'payload': ''})
+v2 = {'type': 257, 'version': -1744830462, 'signer': PK1, 'timeStamp': 90000000, 'deadline': 90003600,
+      'recipient': CK, 'amount': 1000000, 'fee': 150000, 'message': {'type': 1, 'payload': '00ff'},
+      'mosaics': [{'mosaicId': {'namespaceId': 'nem', 'name': 'xem'}, 'quantity': 5},
+                  {'mosaicId': {'namespaceId': 'bench', 'name': 'coin'}, 'quantity': 10 ** 10}]}
+mod = {'type': 4097, 'version': -1744830462, 'signer': PK1, 'timeStamp': 90000000, 'deadline': 90003600,
+       'fee': 500000, 'modifications': [{'modificationType': 1, 'cosignatoryAccount': PK2},
+                                        {'modificationType': 2, 'cosignatoryAccount': PK3}],
+       'minCosignatories': {'relativeChange': -1}}
+mod0 = dict(mod, minCosignatories={'relativeChange': 0})
+wrap = {'type': 4100, 'version': -1744830463, 'signer': PK2, 'timeStamp': 90000000, 'deadline': 90003600,
+        'fee': 150000, 'otherTrans': v2}
+
+# 以前の実装(bytesを繋げる)で作った値
+EXPECTED = {
+    'v1': (
+        '0101000001000098804a5d0520000000aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa50c300000000000090585d05280000005442554c4541554732435a51495355523434324857413655414b47574958484441424a564950533487d61200000000000d000000010000000500000068656c6c6f'),
+    'v1_nomsg': (
+        '0101000001000098804a5d0520000000aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa50c300000000000090585d05280000005442554c4541554732435a51495355523434324857413655414b47574958484441424a564950533487d612000000000000000000'),
+    'v2': (
+        '0101000002000098804a5d0520000000aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaf04902000000000090585d05280000005442554c4541554732435a51495355523434324857413655414b47574958484441424a564950533440420f00000000000a000000010000000200000000ff020000001d000000110000000500000062656e636804000000636f696e00e40b54020000001a0000000e000000030000006e656d0300000078656d0500000000000000'),
+    'mod': (
+        '0110000002000098804a5d0520000000aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa20a107000000000090585d05020000002800000002000000200000000123456789abcdef0123456789abcdef0123456789abcdef0123456789abcdef280000000100000020000000bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb04000000ffffffff'),
+    'mod0': (
+        '0110000002000098804a5d0520000000aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa20a107000000000090585d05020000002800000002000000200000000123456789abcdef0123456789abcdef0123456789abcdef0123456789abcdef280000000100000020000000bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb'),
+    'wrap': (
+        '0410000001000098804a5d0520000000bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbf04902000000000090585d05c10000000101000002000098804a5d0520000000aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaf04902000000000090585d05280000005442554c4541554732435a51495355523434324857413655414b47574958484441424a564950533440420f00000000000a000000010000000200000000ff020000001d000000110000000500000062656e636804000000636f696e00e40b54020000001a0000000e000000030000006e656d0300000078656d0500000000000000'),
+}
+
+
+def test_same_as_before():
+    for name, tx in [('v1', v1), ('v1_nomsg', v1_nomsg), ('v2', v2), ('mod', mod), ('mod0', mod0), ('wrap', wrap)]:
+        tb = TransactionBuilder()
+        assert tb.encode(tx) == EXPECTED[name], name
+        assert tb.encode_raw(tx) == unhexlify(EXPECTED[name]) == tb.binary
+        assert tb.size(tx) == len(EXPECTED[name]) // 2
+
+
+def test_cosign():
+    tx = {'type': 4098, 'version': -1744830463, 'signer': PK1, 'timeStamp': 90000000, 'deadline': 90003600,
+          'fee': 150000, 'otherHash': {'data': 'cd' * 32}, 'otherAccount': CK}
+    raw = TransactionBuilder().encode_raw(tx)
+    assert len(raw) == 60 + 84
+    assert raw[60:68] == unhexlify('2400000020000000')
+    assert raw[68:100] == b'\xcd' * 32
+    assert raw[100:104] == (40).to_bytes(4, 'little') and raw[104:] == CK.encode()
+
+
+def test_no_shared_state():
+    a, b = TransactionBuilder(), TransactionBuilder()
+    a.encode(v1)
+    assert b.binary == b''
+
+
+def test_decode():
+    tb = TransactionBuilder()
+    for name, tx in [('v1', v1), ('v2', v2), ('mod', mod), ('mod0', mod0), ('wrap', wrap)]:
+        raw = unhexlify(EXPECTED[name])
+        decoded = tb.decode(memoryview(raw))
+        assert tb.encode_raw(decoded) == raw, name
+        assert tb.decode(EXPECTED[name]) == decoded
+    # Mosaicは並べ替えた順、メッセージ無しは{}
+    assert tb.decode(EXPECTED['v1']) == v1
+    assert tb.decode(EXPECTED['v1_nomsg']) == dict(v1, message={})
+    assert [m['mosaicId']['namespaceId'] for m in tb.decode(EXPECTED['v2'])['mosaics']] == ['bench', 'nem']
+    assert tb.decode(EXPECTED['mod'])['minCosignatories'] == {'relativeChange': -1}
+    assert tb.decode(EXPECTED['mod0'])['minCosignatories'] == {'relativeChange': 0}
+    assert tb.decode(EXPECTED['wrap'])['otherTrans']['amount'] == 1000000
+
+    cosign = {'type': 4098, 'version': -1744830463, 'signer': PK1, 'timeStamp': 90000000, 'deadline': 90003600,
+              'fee': 150000, 'otherHash': {'data': 'cd' * 32}, 'otherAccount': CK}
+    assert tb.decode(tb.encode_raw(cosign)) == cosign
+
+
+def test_decode_broken():
+    raw = unhexlify(EXPECTED['wrap'])
+    for broken in (raw[:-1], raw + b'\x00', raw[:100]):
+        with pytest.raises(TransactionBuilderError):
+            TransactionBuilder().decode(broken)
+
+
+def test_wrong_length():
+    # structは黙って0埋め・切り捨てをするので長さ違いはエラー
+    cosign = {'type': 4098, 'version': -1744830463, 'signer': PK1, 'timeStamp': 90000000, 'deadline': 90003600,
+              'fee': 150000, 'otherHash': {'data': 'cd' * 32}, 'otherAccount': CK}
+    for tx in (dict(v1, signer=PK1[:-2]), dict(v1, signer=PK1 + 'aa'), dict(v1, recipient=CK[:-1]),
+               dict(v2, recipient=CK + 'A'), dict(wrap, otherTrans=dict(v2, signer='ab')),
+               dict(mod, modifications=[{'modificationType': 1, 'cosignatoryAccount': PK2[:-2]}]),
+               dict(cosign, otherHash={'data': 'cd' * 31}), dict(cosign, otherAccount=CK[:-1])):
+        with pytest.raises(TransactionBuilderError):
+            TransactionBuilder().encode(tx)